@@ -0,0 +1,200 @@
+import io
+import os
+import datetime
+import tempfile
+import zipfile
+import numpy
+import pandas
+import piecewise
+from fabfile import logger, calibrate, calibration_config, archive_calibration, profile_applied, CALIBRATION_DIR
+
+# Files whose operations drive the design, the other ones (Test, Iprobe, Wtime) are only recorded
+MODEL_FILES = ['exp_Recv.csv', 'exp_Isend.csv', 'exp_PingPong.csv']
+ROUNDS_DIR = 'rounds'
+
+
+def read_csvs(zip_name):
+    input_zip = zipfile.ZipFile(zip_name)
+    result = []
+    for name in input_zip.namelist():
+        if name.endswith('.csv'):
+            df = pandas.read_csv(io.BytesIO(input_zip.read(name)), names=['op', 'msg_size', 'start', 'duration'])
+            df['type'] = os.path.basename(name)
+            result.append(df)
+    return pandas.concat(result, ignore_index=True)
+
+
+def write_sizes(job, sizes, filename):
+    content = '\n'.join(str(size) for size in sorted(set(sizes))) + '\n'
+    job.nodes.write_files(content, os.path.join(CALIBRATION_DIR, filename))
+
+
+def run_round(job, round_id, sizes, iterations):
+    dirname = os.path.join(ROUNDS_DIR, 'round_%d' % round_id)
+    size_file = 'sizes_%d' % round_id
+    logger.info('Calibration round %d: %d sizes, %d iterations' % (round_id, len(set(sizes)), iterations))
+    write_sizes(job, sizes, size_file)
+    config = calibration_config(dirname=dirname, size_file=size_file, min_size=0, max_size=max(sizes),
+                                iterations=iterations)
+    calibrate(job, config, dirname=dirname, config_filename='exp_%d.xml' % round_id)
+    zip_path = '/tmp/round_%d.zip' % round_id
+    job.director.run('rm -f %s && zip -r %s %s' % (zip_path, zip_path, dirname), directory=CALIBRATION_DIR)
+    tmp_file = tempfile.NamedTemporaryFile(dir='.', suffix='.zip')
+    job.director.get(zip_path, tmp_file.name)
+    df = read_csvs(tmp_file.name)
+    tmp_file.close()
+    df['round'] = round_id
+    return df
+
+
+def merge_rounds(job, filenames):
+    '''Concatenate the CSV files of all the rounds in the exp directory, to get the usual archive layout.'''
+    job.director.run('rm -rf exp && mkdir exp', directory=CALIBRATION_DIR)
+    for name in filenames:
+        job.director.run('cat %s/round_*/%s > exp/%s' % (ROUNDS_DIR, name, name), directory=CALIBRATION_DIR)
+
+
+def archive_rounds(job, data, start_date, end_date, extra_files, profile_record=None):
+    '''Merge the rounds and archive them, with the record of the benchmark profile if any.'''
+    merge_rounds(job, data.type.unique())
+    if profile_record:
+        extra_files = dict(extra_files, **{'profile.yaml': profile_record})
+    return archive_calibration(job, start_date, end_date, extra_files)
+
+
+def summarize(df, z=1.96):
+    '''
+    Per file, operation and message size: number of measurements, mean, standard error and relative half-width of the
+    confidence interval.
+    '''
+    df = df[df.type.isin(MODEL_FILES)]
+    stats = df.groupby(['type', 'op', 'msg_size']).duration.agg(['count', 'mean', 'std', 'median']).reset_index()
+    stats['se'] = stats['std'].fillna(numpy.inf)/numpy.sqrt(stats['count'])
+    stats['relative_ci'] = z*stats['se']/stats['mean']
+    return stats
+
+
+def find_breakpoints(stats, max_breakpoints=5):
+    result = {}
+    for (filename, op), df in stats.groupby(['type', 'op']):
+        if len(df) < 6:
+            continue
+        result['%s/%s' % (filename, op)] = piecewise.find_breakpoints(df.msg_size.values, df['median'].values,
+                                                                     max_breakpoints=max_breakpoints)
+    return result
+
+
+def refine_sizes(sampled_sizes, breakpoints, nb_points=4, resolution=0.1):
+    '''
+    New sizes in the intervals (previous sampled size, breakpoint) that are still larger than the resolution, to locate
+    the breakpoints more precisely.
+    '''
+    sampled_sizes = numpy.array(sorted(set(sampled_sizes)))
+    new_sizes = set()
+    for bp in breakpoints:
+        lower = sampled_sizes[sampled_sizes < bp]
+        if len(lower) == 0:
+            continue
+        left, right = lower[-1], bp
+        if right - left <= 1 or right/max(left, 1) <= 1 + resolution:
+            continue
+        candidates = numpy.geomspace(max(left, 1), right, nb_points+2)[1:-1].astype(int)
+        new_sizes |= set(int(size) for size in candidates if left < size < right)
+    return sorted(new_sizes - set(sampled_sizes.tolist()))
+
+
+def run_adaptive_calibration(job, max_size=1000000, nb_initial_sizes=40, initial_iterations=3, iterations=3,
+                             target=0.05, max_rounds=8, max_breakpoints=5, profile=None):
+    '''
+    Calibration with an adaptive design: a coarse sweep of log-spaced sizes, then rounds concentrating the
+    measurements on the intervals containing the breakpoints of the piecewise models and on the sizes whose confidence
+    interval (relative half-width) is larger than target. Stops when all the intervals meet the target and the
+    breakpoints are located, or after max_rounds rounds.
+    '''
+    if max_rounds < 1:
+        raise ValueError('At least one round is needed, got max_rounds=%d.' % max_rounds)
+    sizes = [0] + sorted(set(numpy.geomspace(1, max_size, nb_initial_sizes).astype(int).tolist()))
+    job.director.run('rm -rf %s' % ROUNDS_DIR, directory=CALIBRATION_DIR)
+    history = []
+    all_data = []
+    with profile_applied(job, profile) as profile_record:
+        start_date = datetime.datetime.now()
+        round_iterations = initial_iterations
+        for round_id in range(max_rounds):
+            all_data.append(run_round(job, round_id, sizes, round_iterations))
+            data = pandas.concat(all_data, ignore_index=True)
+            stats = summarize(data)
+            breakpoints = find_breakpoints(stats, max_breakpoints)
+            sampled = stats.msg_size.unique()
+            new_sizes = refine_sizes(sampled, set(sum(breakpoints.values(), [])))
+            noisy_sizes = stats[stats.relative_ci > target].msg_size.unique().tolist()
+            history.append({'round': round_id, 'sizes': len(set(sizes)), 'iterations': round_iterations,
+                            'measurements': len(all_data[-1]), 'breakpoints': breakpoints,
+                            'noisy_sizes': len(noisy_sizes)})
+            logger.info('Round %d: %d breakpoint(s), %d new size(s), %d size(s) above the target' % (
+                round_id, len(set(sum(breakpoints.values(), []))), len(new_sizes), len(noisy_sizes)))
+            if not new_sizes and not noisy_sizes:
+                break
+            sizes = sorted(set(new_sizes) | set(int(size) for size in noisy_sizes))
+            round_iterations = iterations
+        end_date = datetime.datetime.now()
+    extra_files = {'adaptive.yaml': {'target': target, 'rounds': history,
+                                     'breakpoints': {key: [float(bp) for bp in value]
+                                                     for key, value in breakpoints.items()}}}
+    return archive_rounds(job, data, start_date, end_date, extra_files, profile_record)
+
+
+def read_zoo_sizes(job, min_size=0, max_size=1000000):
+    sizes = job.director.run_unique('cat zoo_sizes', hide_output=False, directory=CALIBRATION_DIR).stdout.split()
+    return sorted(set(int(size) for size in sizes if min_size <= int(size) <= max_size))
+
+
+def run_sequential_calibration(job, sizes=None, batch_iterations=2, max_relative_se=0.02, min_iterations=3,
+                               max_iterations=20, fixed_iterations=5, profile=None):
+    '''
+    Calibration where each message size is sampled until the standard error of its durations (relative to the mean, for
+    every operation) falls below max_relative_se, or until max_iterations iterations have been done. The sizes are
+    sampled by batches of batch_iterations iterations. The report compares the number of iterations with the fixed
+    design (fixed_iterations for every size).
+    '''
+    sizes = sizes or read_zoo_sizes(job)
+    job.director.run('rm -rf %s' % ROUNDS_DIR, directory=CALIBRATION_DIR)
+    iterations = {size: 0 for size in sizes}
+    active = set(sizes)
+    all_data = []
+    with profile_applied(job, profile) as profile_record:
+        start_date = datetime.datetime.now()
+        round_id = 0
+        while active:
+            all_data.append(run_round(job, round_id, sorted(active), batch_iterations))
+            for size in active:
+                iterations[size] += batch_iterations
+            data = pandas.concat(all_data, ignore_index=True)
+            stats = summarize(data[data.msg_size.isin(active)])
+            worst = (stats['se']/stats['mean']).groupby(stats.msg_size).max()
+            converged = set(worst[worst <= max_relative_se].index)
+            done = set(size for size in active if iterations[size] >= max_iterations or
+                       (size in converged and iterations[size] >= min_iterations))
+            active -= done
+            logger.info('Round %d: %d size(s) done, %d remaining' % (round_id, len(done), len(active)))
+            round_id += 1
+        end_date = datetime.datetime.now()
+    report = sequential_report(iterations, max_iterations, fixed_iterations)
+    report['max_relative_se'] = max_relative_se
+    logger.info('%d iterations instead of %d with the fixed design (%.1f%% saved), %d size(s) hit the cap' % (
+        report['iterations'], report['fixed_iterations'], report['saved_fraction']*100, report['capped_sizes']))
+    return archive_rounds(job, data, start_date, end_date, {'sequential.yaml': report}, profile_record), report
+
+
+def sequential_report(iterations, max_iterations, fixed_iterations):
+    total = sum(iterations.values())
+    fixed_total = fixed_iterations*len(iterations)
+    return {
+        'sizes': len(iterations),
+        'iterations': total,
+        'fixed_iterations': fixed_total,
+        'saved_iterations': fixed_total - total,
+        'saved_fraction': (fixed_total - total)/fixed_total if fixed_total else 0.0,
+        'capped_sizes': sum(1 for nb in iterations.values() if nb >= max_iterations),
+        'iterations_per_size': {int(size): nb for size, nb in sorted(iterations.items())},
+    }
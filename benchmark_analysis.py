@@ -0,0 +1,181 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import multiprocessing
+import numpy
+import pandas
+import extract_archive
+
+FOLDERS = ['results', 'results_paravance', 'results_paravance_deploy', 'results_paravance_deploy2', 'grvingt']
+SCALES = [1, 10, 100]
+BASELINE_FILE = 'benchmark_baseline.json'
+
+
+def list_archives(folder):
+    result = []
+    for root, dirs, files in os.walk(folder):
+        result.extend(os.path.join(root, f) for f in files if f.endswith('.zip'))
+    return sorted(result)
+
+
+def reference_dataframe(archive, csv_name='exp/exp_Recv.csv'):
+    return extract_archive.extract_zip(archive)[csv_name]
+
+
+def scale_dataframe(df, factor, seed=42):
+    '''Synthetic dataset with factor times more rows, the durations of the copies are perturbed with a small noise.'''
+    if factor == 1:
+        return df
+    random = numpy.random.RandomState(seed)
+    copies = []
+    for i in range(factor):
+        copy = df.copy()
+        if i > 0:
+            copy['duration'] *= random.lognormal(0, 0.05, len(copy))
+        copy['index'] += i*len(df)
+        copies.append(copy)
+    return pandas.concat(copies, ignore_index=True)
+
+
+def _peak_rss():
+    '''Peak resident set size of the current process, in kB.'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM'):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _reset_peak_rss():
+    try:  # Linux only, resets VmHWM to the current RSS
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _measure(pipe, setup, function):
+    try:
+        args = setup()
+        _reset_peak_rss()
+        base_rss = _peak_rss()
+        start = time.perf_counter()
+        function(*args)
+        duration = time.perf_counter() - start
+        pipe.send(((duration, _peak_rss(), base_rss), None))
+    except Exception as e:
+        try:
+            pipe.send((None, e))
+        except Exception:  # the exception cannot be pickled
+            pipe.send((None, RuntimeError(repr(e))))
+    pipe.close()
+
+
+def measure(setup, function, repeat=3):
+    '''
+    Run function(*setup()) repeat times, each time in a new process, and return the best time (in seconds), the peak
+    RSS and the RSS increase during the call (in kB). The setup is not measured. An exception of the setup or of the
+    function is raised again here.
+    '''
+    context = multiprocessing.get_context('fork')
+    times, peaks, deltas = [], [], []
+    for _ in range(repeat):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_measure, args=(sender, setup, function))
+        process.start()
+        sender.close()  # otherwise, the receiver never gets EOF if the process dies
+        try:
+            result, error = receiver.recv()
+        except EOFError:
+            result, error = None, None
+        process.join()
+        if error is not None:
+            raise error
+        if result is None or process.exitcode != 0:
+            raise RuntimeError('The measure process failed with exit code %s.' % process.exitcode)
+        duration, peak, base = result
+        times.append(duration)
+        peaks.append(peak)
+        deltas.append(peak - base)
+    return {'time': min(times), 'peak_rss': max(peaks), 'rss_increase': max(deltas)}
+
+
+def benchmark_cases(folders=FOLDERS, scales=SCALES):
+    cases = {}
+    for folder in folders:
+        if not list_archives(folder):
+            raise ValueError('No zip archive in %s.' % folder)
+        archive = list_archives(folder)[0]
+        cases['extract_zip[%s]' % folder] = (lambda archive=archive: (archive,), extract_archive.extract_zip)
+        cases['extract_folder[%s]' % folder] = (lambda folder=folder: (folder,), extract_archive.extract_folder)
+    reference = list_archives(folders[-1])[0]
+    for scale in scales:
+        def setup(scale=scale):
+            return (scale_dataframe(reference_dataframe(reference), scale),)
+        for func in [extract_archive.lower_quantile, extract_archive.aggregate_dataframe,
+                     extract_archive.clean_dataset]:
+            cases['%s[x%d]' % (func.__name__, scale)] = (setup, func)
+    return cases
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, res in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in ['time', 'peak_rss']:
+            ratio = res[metric] / baseline[name][metric]
+            if ratio > 1 + tolerance:
+                regressions.append((name, metric, ratio))
+            print('%-50s %-8s %6.2fx baseline' % (name, metric, ratio))
+    return regressions
+
+
+def main(args):
+    cases = benchmark_cases(args.folders, args.scales)
+    results = {}
+    for name, (setup, function) in sorted(cases.items()):
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(setup, function, repeat=args.repeat)
+        print('%-50s %8.3f s %8.1f MB peak RSS (+%.1f MB)' % (name, results[name]['time'],
+                                                              results[name]['peak_rss']/1024,
+                                                              results[name]['rss_increase']/1024))
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, ratio in regressions:
+            print('REGRESSION: %s %s is %.2f times the baseline' % (name, metric, ratio))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the analysis functions')
+    parser.add_argument('--folders', nargs='+', default=FOLDERS, help='Folders with the archives to use.')
+    parser.add_argument('--scales', nargs='+', type=int, default=SCALES,
+                        help='Scaling factors of the synthetic datasets.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per benchmark.')
+    parser.add_argument('--filter', type=str, default=None, help='Only run the benchmarks whose name contains it.')
+    parser.add_argument('--baseline', type=str, default=BASELINE_FILE, help='File for the baseline.')
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative slowdown (or memory increase) considered as a regression.')
+    main(parser.parse_args())
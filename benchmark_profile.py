@@ -0,0 +1,160 @@
+import base64
+import contextlib
+from fabfile import logger
+
+RESTORE_FILE = '/tmp/benchmark_profile_restore.sh'
+
+SCRIPT_HEADER = r'''
+cpu=/sys/devices/system/cpu
+read_value() {
+    sed -e 's/.*\[\(.*\)\].*/\1/' "$1"
+}
+set_value() {
+    [ -w "$1" ] || return 0
+    echo "echo '$(read_value $1)' > $1" >> %(restore)s
+    echo "$2" > "$1"
+}
+state() {
+    echo "governor=$(cat $cpu/cpu0/cpufreq/scaling_governor 2> /dev/null || echo none)"
+    echo "min_freq=$(cat $cpu/cpu0/cpufreq/scaling_min_freq 2> /dev/null || echo 0)"
+    echo "max_freq=$(cat $cpu/cpu0/cpufreq/scaling_max_freq 2> /dev/null || echo 0)"
+    echo "cur_freq=$(grep MHz /proc/cpuinfo | awk '{s+=$4} END {printf "%%d", s/NR*1000}')"
+    if [ -e $cpu/intel_pstate/no_turbo ]; then
+        echo "turbo=$((1 - $(cat $cpu/intel_pstate/no_turbo)))"
+    else
+        echo "turbo=$(cat $cpu/cpufreq/boost 2> /dev/null || echo none)"
+    fi
+    echo "cstates=$(cat $cpu/cpu0/cpuidle/state*/disable 2> /dev/null | tr -d '\n')"
+    echo "thp=$(read_value /sys/kernel/mm/transparent_hugepage/enabled 2> /dev/null || echo none)"
+    echo "hugepages=$(cat /proc/sys/vm/nr_hugepages)"
+    echo "online=$(cat $cpu/online)"
+}
+'''
+
+
+class BenchmarkProfile:
+    '''
+    Declarative node configuration for the benchmarks. A value of None leaves the corresponding setting untouched.
+    - hyperthreading: enable (True) or disable (False) the hyperthreads
+    - governor: cpufreq governor
+    - frequency: 'max' or a frequency in kHz, used both as minimum and maximum frequency
+    - turbo: enable or disable turbo boost
+    - cstate_limit: deepest C-state allowed (the deeper ones are disabled)
+    - thp: transparent huge pages mode ('always', 'madvise' or 'never')
+    - hugepages: number of huge pages to reserve
+    '''
+    def __init__(self, hyperthreading=None, governor='performance', frequency='max', turbo=False, cstate_limit=None,
+                 thp=None, hugepages=None):
+        self.hyperthreading = hyperthreading
+        self.governor = governor
+        self.frequency = frequency
+        self.turbo = turbo
+        self.cstate_limit = cstate_limit
+        self.thp = thp
+        self.hugepages = hugepages
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        settings = ', '.join('%s=%r' % (key, value) for key, value in self.to_dict().items() if value is not None)
+        return '%s(%s)' % (self.__class__.__name__, settings)
+
+    def __apply_commands(self, job):
+        cmd = ['rm -f %s' % RESTORE_FILE]
+        # The hyperthreads are enabled first and disabled last, so that they get the settings of the profile. The
+        # restoration runs in reverse order: it disables them last and enables them first.
+        online = []
+        if self.hyperthreading is not None:
+            online = ['set_value $cpu/cpu%d/online %d' % (core, self.hyperthreading) for core in job.nodes.hyperthreads]
+        if self.hyperthreading:
+            cmd.extend(online)
+        if self.governor:
+            cmd.append('for f in $cpu/cpu*/cpufreq/scaling_governor; do set_value $f %s; done' % self.governor)
+        if self.frequency:
+            if self.frequency == 'max':
+                freq = '$(cat $(dirname $f)/cpuinfo_max_freq)'
+            else:
+                freq = str(int(self.frequency))
+            # The maximum frequency is set first, so that the minimum frequency is never above it when lowering both.
+            cmd.append('for f in $cpu/cpu*/cpufreq/scaling_max_freq; do set_value $f %s; done' % freq)
+            cmd.append('for f in $cpu/cpu*/cpufreq/scaling_min_freq; do set_value $f %s; done' % freq)
+            cmd.append('for f in $cpu/cpu*/cpufreq/scaling_max_freq; do set_value $f %s; done' % freq)
+        if self.turbo is not None:
+            cmd.append('set_value $cpu/intel_pstate/no_turbo %d' % (not self.turbo))
+            cmd.append('set_value $cpu/cpufreq/boost %d' % self.turbo)
+        if self.cstate_limit is not None:
+            cmd.append('for f in $cpu/cpu*/cpuidle/state*/disable; do '
+                       'i=$(basename $(dirname $f) | tr -d state); '
+                       'set_value $f $((i > %d)); done' % self.cstate_limit)
+        if self.thp:
+            cmd.append('set_value /sys/kernel/mm/transparent_hugepage/enabled %s' % self.thp)
+        if self.hugepages is not None:
+            cmd.append('set_value /proc/sys/vm/nr_hugepages %d' % self.hugepages)
+        if self.hyperthreading is False:
+            cmd.extend(online)
+        return cmd
+
+    @staticmethod
+    def _run_script(job, lines):
+        script = SCRIPT_HEADER % {'restore': RESTORE_FILE} + '\n'.join(lines) + '\n'
+        script = base64.b64encode(script.encode()).decode()
+        sudo = '' if job.deploy else 'sudo-g5k '
+        output = job.nodes.run('echo %s | base64 -d | %sbash' % (script, sudo), hide_output=False)
+        result = {}
+        for node, res in output.items():
+            states = []
+            for section in res.stdout.strip().split('---'):
+                state = {}
+                for line in section.strip().split('\n'):
+                    if not line:
+                        continue
+                    key, value = line.split('=', 1)
+                    state[key] = value
+                states.append(state)
+            result[node.host] = states
+        return result
+
+    @classmethod
+    def read_state(cls, job):
+        return {host: states[0] for host, states in cls._run_script(job, ['state']).items()}
+
+    def apply(self, job):
+        logger.info('Applying benchmark profile %s' % self)
+        result = self._run_script(job, ['state', 'echo "---"'] + self.__apply_commands(job) + ['state'])
+        before = {host: states[0] for host, states in result.items()}
+        after = {host: states[1] for host, states in result.items()}
+        return before, after
+
+    def check(self, job, state=None):
+        state = state or self.read_state(job)
+        for host, values in state.items():
+            if values['governor'] == 'none' and (self.governor or self.frequency):
+                logger.warning('[%s] cpufreq is not available, cannot check the frequency settings' % host)
+            else:
+                if self.governor and values['governor'] != self.governor:
+                    logger.warning('[%s] governor is %s, expected %s' % (host, values['governor'], self.governor))
+                if self.frequency and values['min_freq'] != values['max_freq']:
+                    logger.warning('[%s] frequency range is [%s, %s], expected a fixed frequency' % (
+                        host, values['min_freq'], values['max_freq']))
+            if self.turbo is not None and values['turbo'] not in ('none', str(int(self.turbo))):
+                logger.warning('[%s] turbo is %s, expected %d' % (host, values['turbo'], self.turbo))
+            if self.thp and values['thp'] not in ('none', self.thp):
+                logger.warning('[%s] transparent huge pages are %s, expected %s' % (host, values['thp'], self.thp))
+        return state
+
+    def restore(self, job):
+        logger.info('Restoring the node settings')
+        self._run_script(job, ['[ -e %s ] && tac %s | bash' % (RESTORE_FILE, RESTORE_FILE),
+                               'rm -f %s' % RESTORE_FILE])
+
+    @contextlib.contextmanager
+    def applied(self, job):
+        record = {'profile': self.to_dict()}
+        try:  # the restore file is written as the settings are applied, a partial apply is restored too
+            record['before'], record['applied'] = self.apply(job)
+            self.check(job, record['applied'])
+            yield record
+            record['after'] = self.check(job)
+        finally:
+            self.restore(job)
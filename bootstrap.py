@@ -0,0 +1,134 @@
+import os
+import collections
+import concurrent.futures
+import numpy
+import pandas
+import piecewise
+
+BootstrapResult = collections.namedtuple('BootstrapResult', ['intervals', 'nb_resamples', 'nb_failed', 'converged'])
+
+_data = {}  # the measures, in each worker process
+
+
+def clean(msg_size, duration):
+    '''
+    Vectorized version of extract_archive.clean_dataset for the durations: for each message size, the mean of the
+    durations lower than the median. Return the message sizes and the cleaned durations.
+    '''
+    df = pandas.DataFrame({'msg_size': msg_size, 'duration': duration})
+    df = df[df.duration < df.groupby('msg_size').duration.transform('median')]
+    means = df.groupby('msg_size').duration.mean()
+    return means.index.to_numpy(dtype=float), means.to_numpy()
+
+
+def _fit(msg_size, duration, max_breakpoints, min_improvement):
+    x, y = clean(msg_size, duration)
+    breakpoints = piecewise.find_breakpoints(x, y, max_breakpoints=max_breakpoints, min_improvement=min_improvement)
+    return breakpoints, piecewise.fit_piecewise(x, y, breakpoints)
+
+
+def _parameters(breakpoints, segments):
+    return list(breakpoints) + [seg.intercept for seg in segments] + [seg.slope for seg in segments]
+
+
+def _parameter_names(nb_breakpoints):
+    return ['breakpoint_%d' % (i+1) for i in range(nb_breakpoints)] + \
+           ['intercept_%d' % i for i in range(nb_breakpoints+1)] + ['slope_%d' % i for i in range(nb_breakpoints+1)]
+
+
+def _blocks(df, block_size):
+    '''
+    The measures, sorted by file and by time, and the start and length of each block of block_size consecutive
+    measures of a file (by default, as many measures as message sizes in the file).
+    '''
+    keys = [column for column in ['experiment', 'type'] if column in df.columns]
+    df = df.sort_values(keys + ['index' if 'index' in df.columns else 'start'], kind='stable')
+    files = df.groupby(keys, sort=False).ngroup().to_numpy() if keys else numpy.zeros(len(df), dtype=int)
+    position = df.groupby(files).cumcount().to_numpy()
+    if block_size is None:
+        block_size = df.groupby(files).msg_size.transform('nunique').to_numpy()
+    blocks, _ = pandas.factorize(files * (len(df) + 1) + position // block_size)
+    lengths = numpy.bincount(blocks)
+    starts = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+    return df.msg_size.to_numpy(dtype=float), df.duration.to_numpy(dtype=float), starts, lengths
+
+
+def _init_worker(data):
+    _data.update(data)
+
+
+def _resample(seeds):
+    '''Fit the model on the resamples of the given seeds, None for the resamples with too few breakpoints.'''
+    results = []
+    nb_blocks = len(_data['starts'])
+    for seed in seeds:
+        chosen = numpy.random.RandomState(seed).randint(nb_blocks, size=nb_blocks)
+        lengths = _data['lengths'][chosen]
+        offsets = numpy.cumsum(lengths) - lengths
+        index = numpy.repeat(_data['starts'][chosen] - offsets, lengths) + numpy.arange(lengths.sum())
+        breakpoints, segments = _fit(_data['msg_size'][index], _data['duration'][index], _data['nb_breakpoints'], 0)
+        if len(breakpoints) == _data['nb_breakpoints'] and len(segments) == len(breakpoints) + 1:
+            results.append(_parameters(breakpoints, segments))
+        else:
+            results.append(None)
+    return results
+
+
+def _intervals(estimates, confidence):
+    estimates = numpy.asarray(estimates)
+    alpha = (1 - confidence) / 2
+    return numpy.quantile(estimates, alpha, axis=0), numpy.quantile(estimates, 1 - alpha, axis=0)
+
+
+def _stable(previous, current, tolerance):
+    '''True if no bound moved by more than tolerance times the width of its interval.'''
+    width = current[1] - current[0]
+    width = numpy.where(width > 0, width, 1e-300)
+    change = numpy.maximum(numpy.abs(current[0] - previous[0]), numpy.abs(current[1] - previous[1])) / width
+    return bool((change <= tolerance).all())
+
+
+def bootstrap_piecewise(df, max_breakpoints=5, min_improvement=0.1, block_size=None, confidence=0.95,
+                        max_resamples=1000, min_resamples=100, batch_size=50, tolerance=0.02, nb_workers=None,
+                        seed=42):
+    '''
+    Bootstrap confidence intervals of the breakpoints, intercepts and slopes of the piecewise linear model of the
+    durations on the cleaned data (as in smpi_platform.fit_overhead), from the raw measures of extract_zip.
+    The measures are resampled by blocks of block_size consecutive measures of the same file, by default one iteration
+    of the calibration, to keep their time correlation. The number of breakpoints is the one of the model of the whole
+    data, the resamples with fewer breakpoints are counted as failed. The resamples are fitted by batches of
+    batch_size in nb_workers processes, until the bounds of the intervals move by less than tolerance (relative to
+    their width) between two batches, or until max_resamples resamples.
+    '''
+    msg_size, duration, starts, lengths = _blocks(df, block_size)
+    breakpoints, segments = _fit(msg_size, duration, max_breakpoints, min_improvement)
+    data = {'msg_size': msg_size, 'duration': duration, 'starts': starts, 'lengths': lengths,
+            'nb_breakpoints': len(breakpoints)}
+    nb_workers = nb_workers or os.cpu_count() or 1
+    estimates = []
+    nb_failed = 0
+    previous = None
+    converged = False
+    with concurrent.futures.ProcessPoolExecutor(nb_workers, initializer=_init_worker, initargs=(data,)) as executor:
+        while len(estimates) + nb_failed < max_resamples:
+            first_seed = seed + len(estimates) + nb_failed
+            seeds = list(range(first_seed, first_seed + min(batch_size, max_resamples - len(estimates) - nb_failed)))
+            chunks = [seeds[i::nb_workers] for i in range(nb_workers) if seeds[i::nb_workers]]
+            for results in executor.map(_resample, chunks):
+                nb_failed += results.count(None)
+                estimates.extend(values for values in results if values is not None)
+            if len(estimates) < max(min_resamples, 2):
+                continue
+            current = _intervals(estimates, confidence)
+            if previous is not None and _stable(previous, current, tolerance):
+                converged = True
+                break
+            previous = current
+    names = _parameter_names(len(breakpoints))
+    intervals = pandas.DataFrame({'parameter': names, 'estimate': _parameters(breakpoints, segments)})
+    if estimates:
+        intervals['low'], intervals['high'] = _intervals(estimates, confidence)
+        intervals['std'] = numpy.std(estimates, axis=0, ddof=1) if len(estimates) > 1 else numpy.nan
+    else:
+        intervals['low'] = intervals['high'] = intervals['std'] = numpy.nan
+    return BootstrapResult(intervals, len(estimates), nb_failed, converged)
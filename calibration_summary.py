@@ -0,0 +1,100 @@
+from fabfile import logger, CALIBRATION_DIR
+
+SUMMARY_SUFFIX = '.summary.csv'
+BINS_PER_DECADE = 10
+
+# Run with python3 on the director, only with the standard library (Python 3.5 on debian9).
+SUMMARY_SCRIPT = r'''
+import math
+import os
+import random
+import sys
+
+QUANTILES = [('q10', 0.1), ('q25', 0.25), ('median', 0.5), ('q75', 0.75), ('q90', 0.9)]
+BINS_PER_DECADE = %(bins_per_decade)d
+FIELDS = ['op', 'msg_size', 'count', 'mean', 'std', 'min'] + [name for name, _ in QUANTILES] + ['max', 'histogram']
+
+
+def quantile(values, q):
+    """Quantile of the sorted values, with a linear interpolation (like pandas)."""
+    position = q * (len(values) - 1)
+    low = int(math.floor(position))
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def histogram(values):
+    """Counts of the durations in logarithmic bins, as "bin:count" pairs; bin b is [10**(b/N), 10**((b+1)/N))."""
+    bins = {}
+    for value in values:
+        b = int(math.floor(math.log10(max(value, 1e-12)) * BINS_PER_DECADE))
+        bins[b] = bins.get(b, 0) + 1
+    return ' '.join('%%d:%%d' %% (b, bins[b]) for b in sorted(bins))
+
+
+def summarize_file(filename, raw_fraction, rng):
+    lines = []
+    durations = {}
+    with open(filename) as f:
+        for line in f:
+            try:
+                op, size, _, duration = line.strip().split(',')
+                key = (op, int(size))
+                duration = float(duration)
+            except ValueError:
+                continue
+            lines.append((key[1], line))
+            durations.setdefault(key, []).append(duration)
+    with open(filename[:-len('.csv')] + '%(suffix)s', 'w') as f:
+        f.write(','.join(FIELDS) + '\n')
+        for (op, size), values in sorted(durations.items()):
+            values.sort()
+            mean = sum(values) / len(values)
+            std = math.sqrt(sum((v - mean)**2 for v in values) / (len(values) - 1)) if len(values) > 1 else 0
+            row = [op, size, len(values), mean, std, values[0]] + [quantile(values, q) for _, q in QUANTILES]
+            row += [values[-1], histogram(values)]
+            f.write(','.join(str(value) for value in row) + '\n')
+    if raw_fraction >= 1:
+        return
+    sizes = sorted(set(size for _, size in durations))
+    nb_kept = max(1, int(round(len(sizes) * raw_fraction))) if raw_fraction > 0 and sizes else 0
+    kept = set(rng.sample(sizes, nb_kept))
+    if not kept:
+        os.remove(filename)
+        return
+    with open(filename, 'w') as f:
+        for size, line in lines:
+            if size in kept:
+                f.write(line)
+
+
+def main(dirname, raw_fraction, seed):
+    rng = random.Random(seed)
+    before = after = 0
+    for name in sorted(os.listdir(dirname)):
+        if not name.endswith('.csv') or name.endswith('%(suffix)s'):
+            continue
+        filename = os.path.join(dirname, name)
+        before += os.path.getsize(filename)
+        summarize_file(filename, raw_fraction, rng)
+    for name in os.listdir(dirname):
+        after += os.path.getsize(os.path.join(dirname, name))
+    print('%%d %%d' %% (before, after))
+
+
+main(sys.argv[1], float(sys.argv[2]), int(sys.argv[3]))
+''' % {'bins_per_decade': BINS_PER_DECADE, 'suffix': SUMMARY_SUFFIX}
+
+
+def summarize(job, dirname='exp', raw_fraction=0.05, seed=42):
+    '''
+    Reduce the calibration files of the director, before they are archived: for each file exp_<operation>.csv, the
+    file exp_<operation>.summary.csv has one line per operation and message size, with the number of measures, the
+    mean, standard deviation, extrema, quantiles and an histogram of the durations. The raw measures are only kept for
+    a random fraction raw_fraction of the message sizes (all of them with raw_fraction=1, none with raw_fraction=0).
+    '''
+    job.director.write_files(SUMMARY_SCRIPT, CALIBRATION_DIR + '/summarize.py')
+    output = job.director.run_unique('python3 summarize.py %s %f %d' % (dirname, raw_fraction, seed),
+                                     hide_output=False, directory=CALIBRATION_DIR)
+    before, after = [int(value) for value in output.stdout.split()]
+    logger.info('Calibration files reduced from %.1f MB to %.1f MB' % (before*1e-6, after*1e-6))
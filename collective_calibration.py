@@ -0,0 +1,152 @@
+from fabfile import logger, CALIBRATION_DIR
+
+BENCHMARK_SOURCE = r'''
+#include <mpi.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+#define NB_COLLECTIVES 6
+static const char *names[NB_COLLECTIVES] = {"Barrier", "Bcast", "Reduce", "Allreduce", "Allgather", "Alltoall"};
+
+static void collective(int op, char *sendbuf, char *recvbuf, int size) {
+    int count = size / sizeof(double);  /* the reductions are done on doubles */
+    switch(op) {
+        case 0: MPI_Barrier(MPI_COMM_WORLD); break;
+        case 1: MPI_Bcast(sendbuf, size, MPI_CHAR, 0, MPI_COMM_WORLD); break;
+        case 2: MPI_Reduce(sendbuf, recvbuf, count, MPI_DOUBLE, MPI_SUM, 0, MPI_COMM_WORLD); break;
+        case 3: MPI_Allreduce(sendbuf, recvbuf, count, MPI_DOUBLE, MPI_SUM, MPI_COMM_WORLD); break;
+        case 4: MPI_Allgather(sendbuf, size, MPI_CHAR, recvbuf, size, MPI_CHAR, MPI_COMM_WORLD); break;
+        case 5: MPI_Alltoall(sendbuf, size, MPI_CHAR, recvbuf, size, MPI_CHAR, MPI_COMM_WORLD); break;
+    }
+}
+
+static FILE *open_output(const char *dirname, const char *name) {
+    char filename[1024];
+    snprintf(filename, sizeof(filename), "%s/exp_%s.csv", dirname, name);
+    FILE *f = fopen(filename, "w");
+    if(!f) {
+        perror(filename);
+        MPI_Abort(MPI_COMM_WORLD, 1);
+    }
+    return f;
+}
+
+/*
+ * Every iteration, for each message size (in a random order, the same on all the ranks):
+ * - each collective operation is timed on all the ranks, the maximal duration is written in exp_<operation>.csv;
+ * - k pairs of ranks (rank i and rank i+n/2, for i < k) do a ping-pong at the same time, for k = 1, 2, 4, ... n/2, the
+ *   duration of each pair is written in exp_Contention.csv with the operation PingPong_<k>pairs.
+ * The lines have the same format as the ones of the calibrate program: operation,size,start,duration.
+ */
+int main(int argc, char *argv[]) {
+    MPI_Init(&argc, &argv);
+    int rank, nb_ranks;
+    MPI_Comm_rank(MPI_COMM_WORLD, &rank);
+    MPI_Comm_size(MPI_COMM_WORLD, &nb_ranks);
+    if(argc != 6) {
+        if(rank == 0)
+            fprintf(stderr, "Syntax: %s <dirname> <size_file> <min_size> <max_size> <iterations>\n", argv[0]);
+        MPI_Finalize();
+        return 1;
+    }
+    int min_size = atoi(argv[3]), max_size = atoi(argv[4]), iterations = atoi(argv[5]);
+    int nb_sizes = 0, sizes[100000], size;
+    FILE *size_file = fopen(argv[2], "r");
+    if(!size_file) {
+        perror(argv[2]);
+        MPI_Abort(MPI_COMM_WORLD, 1);
+    }
+    while(nb_sizes < 100000 && fscanf(size_file, "%d", &size) == 1)
+        if(min_size <= size && size <= max_size)
+            sizes[nb_sizes++] = size;
+    fclose(size_file);
+    char *sendbuf = calloc((size_t)max_size*nb_ranks + 8, 1), *recvbuf = calloc((size_t)max_size*nb_ranks + 8, 1);
+    double *durations = malloc(nb_ranks*sizeof(double));
+    int nb_pairs = nb_ranks / 2, pair = rank % (nb_pairs ? nb_pairs : 1), partner = (rank + nb_pairs) % nb_ranks;
+    FILE *files[NB_COLLECTIVES], *contention = NULL;
+    if(rank == 0) {
+        for(int op = 0; op < NB_COLLECTIVES; op++)
+            files[op] = open_output(argv[1], names[op]);
+        if(nb_ranks % 2 == 0)
+            contention = open_output(argv[1], "Contention");
+        else
+            fprintf(stderr, "Odd number of ranks, no contention measure\n");
+    }
+    MPI_Barrier(MPI_COMM_WORLD);
+    double origin = MPI_Wtime();
+    for(int it = 0; it < iterations; it++) {
+        srand(it);
+        for(int i = nb_sizes-1; i > 0; i--) {
+            int j = rand() % (i+1), tmp = sizes[i];
+            sizes[i] = sizes[j];
+            sizes[j] = tmp;
+        }
+        for(int i = 0; i < nb_sizes; i++) {
+            for(int op = 0; op < NB_COLLECTIVES; op++) {
+                if(op == 0 && i > 0)  /* no message size for the barrier */
+                    continue;
+                MPI_Barrier(MPI_COMM_WORLD);
+                double start = MPI_Wtime();
+                collective(op, sendbuf, recvbuf, sizes[i]);
+                double duration = MPI_Wtime() - start, max_duration;
+                MPI_Reduce(&duration, &max_duration, 1, MPI_DOUBLE, MPI_MAX, 0, MPI_COMM_WORLD);
+                if(rank == 0)
+                    fprintf(files[op], "MPI_%s,%d,%f,%e\n", names[op], op == 0 ? 0 : sizes[i], start - origin,
+                            max_duration);
+            }
+            if(nb_ranks % 2)
+                continue;
+            for(int k = 1; k <= nb_pairs; k = (k < nb_pairs && 2*k > nb_pairs) ? nb_pairs : 2*k) {
+                MPI_Barrier(MPI_COMM_WORLD);
+                double start = MPI_Wtime(), duration = -1;
+                if(pair < k) {
+                    if(rank < nb_pairs) {
+                        MPI_Send(sendbuf, sizes[i], MPI_CHAR, partner, 0, MPI_COMM_WORLD);
+                        MPI_Recv(recvbuf, sizes[i], MPI_CHAR, partner, 0, MPI_COMM_WORLD, MPI_STATUS_IGNORE);
+                    } else {
+                        MPI_Recv(recvbuf, sizes[i], MPI_CHAR, partner, 0, MPI_COMM_WORLD, MPI_STATUS_IGNORE);
+                        MPI_Send(sendbuf, sizes[i], MPI_CHAR, partner, 0, MPI_COMM_WORLD);
+                    }
+                    duration = MPI_Wtime() - start;
+                }
+                MPI_Gather(&duration, 1, MPI_DOUBLE, durations, 1, MPI_DOUBLE, 0, MPI_COMM_WORLD);
+                if(rank == 0)
+                    for(int p = 0; p < k; p++)
+                        fprintf(contention, "PingPong_%dpairs,%d,%f,%e\n", k, sizes[i], start - origin, durations[p]);
+                if(k == nb_pairs)
+                    break;
+            }
+        }
+    }
+    if(rank == 0) {
+        for(int op = 0; op < NB_COLLECTIVES; op++)
+            fclose(files[op]);
+        if(contention)
+            fclose(contention);
+    }
+    MPI_Finalize();
+    return 0;
+}
+'''
+
+
+def install(job):
+    job.nodes.write_files(BENCHMARK_SOURCE, CALIBRATION_DIR + '/collectives.c')
+    job.nodes.run('mpicc -O2 -std=c99 collectives.c -o collectives', directory=CALIBRATION_DIR)
+
+
+def run_collectives(job, dirname='exp', size_file='zoo_sizes', min_size=0, max_size=1000000, iterations=5,
+                    ranks_per_node=1):
+    '''
+    Collective operations and concurrent ping-pongs on all the nodes, ranks_per_node ranks per node. The results go in
+    dirname/exp_<operation>.csv and dirname/exp_Contention.csv, with the format of the point-to-point calibration.
+    '''
+    install(job)
+    job.nodes.run('mkdir -p %s' % (CALIBRATION_DIR + '/' + dirname))
+    placement = job.nodes.placement(ranks_per='node', cores_per_rank=1, ranks_per_domain=ranks_per_node)
+    nb_ranks = placement.nb_ranks(len(job.hostnames))
+    hosts = ','.join('%s:%d' % (host, ranks_per_node) for host in job.hostnames)
+    logger.info('Collective calibration with %d ranks on %d nodes' % (nb_ranks, len(job.hostnames)))
+    job.director.run('mpirun --allow-run-as-root %s -np %d -host %s ./collectives %s %s %d %d %d' % (
+                     placement.mpirun_options(), nb_ranks, hosts, dirname, size_file, min_size, max_size, iterations),
+                     directory=CALIBRATION_DIR)
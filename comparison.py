@@ -0,0 +1,159 @@
+import math
+import numpy
+import pandas
+import extract_archive
+
+
+def _as_dataframe(data, columns):
+    '''DataFrame of measures, from a DataFrame or from the result of extract_folder or extract_zip.'''
+    if isinstance(data, pandas.DataFrame):
+        return data
+    frames = []
+    for value in data.values():
+        frames.extend(value.values() if isinstance(value, dict) else [value])
+    frames = [frame for frame in frames if set(columns) <= set(frame.columns)]
+    if not frames:
+        return pandas.DataFrame(columns=columns)
+    return pandas.concat(frames, ignore_index=True)
+
+
+def _normal_quantile(p):
+    '''Quantile of the standard normal distribution, by bisection.'''
+    low, high = -40.0, 40.0
+    for _ in range(100):
+        middle = (low + high) / 2
+        if 0.5 * math.erfc(-middle / math.sqrt(2)) < p:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def _kolmogorov_pvalue(statistic, n1, n2):
+    '''Asymptotic p-value of the two-sample Kolmogorov-Smirnov test (with the correction of Stephens).'''
+    en = numpy.sqrt(n1 * n2 / (n1 + n2))
+    lam = (en + 0.12 + 0.11 / en) * statistic
+    k = numpy.arange(1, 101).reshape(-1, 1)
+    terms = 2 * (-1.0)**(k - 1) * numpy.exp(-2 * k**2 * lam**2)
+    pvalue = numpy.clip(terms.sum(axis=0), 0, 1)
+    return numpy.where(lam < 0.2, 1.0, pvalue)  # the series does not converge well there, the p-value is 1 anyway
+
+
+def adjust_pvalues(pvalues):
+    '''Benjamini-Hochberg adjustment of the p-values, to control the false discovery rate (the NaN are ignored).'''
+    pvalues = numpy.asarray(pvalues, dtype=float)
+    result = numpy.full(len(pvalues), numpy.nan)
+    mask = ~numpy.isnan(pvalues)
+    values = pvalues[mask]
+    order = numpy.argsort(values)
+    adjusted = values[order] * len(values) / numpy.arange(1, len(values) + 1)
+    adjusted = numpy.minimum.accumulate(adjusted[::-1])[::-1]
+    unsorted = numpy.empty(len(values))
+    unsorted[order] = numpy.minimum(adjusted, 1)
+    result[mask] = unsorted
+    return result
+
+
+def _medians(values, subgroups, nb_subgroups, z):
+    '''Median of each subgroup and its standard error (McKean-Schrader), the values are sorted by subgroup and value.'''
+    sizes = numpy.bincount(subgroups, minlength=nb_subgroups)
+    starts = numpy.concatenate([[0], numpy.cumsum(sizes)[:-1]])
+    values = numpy.append(values, numpy.nan)  # for the empty subgroups
+
+    def order_statistic(rank):  # rank starts at 0
+        return values[numpy.where(sizes > 0, starts + rank, len(values) - 1)]
+    median = (order_statistic((sizes - 1) // 2) + order_statistic(sizes // 2)) / 2
+    c = numpy.clip(numpy.round((sizes + 1) / 2 - z * numpy.sqrt(sizes / 4)), 1, numpy.maximum(sizes, 1)).astype(int)
+    error = (order_statistic(sizes - c) - order_statistic(c - 1)) / (2 * z)
+    return median, error
+
+
+def compare(first, second, by=('op', 'msg_size'), value='duration', confidence=0.95):
+    '''
+    Compare the measures of two groups of archives (DataFrames, or results of extract_folder) for each operation and
+    message size, all at once. For each of them: number of measures and median of each group, difference of the
+    medians (second - first) with its confidence interval, Kolmogorov-Smirnov and Mann-Whitney tests (p-values, also
+    adjusted for the number of comparisons with Benjamini-Hochberg) and Cliff's delta, P(second > first) -
+    P(second < first).
+    '''
+    by = list(by)
+    first = _as_dataframe(first, by + [value])
+    second = _as_dataframe(second, by + [value])
+    keys = pandas.concat([first[by], second[by]], ignore_index=True)
+    values = numpy.concatenate([first[value].to_numpy(float), second[value].to_numpy(float)])
+    in_second = numpy.concatenate([numpy.zeros(len(first), dtype=int), numpy.ones(len(second), dtype=int)])
+    codes, groups = pandas.factorize(pandas.MultiIndex.from_frame(keys), sort=True)
+    groups = pandas.MultiIndex.from_tuples(list(groups), names=by)
+    nb_groups = len(groups)
+    order = numpy.lexsort((values, codes))
+    codes, values, in_second = codes[order], values[order], in_second[order]
+    n = numpy.bincount(codes, minlength=nb_groups).astype(float)
+    n2 = numpy.bincount(codes, weights=in_second, minlength=nb_groups)
+    n1 = n - n2
+    starts = numpy.concatenate([[0], numpy.cumsum(n)[:-1]]).astype(int)
+    position = numpy.arange(len(values)) - starts[codes]
+    # Runs of equal values in a group, for the ties
+    new_run = numpy.ones(len(values), dtype=bool)
+    new_run[1:] = (values[1:] != values[:-1]) | (codes[1:] != codes[:-1])
+    end_of_run = numpy.append(new_run[1:], True)
+    runs = numpy.cumsum(new_run) - 1
+    run_lengths = numpy.bincount(runs).astype(float)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        # Kolmogorov-Smirnov, the difference of the empirical distribution functions is taken at the end of the runs
+        cum2 = numpy.cumsum(in_second) - numpy.concatenate([[0], numpy.cumsum(n2)[:-1]])[codes]
+        cum1 = position + 1 - cum2
+        difference = numpy.abs(cum1 / n1[codes] - cum2 / n2[codes])
+        ks_statistic = numpy.zeros(nb_groups)
+        numpy.maximum.at(ks_statistic, codes[end_of_run], difference[end_of_run])
+        ks_pvalue = _kolmogorov_pvalue(ks_statistic, n1, n2)
+        # Mann-Whitney, with the average rank for the ties and the normal approximation
+        ranks = position[new_run][runs] + (run_lengths[runs] + 1) / 2
+        u2 = numpy.bincount(codes, weights=ranks * in_second, minlength=nb_groups) - n2 * (n2 + 1) / 2
+        u1 = n1 * n2 - u2
+        ties = numpy.bincount(codes[new_run], weights=run_lengths**3 - run_lengths, minlength=nb_groups)
+        sigma = numpy.sqrt(n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1))))
+        deviation = numpy.maximum(numpy.abs(u2 - n1 * n2 / 2) - 0.5, 0) / sigma
+        mw_pvalue = numpy.where(sigma > 0, numpy.vectorize(math.erfc)(deviation / math.sqrt(2)), 1.0)
+        cliffs_delta = (u2 - u1) / (n1 * n2)
+    # Medians, the values are sorted again by group and by sample
+    order = numpy.lexsort((values, in_second, codes))
+    z = _normal_quantile(1 - (1 - confidence) / 2)
+    median, error = _medians(values[order], (codes * 2 + in_second)[order], 2 * nb_groups, z)
+    median1, median2 = median[0::2], median[1::2]
+    margin = z * numpy.sqrt(error[0::2]**2 + error[1::2]**2)
+    result = groups.to_frame(index=False)
+    result['n1'] = n1.astype(int)
+    result['n2'] = n2.astype(int)
+    result['median1'] = median1
+    result['median2'] = median2
+    result['median_diff'] = median2 - median1
+    result['median_diff_low'] = result.median_diff - margin
+    result['median_diff_high'] = result.median_diff + margin
+    result['relative_median_diff'] = result.median_diff / median1
+    result['ks_statistic'] = ks_statistic
+    result['ks_pvalue'] = ks_pvalue
+    result['mw_pvalue'] = mw_pvalue
+    result['cliffs_delta'] = cliffs_delta
+    valid = (n1 > 0) & (n2 > 0)
+    for column in ['ks_statistic', 'ks_pvalue', 'mw_pvalue', 'cliffs_delta']:
+        result.loc[~valid, column] = numpy.nan
+    result['ks_adjusted_pvalue'] = adjust_pvalues(result.ks_pvalue)
+    result['mw_adjusted_pvalue'] = adjust_pvalues(result.mw_pvalue)
+    return result
+
+
+def summarize(result, alpha=0.05, by='op'):
+    '''
+    For each operation: number of message sizes compared, fraction of them for which both tests find a difference
+    (adjusted p-values below alpha), median of the relative differences of the medians and of Cliff's delta.
+    '''
+    result = result.assign(different=(result.ks_adjusted_pvalue < alpha) & (result.mw_adjusted_pvalue < alpha))
+    return result.groupby(by).agg(nb_sizes=('different', 'size'), fraction_different=('different', 'mean'),
+                                  relative_median_diff=('relative_median_diff', 'median'),
+                                  cliffs_delta=('cliffs_delta', 'median')).reset_index()
+
+
+def compare_folders(first_folder, second_folder, **kwargs):
+    '''Compare all the archives of a folder to all the archives of another one (e.g. without and with deployment).'''
+    return compare(extract_archive.extract_folder(first_folder), extract_archive.extract_folder(second_folder),
+                   **kwargs)
@@ -1,5 +1,71 @@
+import os
+import numpy
+import pandas
+import piecewise
 from fabfile import Job, Time, logger
 
+KERNEL_DIR = '/tmp/dgemm_sweep'
+DESIGN_FILE = 'design.txt'
+# Term of the model of each operation, its coefficient is the one used by the SMPI build of HPL
+MODEL_TERMS = {
+    'dgemm': lambda df: df.m * df.n * df.k,
+    'dtrsm': lambda df: df.m * df.m * df.n,
+}
+
+DGEMM_KERNEL = r'''
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <cblas.h>
+
+static double get_time(void) {
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec + t.tv_nsec*1e-9;
+}
+
+static double *random_matrix(long size) {
+    double *matrix = malloc(size*size*sizeof(double));
+    if(!matrix) {
+        perror("malloc");
+        exit(1);
+    }
+    for(long i = 0; i < size*size; i++)
+        matrix[i] = (double)rand()/RAND_MAX;
+    return matrix;
+}
+
+/* Reads "m n k" lines on the standard input, prints "m,n,k,duration" for each of them as soon as it is measured.
+ * The dtrsm calls solve A*X = B with A an m*m lower triangular matrix and B an m*n matrix (k is not used). */
+int main(int argc, char *argv[]) {
+    if(argc != 3 || (strcmp(argv[1], "dgemm") && strcmp(argv[1], "dtrsm"))) {
+        fprintf(stderr, "Syntax: %s dgemm|dtrsm <max_size>\n", argv[0]);
+        return 1;
+    }
+    int dtrsm = !strcmp(argv[1], "dtrsm");
+    long max_size = atol(argv[2]);
+    double *a = random_matrix(max_size), *b = random_matrix(max_size), *c = random_matrix(max_size);
+    if(dtrsm)  /* unit triangular matrix with small entries, well conditioned whatever the leading dimension */
+        for(long i = 0; i < max_size*max_size; i++)
+            a[i] /= max_size;
+    int m, n, k;
+    while(scanf("%d %d %d", &m, &n, &k) == 3) {
+        double start = get_time();
+        if(dtrsm)
+            cblas_dtrsm(CblasColMajor, CblasLeft, CblasLower, CblasNoTrans, CblasUnit, m, n, 1., a, m, b, m);
+        else
+            cblas_dgemm(CblasColMajor, CblasNoTrans, CblasNoTrans, m, n, k, 1., a, m, b, k, 1., c, m);
+        double duration = get_time() - start;
+        if(dtrsm)  /* the solution overwrites b, restore it so that the values do not drift from one call to another */
+            memcpy(b, c, (long)m*n*sizeof(double));
+        printf("%d,%d,%d,%.9e\n", m, n, k, duration);
+        fflush(stdout);
+    }
+    return 0;
+}
+'''
+
 
 def install(job):
     job.apt_install(
@@ -16,14 +82,110 @@ def install(job):
     job.nodes.run('unzip openblas.zip && mv OpenBLAS-* openblas')
     job.nodes.run('make -j 64', directory='openblas')
     job.nodes.run('make install PREFIX=/tmp', directory='openblas')
-    job.nodes.run('wget https://github.com/Ezibenroc/m2_internship_scripts/archive/master.zip -O scripts.zip')
-    job.nodes.run('unzip scripts.zip && mv m2_internship* scripts')
+    install_kernel(job)
+
+
+def install_kernel(job):
+    job.nodes.run('mkdir -p %s' % KERNEL_DIR)
+    job.nodes.write_files(DGEMM_KERNEL, os.path.join(KERNEL_DIR, 'dgemm_sweep.c'))
+    job.nodes.run('gcc -O3 dgemm_sweep.c -I /tmp/include /tmp/lib/libopenblas.so -o dgemm_sweep',
+                  directory=KERNEL_DIR)
+
+
+def sweep_design(nb_points, min_size=1, max_size=10000, nb_repeats=1, seed=42):
+    '''
+    Space-filling design over (m, n, k): a latin hypercube in log-space, each of the three dimensions being divided in
+    nb_points strata that are all sampled once. The points are repeated nb_repeats times and shuffled, so that a
+    temporary perturbation of the node does not bias a region of the design.
+    '''
+    random = numpy.random.RandomState(seed)
+    low, high = numpy.log(min_size), numpy.log(max_size)
+    columns = []
+    for _ in range(3):
+        strata = (random.permutation(nb_points) + random.uniform(size=nb_points)) / nb_points
+        columns.append(numpy.exp(low + strata*(high-low)).round().astype(int).clip(min_size, max_size))
+    design = numpy.array(columns).T
+    design = numpy.tile(design, (nb_repeats, 1))
+    return design[random.permutation(len(design))]
+
+
+def _parse_output(host, stdout):
+    rows = []
+    for line in stdout.split():
+        m, n, k, duration = line.split(',')
+        rows.append((host, int(m), int(n), int(k), float(duration)))
+    return rows
+
+
+def run_sweep(job, design, nb_chunks=10, nb_threads=1, csv_file=None, operation='dgemm'):
+    '''
+    Run the dgemm (or dtrsm) calls of the design on all the nodes of the job concurrently. The design is split in
+    nb_chunks chunks, the results of each chunk are fetched (and appended to csv_file, if given) as soon as it is done
+    on all the nodes, so that an interrupted sweep still gives usable data.
+    '''
+    max_size = int(design.max())
+    content = '\n'.join('%d %d %d' % tuple(point) for point in design) + '\n'
+    job.nodes.write_files(content, os.path.join(KERNEL_DIR, DESIGN_FILE))
+    bounds = numpy.linspace(0, len(design), nb_chunks+1).astype(int)
+    columns = ['hostname', 'm', 'n', 'k', 'duration']
+    results = []
+    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if start == stop:
+            continue
+        cmd = "sed -n '%d,%dp' %s | OMP_NUM_THREADS=%d LD_LIBRARY_PATH=/tmp/lib ./dgemm_sweep %s %d" % (
+            start+1, stop, DESIGN_FILE, nb_threads, operation, max_size)
+        output = job.nodes.run(cmd, hide_output=False, directory=KERNEL_DIR)
+        rows = []
+        for node, res in output.items():
+            rows.extend(_parse_output(node.host, res.stdout))
+        df = pandas.DataFrame(rows, columns=columns)
+        df['operation'] = operation
+        if csv_file:
+            df.to_csv(csv_file, mode='a', header=not os.path.exists(csv_file), index=False)
+        results.append(df)
+        logger.info('%s sweep: chunk %d/%d done (%d measures)' % (operation, i+1, nb_chunks, len(df)))
+    return pandas.concat(results, ignore_index=True)
+
+
+def fit_node(df, max_breakpoints=3, operation='dgemm'):
+    '''
+    Models of the dgemm (or dtrsm) duration of a node: a linear regression on m*n*k, or m*m*n for dtrsm (its slope is
+    the SMPI_DGEMM_COEFFICIENT, or SMPI_DTRSM_COEFFICIENT, of the SMPI build of HPL) and a piecewise linear regression
+    on the same term.
+    '''
+    term = MODEL_TERMS[operation](df).values.astype(float)
+    duration = df.duration.values
+    slope, intercept = numpy.polyfit(term, duration, 1)
+    residuals = duration - (intercept + slope*term)
+    r2 = 1 - (residuals**2).sum() / ((duration - duration.mean())**2).sum()
+    breakpoints = piecewise.find_breakpoints(term, duration, max_breakpoints=max_breakpoints)
+    return {
+        'coefficient': slope,
+        'intercept': intercept,
+        'r2': r2,
+        'nb_measures': len(df),
+        'breakpoints': breakpoints,
+        'segments': [seg._asdict() for seg in piecewise.fit_piecewise(term, duration, breakpoints)],
+    }
 
 
-def run_test(job):
-    nb_nodes = 64
-    job.nodes.run('LD_LIBRARY_PATH=/tmp/lib python3 runner.py --csv_file /tmp/result.csv --lib openblas --dgemm ' +
-                  '--size_range 1,10000 -np %d' % nb_nodes, directory='/tmp/scripts/cblas_tests')
+def fit_nodes(df, max_breakpoints=3, threshold=0.05, operation='dgemm'):
+    '''
+    Per-node models, as a DataFrame indexed by hostname. A warning is issued for the nodes whose coefficient is more
+    than threshold away from the median coefficient of the nodes, which is the coefficient to use for the cluster.
+    '''
+    fits = {host: fit_node(node_df, max_breakpoints, operation) for host, node_df in df.groupby('hostname')}
+    fits = pandas.DataFrame(fits).T
+    fits['coefficient'] = fits.coefficient.astype(float)
+    reference = fits.coefficient.median()
+    for host, fit in fits.iterrows():
+        logger.info('[%s] %s coefficient: %e (R²=%.4f, %d breakpoint(s))' % (host, operation, fit.coefficient,
+                                                                            fit.r2, len(fit.breakpoints)))
+        if abs(fit.coefficient - reference) > threshold*reference:
+            logger.warning('Node %s has a %s coefficient of %e, median of the nodes is %e' % (
+                host, operation, fit.coefficient, reference))
+    logger.info('Cluster %s coefficient: %e' % (operation, reference))
+    return fits
 
 
 if __name__ == '__main__':
@@ -31,12 +193,12 @@ if __name__ == '__main__':
                              username='tocornebize',
                              clusters=['dahu'],
                              walltime=Time(hours=2),
-                             nb_nodes=1,
+                             nb_nodes=4,
                              deploy=False,
                              queue='testing')
     logger.info(str(job))
-    logger.info('Node: %s' % job.hostnames[0])
+    logger.info('Nodes: %s' % ', '.join(job.hostnames))
     install(job)
-    run_test(job)
-    job.nodes.get('/tmp/result_dgemm.csv', 'result.csv')
+    df = run_sweep(job, sweep_design(nb_points=500, max_size=10000, nb_repeats=2), csv_file='result.csv')
+    fit_nodes(df)
     job.oardel()
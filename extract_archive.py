@@ -3,47 +3,169 @@ import zipfile
 import yaml
 import io
 import os
+import telemetry
+import result_archive
+from calibration_summary import SUMMARY_SUFFIX, BINS_PER_DECADE
 
+MEASURE_COLUMNS = ['op', 'msg_size', 'start', 'duration']
 
-def extract_zip(zip_name):
-    '''Taken from https://stackoverflow.com/a/10909016/4110059'''
-    input_zip = zipfile.ZipFile(zip_name)
-    result = {}
-    deployment = yaml.load(input_zip.read('info.yaml'))['deployment']
+
+def open_archive(archive_name):
+    '''A zip archive or, for the files with the extension result_archive.EXTENSION, a result_archive.Archive.'''
+    if archive_name.endswith(result_archive.EXTENSION):
+        return result_archive.Archive(archive_name)
+    return zipfile.ZipFile(archive_name)
+
+
+def _read_table(archive, name, **kwargs):
+    if isinstance(archive, result_archive.Archive) and archive.is_table(name):
+        return archive.dataframe(name)
+    return pandas.read_csv(io.BytesIO(archive.read(name)), **kwargs)
+
+
+def _archive_metadata(zip_name, input_zip):
+    if 'info.yaml' in input_zip.namelist():  # old archives have no info.yaml, or no deployment field
+        deployment = yaml.safe_load(input_zip.read('info.yaml')).get('deployment')
+    else:
+        deployment = None
     experiment = zip_name
     if '/' in experiment:
         experiment = experiment[experiment.index('/')+1:]
     experiment = experiment[:experiment.index('_')]
-    for name in input_zip.namelist():
-        if name.endswith('.csv'):
-            dataframe = pandas.read_csv(io.BytesIO(input_zip.read(name)), names = ['op', 'msg_size', 'start', 'duration'])
-            dataframe['experiment'] = experiment
-            dataframe['type'] = name
-            dataframe['deployment'] = deployment
-            dataframe['index'] = range(len(dataframe))
-            result[name] = dataframe
+    return experiment, deployment
+
+
+def extract_zip(zip_name, with_telemetry=False):
+    '''
+    Taken from https://stackoverflow.com/a/10909016/4110059
+    The archive is either a zip archive or an archive of result_archive (see convert_zip).
+    The summaries of the measures (see calibration_summary) are ignored, they are read by extract_summary.
+    With with_telemetry=True, the samples of the nodes (if any) are in the entry 'telemetry', see extract_telemetry.
+    '''
+    result = {}
+    with open_archive(zip_name) as input_zip:
+        experiment, deployment = _archive_metadata(zip_name, input_zip)
+        for name in input_zip.namelist():
+            if name.endswith('.csv') and not name.endswith(SUMMARY_SUFFIX):
+                dataframe = _read_table(input_zip, name, names=MEASURE_COLUMNS)
+                dataframe['experiment'] = experiment
+                dataframe['type'] = name
+                dataframe['deployment'] = deployment
+                dataframe['index'] = range(len(dataframe))
+                result[name] = dataframe
+    if with_telemetry:
+        df = extract_telemetry(zip_name)
+        if df is not None:
+            result['telemetry'] = df
     return result
 
 
+def extract_summary(zip_name):
+    '''
+    Summaries of the measures made on the nodes (see calibration_summary), one DataFrame per calibration file, with
+    one line per operation and message size. The keys are the names of the raw files (e.g. exp/exp_Recv.csv), whose
+    measures are only kept for a sample of the message sizes.
+    '''
+    result = {}
+    with open_archive(zip_name) as input_zip:
+        experiment, deployment = _archive_metadata(zip_name, input_zip)
+        for name in input_zip.namelist():
+            if name.endswith(SUMMARY_SUFFIX):
+                dataframe = _read_table(input_zip, name, keep_default_na=False)
+                raw_name = name[:-len(SUMMARY_SUFFIX)] + '.csv'
+                dataframe['experiment'] = experiment
+                dataframe['type'] = raw_name
+                dataframe['deployment'] = deployment
+                result[raw_name] = dataframe
+    return result
+
+
+def parse_histogram(histogram):
+    '''Histogram of a summary line, as a dictionary {lower bound of the bin: number of durations in the bin}.'''
+    result = {}
+    for pair in histogram.split():
+        b, count = pair.split(':')
+        result[10**(int(b) / BINS_PER_DECADE)] = int(count)
+    return result
+
+
+def extract_telemetry(zip_name):
+    '''Samples of all the nodes stored in the archive, in a single DataFrame (None if the archive has no sample).'''
+    result = []
+    with open_archive(zip_name) as input_zip:
+        for name in sorted(input_zip.namelist()):
+            if name.startswith('telemetry/') and name.endswith('.bin'):
+                dataframe = telemetry.decode(input_zip.read(name))
+                dataframe['hostname'] = os.path.basename(name)[:-len('.bin')]
+                result.append(dataframe)
+    if not result:
+        return None
+    return pandas.concat(result, ignore_index=True)
+
+
 def extract_folder(folder_name):
+    '''
+    Extract all the archives of the folder. The zip archives that have been converted (see convert_folder) are
+    skipped, their converted version is extracted instead.
+    '''
     result = {}
     for root, dirs, files in os.walk(folder_name):
         for file in files:
-            if file.endswith('.zip'):
+            base, extension = os.path.splitext(file)
+            if extension == '.zip' and base + result_archive.EXTENSION in files:
+                continue
+            if extension in ('.zip', result_archive.EXTENSION):
                 filename = os.path.join(root, file)
                 result[filename] = extract_zip(filename)
     return result
 
 
+def convert_zip(zip_name, archive_name=None, codec=None):
+    '''
+    Convert a zip archive into an archive of result_archive (by default, with the same name and the extension
+    result_archive.EXTENSION). The measures and the summaries are stored as tables, the other files as they are.
+    '''
+    archive_name = archive_name or os.path.splitext(zip_name)[0] + result_archive.EXTENSION
+    with zipfile.ZipFile(zip_name) as input_zip, result_archive.ArchiveWriter(archive_name, codec=codec) as writer:
+        for name in input_zip.namelist():
+            if name.endswith('/'):
+                continue
+            data = input_zip.read(name)
+            try:
+                if name.endswith(SUMMARY_SUFFIX):
+                    writer.add_dataframe(name, pandas.read_csv(io.BytesIO(data), keep_default_na=False))
+                    continue
+                if name.endswith('.csv'):
+                    writer.add_dataframe(name, pandas.read_csv(io.BytesIO(data), names=MEASURE_COLUMNS))
+                    continue
+            except (pandas.errors.ParserError, pandas.errors.EmptyDataError):
+                pass  # kept as it is, extract_zip will fail on it as it does on the zip
+            writer.add_bytes(name, data)
+    return archive_name
+
+
+def convert_folder(folder_name, codec=None, remove=False):
+    '''Convert all the zip archives of the folder, the zip archives are removed if remove is True.'''
+    result = []
+    for root, dirs, files in os.walk(folder_name):
+        for file in files:
+            if file.endswith('.zip'):
+                filename = os.path.join(root, file)
+                result.append(convert_zip(filename, codec=codec))
+                if remove:
+                    os.remove(filename)
+    return result
+
+
 def aggregate_dataframe(dataframe):
-    df = dataframe.groupby('msg_size').mean().reset_index()
+    df = dataframe.groupby('msg_size').mean(numeric_only=True).reset_index()
     df['experiment'] = dataframe['experiment'].unique()[0]
     return df
 
 
 def lower_quantile(df):
     df = pandas.DataFrame(df)
-    quantiles = df.groupby('msg_size').quantile(0.5).reset_index()
+    quantiles = df.groupby('msg_size')['duration'].quantile(0.5).reset_index()
     df['above_quantile'] = True
     for size in quantiles.msg_size:
         duration_thresh = quantiles[quantiles.msg_size == size].duration.unique()[0]
@@ -53,12 +175,12 @@ def lower_quantile(df):
 
 def clean_dataset(dataframe):
     def aggregate_dataframe(dataframe):
-        df = dataframe.groupby('msg_size').mean().reset_index()
+        df = dataframe.groupby('msg_size').mean(numeric_only=True).reset_index()
         return df
 
     def lower_quantile(df):
         df = pandas.DataFrame(df)
-        quantiles = df.groupby('msg_size').quantile(0.5).reset_index()
+        quantiles = df.groupby('msg_size')['duration'].quantile(0.5).reset_index()
         df['above_quantile'] = True
         for size in quantiles.msg_size:
             duration_thresh = quantiles[quantiles.msg_size == size].duration.unique()[0]
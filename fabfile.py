@@ -16,8 +16,17 @@ import zipfile
 import yaml
 import random
 import json
+import math
+import hashlib
 import io
 import lxml.etree
+import contextlib
+import traceback
+import concurrent.futures
+import threading
+import telemetry
+import information_store
+from topology import Topology, TopologyCache
 
 handler = colorlog.StreamHandler()
 formatter = colorlog.ColoredFormatter(
@@ -41,6 +50,20 @@ io_handler.setFormatter(logging.Formatter('[%(asctime)s][%(levelname)s] %(messag
 logger.addHandler(handler)
 logger.addHandler(io_handler)
 logger.setLevel(logging.DEBUG)
+# The job whose steps run in the current thread (see JobGroup.map), its records are also written in its own log.
+current_job = threading.local()
+
+
+class JobLogHandler(logging.Handler):
+    def emit(self, record):
+        stream = getattr(getattr(current_job, 'job', None), 'log_stream', None)
+        if stream is not None:
+            stream.write(self.format(record) + '\n')
+
+
+job_handler = JobLogHandler()
+job_handler.setFormatter(io_handler.formatter)
+logger.addHandler(job_handler)
 
 
 class Time:
@@ -50,20 +73,94 @@ class Time:
         self.minutes = minutes or 0
         self.seconds = seconds or 0
 
+    @classmethod
+    def from_seconds(cls, seconds):
+        minutes, seconds = divmod(int(math.ceil(seconds)), 60)
+        hours, minutes = divmod(minutes, 60)
+        return cls(hours, minutes, seconds)
+
     def __repr__(self):
         return '%.2d:%.2d:%.2d' % (self.hours, self.minutes, self.seconds)
 
 
+def get_cluster(hostname):
+    short_name = hostname.split('.')[0]
+    match = re.match(r'([a-zA-Z0-9]+?)-\d+$', short_name)
+    if match:
+        return match.groups()[0]
+    return short_name
+
+
+# Default value of the arguments that can be None
+DEFAULT = object()
+
+
+class Abort:
+    '''Straggler policy: raise the GroupException (default).'''
+    def __call__(self, nodes, exception, rerun):
+        raise exception
+
+    def __repr__(self):
+        return 'Abort()'
+
+
+class Retry:
+    '''Straggler policy: run the command again on the failed hosts, up to attempts times, then apply then.'''
+    def __init__(self, attempts=1, then=None):
+        self.attempts = attempts
+        self.then = then or Abort()
+
+    def __call__(self, nodes, exception, rerun):
+        result = fabric.GroupResult(exception.result)
+        for attempt in range(self.attempts):
+            failed = list(result.failed)
+            logger.warning('[%s] retrying on %s (attempt %d/%d)' % (nodes.name, ', '.join(cxn.host for cxn in failed),
+                                                                   attempt+1, self.attempts))
+            try:
+                new_result = rerun(failed)
+            except fabric.exceptions.GroupException as e:
+                new_result = e.result
+            merged = dict(result.succeeded)
+            merged.update(new_result)
+            result = fabric.GroupResult(merged)
+            if not result.failed:
+                return result
+        return self.then(nodes, fabric.exceptions.GroupException(result), rerun)
+
+    def __repr__(self):
+        return 'Retry(%d, then=%r)' % (self.attempts, self.then)
+
+
+class Drop:
+    '''Straggler policy: remove the failed hosts from the nodes and return the results of the others.'''
+    def __call__(self, nodes, exception, rerun):
+        failed = exception.result.failed
+        for cxn, error in failed.items():
+            logger.warning('[%s] dropping %s: %s' % (nodes.name, cxn.host, repr(error).split('\n')[0]))
+        nodes.drop([cxn.host for cxn in failed])
+        return fabric.GroupResult(exception.result.succeeded)
+
+    def __repr__(self):
+        return 'Drop()'
+
+
 class Nodes:
-    def __init__(self, nodes, name, working_dir):
+    topology_cache = TopologyCache()
+
+    def __init__(self, nodes, name, working_dir, timeout=None, policy=None):
+        '''The timeout (in seconds, per host) and the straggler policy are the defaults of run.'''
         self.nodes = fabric.ThreadingGroup.from_connections(nodes)
         self.name = name
         self.working_dir = working_dir
+        self.timeout = timeout
+        self.policy = policy or Abort()
+        self.drop_callbacks = []
 
     def __iter__(self):
         yield from self.nodes
 
-    def run(self, command, **kwargs):
+    def run(self, command, timeout=DEFAULT, policy=None, **kwargs):
+        '''A timeout of None (or 0) runs the command without a timeout, whatever the default of the nodes.'''
         if 'directory' in kwargs:
             directory = os.path.join(self.working_dir, kwargs['directory'])
             del kwargs['directory']
@@ -79,7 +176,25 @@ class Nodes:
             del kwargs['hide_output']
         else:  # hide output by default
             command = '%s &> /dev/null' % command
-        return self.nodes.run(command, **kwargs)
+        if timeout is DEFAULT:
+            timeout = self.timeout
+        if timeout:
+            kwargs['timeout'] = timeout
+        try:
+            return self.nodes.run(command, **kwargs)
+        except fabric.exceptions.GroupException as e:
+            def rerun(connections):
+                return fabric.ThreadingGroup.from_connections(connections).run(command, **kwargs)
+            return (policy or self.policy)(self, e, rerun)
+
+    def drop(self, hostnames):
+        '''Remove the hosts and call the drop_callbacks with them.'''
+        remaining = [cxn for cxn in self.nodes if cxn.host not in hostnames]
+        if not remaining:
+            raise RuntimeError('[%s] no node left after dropping %s' % (self.name, ', '.join(hostnames)))
+        self.nodes = fabric.ThreadingGroup.from_connections(remaining)
+        for callback in self.drop_callbacks:
+            callback(hostnames)
 
     def run_unique(self, *args, **kwargs):
         result = list(self.run(*args, **kwargs).values())
@@ -125,12 +240,16 @@ class Nodes:
                 self.run(cmd)
 
     @property
-    def cores(self):
+    def topology(self):
         try:
-            return self.__cores
+            return self.__topology
         except AttributeError:
-            self.__cores = self._get_all_cores()
-            return self.__cores
+            self.__topology = self._get_topology()
+            return self.__topology
+
+    @property
+    def cores(self):
+        return self.topology.core_pus
 
     @property
     def hyperthreads(self):
@@ -141,6 +260,10 @@ class Nodes:
             self.__hyperthreads = sum(self.__hyperthreads, [])
             return self.__hyperthreads
 
+    def placement(self, ranks_per='node', cores_per_rank=None, ranks_per_domain=None):
+        return self.topology.placement(ranks_per=ranks_per, cores_per_rank=cores_per_rank,
+                                       ranks_per_domain=ranks_per_domain)
+
     def enable_hyperthreading(self):
         self.__set_hyperthreads(1)
 
@@ -152,21 +275,54 @@ class Nodes:
         filenames = ['/sys/devices/system/cpu/cpu%d/online' % core_id for core_id in self.hyperthreads]
         self.write_files(str(value), *filenames)
 
-    def _get_all_cores(self):
-        ref_cores = None
+    @property
+    def topology_key(self):
+        clusters = set(get_cluster(host) for host in self.hostnames)
+        if len(clusters) != 1:
+            return None
+        return clusters.pop()
+
+    def __topology_cache_key(self):
+        '''Cluster and hash of the CPU description of the nodes, None if the nodes differ.'''
+        if self.topology_key is None:
+            return None
+        result = self.run('cat /sys/devices/system/cpu/possible && grep -m 1 "model name" /proc/cpuinfo',
+                          hide_output=False)
+        descriptions = set(res.stdout for res in result.values())
+        if len(descriptions) != 1:
+            return None
+        return '%s_%s' % (self.topology_key, hashlib.sha256(descriptions.pop().encode()).hexdigest()[:16])
+
+    def refresh_topology(self):
+        '''Run lstopo again, ignoring the cache (e.g. after a change of the BIOS settings).'''
+        self.__topology = self._get_topology(use_cache=False)
+        return self.__topology
+
+    def _get_topology(self, use_cache=True):
+        key = self.__topology_cache_key()
+        if key is not None and use_cache:
+            topology = self.topology_cache.get(key)
+            if topology is not None:
+                logger.debug('[%s] topology of %s found in the cache' % (self.name, key))
+                return topology
+        topology = self._get_all_topologies()
+        # Offline PUs do not appear in lstopo output, caching such a topology would lose the hyperthreads.
+        if key is not None and not self.run_unique('cat /sys/devices/system/cpu/offline',
+                                                   hide_output=False).stdout.strip():
+            self.topology_cache.put(key, topology)
+        return topology
+
+    def _get_all_topologies(self):
+        ref_topology = None
         all_xml = self.__get_platform_xml()
         for node, xml in all_xml.items():
-            cores = self.__get_all_cores(xml)
-            if ref_cores is None:
-                ref_cores = cores
+            topology = Topology.from_xml(xml)
+            if ref_topology is None:
+                ref_topology = topology
                 ref_node = node
-            elif cores != ref_cores:
+            elif topology != ref_topology:
                 raise ValueError('Got different topologies for nodes %s and %s' % (ref_node.host, node.host))
-        return ref_cores
-
-    def __get_all_cores(self, xml):
-        xml = xml.findall('object')[0]
-        return self.__process_cache(xml)
+        return ref_topology
 
     def __get_platform_xml(self):
         result = self.run('lstopo topology.xml && cat topology.xml', hide_output=False)
@@ -175,24 +331,6 @@ class Nodes:
             xml[node] = lxml.etree.fromstring(output.stdout.encode('utf8'))
         return xml
 
-    def __process_cache(self, xml):
-        cache = xml.findall('object')
-        result = []
-        for obj in cache:
-            if obj.get('type') == 'Core':
-                result.append(self.__process_core(obj))
-            elif obj.get('type') in ('Machine', 'NUMANode', 'Package', 'Cache', 'L3Cache',
-                                     'L2Cache', 'L1Cache', 'L1iCache'):
-                result.extend(self.__process_cache(obj))
-        return result
-
-    def __process_core(self, xml):
-        result = []
-        for pu in xml.findall('object'):
-            assert pu.get('type') == 'PU'
-            result.append(int(pu.get('os_index')))
-        return result
-
     @property
     def frequency_information(self):
         try:
@@ -247,6 +385,17 @@ class Nodes:
         self.set_frequency_information('performance', max_f, max_f)
 
 
+# Information on the platform collected on each node for the archives (file: command creating the file)
+RAW_INFORMATION_COMMANDS = collections.OrderedDict([
+    ('cpuinfo.txt', 'cp /proc/cpuinfo cpuinfo.txt'),
+    ('environment.txt', 'env > environment.txt'),
+    ('topology.xml', 'lstopo topology.xml'),
+    ('topology.pdf', 'lstopo topology.pdf'),
+    ('lspci.txt', 'lspci -v > lspci.txt'),
+    ('dmidecode.txt', 'dmidecode > dmidecode.txt'),
+])
+
+
 class Job:
     auto_oardel = False
 
@@ -254,6 +403,7 @@ class Job:
         self.jobid = jobid
         self.frontend = frontend
         self.deploy = deploy
+        self.log_stream = io.StringIO()
         self.user = frontend.nodes[0].user
         self.site = frontend.nodes[0].host
 
@@ -352,7 +502,10 @@ class Job:
 
     @classmethod
     def oarsub_cluster(cls, site, username, clusters, walltime, nb_nodes, *,
-                       deploy=True, queue=None, immediate=True, script=None):
+                       deploy=True, queue=None, immediate=True, script=None, predictor=None, calibration=False):
+        '''For a calibration job, a walltime None is predicted from the past calibrations (see walltime_predictor).'''
+        if walltime is None:
+            walltime = cls._predict_walltime(clusters, deploy, predictor, calibration)
         connection = cls.g5k_connection(site, username)
         frontend = Nodes([connection], name='frontend', working_dir='/home/%s' % username)
         clusters = ["'%s'" % clus for clus in clusters]
@@ -362,11 +515,15 @@ class Job:
 
     @classmethod
     def oarsub_hostnames(cls, site, username, hostnames, walltime, nb_nodes=None, *,
-                         deploy=True, queue=None, immediate=True, script=None):
+                         deploy=True, queue=None, immediate=True, script=None, predictor=None, calibration=False):
+        '''For a calibration job, a walltime None is predicted, see oarsub_cluster.'''
         def expandg5k(host, site):
             if 'grid5000' not in host:
                 host = '%s.%s.grid5000.fr' % (host, site)
             return host
+        if walltime is None:
+            clusters = sorted({get_cluster(host) for host in hostnames})
+            walltime = cls._predict_walltime(clusters, deploy, predictor, calibration)
         connection = cls.g5k_connection(site, username)
         frontend = Nodes([connection], name='frontend', working_dir='/home/%s' % username)
         hostnames = ["'%s'" % expandg5k(host, site) for host in hostnames]
@@ -376,6 +533,16 @@ class Job:
         return cls.oarsub(frontend, constraint, walltime, nb_nodes, deploy=deploy,
                           queue=queue, immediate=immediate, script=script)
 
+    @classmethod
+    def _predict_walltime(cls, clusters, deploy, predictor=None, calibration=False):
+        if not calibration:  # the history only holds the durations of the calibrations
+            raise ValueError('A walltime is required, only the walltime of a calibration job can be predicted')
+        import walltime_predictor
+        predictor = predictor or walltime_predictor.WalltimePredictor()
+        walltime = predictor.walltime(clusters, deploy)
+        logger.info('Predicted walltime for %s: %s' % (', '.join(clusters), walltime))
+        return walltime
+
     @classmethod
     def g5k_connection(cls, site, username):
         if 'grid5000' in socket.getfqdn():  # already inside G5K, no need for a gateway
@@ -408,11 +575,25 @@ class Job:
             connections = [fabric.Connection(host, user=user, gateway=self.frontend.nodes[0])
                            for host in self.hostnames]
             self.__nodes = Nodes(connections, name='allnodes', working_dir='/tmp')
-            self.orchestra = Nodes(connections[1:], name='orchestra', working_dir='/tmp')
-            self.director = Nodes([connections[0]], name='director', working_dir='/tmp')
+            self.__nodes.drop_callbacks.append(self.__nodes_dropped)
+            self.__split_nodes()
             self.__open_nodes_connection()
             return self.__nodes
 
+    def __split_nodes(self):
+        connections = list(self.__nodes)
+        for name, part in [('orchestra', connections[1:]), ('director', connections[:1])]:
+            previous = getattr(self, name, self.__nodes)  # a rebuilt part keeps its timeout and policy
+            nodes = Nodes(part, name=name, working_dir='/tmp', timeout=previous.timeout, policy=previous.policy)
+            nodes.drop_callbacks.append(self.__nodes.drop)  # the dropped hosts are removed from the job too
+            setattr(self, name, nodes)
+
+    def __nodes_dropped(self, hostnames):
+        '''Remove the dropped nodes from the job, the director and orchestra are rebuilt.'''
+        self.__hostnames = [host for host in self.hostnames if host not in hostnames]
+        self.__split_nodes()
+        logger.warning('%s: %d node(s) left (%s)' % (self, len(self.__hostnames), ', '.join(self.__hostnames)))
+
     def apt_install(self, *packages):
         sudo = 'sudo-g5k ' if not self.deploy else ''
         cmd = '{0}apt update && {0}DEBIAN_FRONTEND=noninteractive apt upgrade -yq'.format(sudo)
@@ -421,31 +602,67 @@ class Job:
         self.nodes.run(cmd)
         return self
 
-    def __add_raw_information(self, archive_name, filename, command):
+    def __some_nodes(self, hosts):
+        return Nodes([cxn for cxn in self.nodes if cxn.host in hosts], name='somenodes', working_dir='/tmp')
+
+    def __run_raw_information(self, command, hosts):
         if not self.deploy:
             command = 'sudo-g5k %s' % command
-        self.nodes.run(command, hide_output=False)
-        self.director.run('cp %s information/%s' % (filename, self.director.hostnames[0]))
-        for host in self.hostnames:
-            if host == self.director.hostnames[0]:
-                continue
-            self.director.run('scp %s:/tmp/%s information/%s' % (host, filename, host))
+        self.__some_nodes(hosts).run(command, hide_output=False)
+
+    def __hash_raw_information(self, filenames, hosts):
+        result = self.__some_nodes(hosts).run(information_store.hash_command(filenames), hide_output=False)
+        return {cxn.host: information_store.parse_hashes(res.stdout) for cxn, res in result.items()}
 
-    def add_raw_information(self, archive_name):
+    def __collect_raw_information(self, filename, hosts):
+        for host in hosts:
+            if host == self.director.hostnames[0]:
+                self.director.run('cp %s information/%s' % (filename, host))
+            else:
+                self.director.run('scp %s:/tmp/%s information/%s' % (host, filename, host))
+
+    def add_raw_information(self, archive_name, store=None):
+        '''
+        Add the information on the platform of each node to the archive, in information/<hostname>. With an
+        information_store.InformationStore, only the files missing from the store are added, and the hardware files are
+        not collected again on the nodes whose fingerprint is unchanged. Return the hashes (None without a store).
+        '''
         for host in self.hostnames:
             self.director.run('mkdir -p information/%s' % host)
-        commands_with_files = {
-                    'cpuinfo.txt': 'cp /proc/cpuinfo cpuinfo.txt',
-                    'environment.txt': 'env > environment.txt',
-                    'topology.xml': 'lstopo topology.xml',
-                    'topology.pdf': 'lstopo topology.pdf',
-                    'lspci.txt': 'lspci -v > lspci.txt',
-                    'dmidecode.txt': 'dmidecode > dmidecode.txt',
-                    }
-        for filename, command in commands_with_files.items():
-            self.__add_raw_information(archive_name, filename, command)
+        unchanged = []
+        if store:
+            result = self.nodes.run(information_store.FINGERPRINT_COMMAND, hide_output=False)
+            unchanged = [cxn.host for cxn, res in result.items() if store.unchanged(cxn.host, res.stdout.strip())]
+            if unchanged:
+                logger.info('Hardware unchanged since last seen: %s' % ', '.join(unchanged))
+        changed = [host for host in self.hostnames if host not in unchanged]
+        for filename, command in RAW_INFORMATION_COMMANDS.items():
+            hosts = changed if filename in information_store.HARDWARE_FILES else self.hostnames
+            if hosts:
+                self.__run_raw_information(command, hosts)
+        hashes = None
+        missing = {filename: self.hostnames for filename in RAW_INFORMATION_COMMANDS}
+        if store:
+            hashes = self.__hash_raw_information(RAW_INFORMATION_COMMANDS, changed) if changed else {}
+            if unchanged:
+                other_files = [filename for filename in RAW_INFORMATION_COMMANDS
+                               if filename not in information_store.HARDWARE_FILES]
+                for host, files in self.__hash_raw_information(other_files, unchanged).items():
+                    last_seen = store.last_seen(host)
+                    hashes[host] = dict(files, **{name: last_seen[name] for name in information_store.HARDWARE_FILES})
+            for host, files in hashes.items():
+                changed_files = store.changes(host, files)
+                if changed_files:
+                    logger.info('[%s] changed since the node was last seen: %s' % (host, ', '.join(changed_files)))
+            missing = {filename: [host for host in self.hostnames if not store.has(hashes[host][filename])]
+                       for filename in RAW_INFORMATION_COMMANDS}
+            logger.info('Collecting %d information files out of %d' % (
+                sum(len(hosts) for hosts in missing.values()), len(self.hostnames)*len(RAW_INFORMATION_COMMANDS)))
+        for filename, hosts in missing.items():
+            self.__collect_raw_information(filename, hosts)
         self.director.run('zip -ru %s information' % archive_name)
         self.director.run('rm -rf information')
+        return hashes
 
     def platform_information(self):
         commands = {'kernel': 'uname -r',
@@ -487,6 +704,85 @@ class Job:
         return result
 
 
+class JobGroup:
+    '''
+    Jobs on which the same steps are run concurrently. A job whose step failed is kept in failed and skipped afterwards.
+    '''
+    def __init__(self, jobs):
+        self.jobs = list(jobs)
+        self.failed = collections.OrderedDict()
+
+    def __iter__(self):
+        yield from self.alive
+
+    def __len__(self):
+        return len(self.alive)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(repr(job) for job in self.jobs))
+
+    @property
+    def alive(self):
+        return [job for job in self.jobs if job not in self.failed]
+
+    def map(self, function, *args, **kwargs):
+        '''Call function(job, *args, **kwargs) concurrently, return {job: result} for the jobs where it succeeded.'''
+        jobs = self.alive
+        results = collections.OrderedDict()
+        if not jobs:
+            return results
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = collections.OrderedDict((job, executor.submit(self.__call_logged, job, function, *args,
+                                                                    **kwargs)) for job in jobs)
+            for job, future in futures.items():
+                try:
+                    results[job] = future.result()
+                except Exception as e:
+                    name = getattr(function, '__name__', str(function))
+                    logger.error('[%s] %s failed: %s\n%s' % (job, name, e, traceback.format_exc()))
+                    self.failed[job] = e
+        return results
+
+    @staticmethod
+    def __call_logged(job, function, *args, **kwargs):
+        current_job.job = job
+        try:
+            return function(job, *args, **kwargs)
+        finally:
+            current_job.job = None
+
+    def pipeline(self, *steps):
+        '''Run the steps one after the other on all the jobs, return {job: [results]} for the jobs that succeeded.'''
+        results = collections.OrderedDict((job, []) for job in self.alive)
+        for step in steps:
+            for job, result in self.map(step).items():
+                results[job].append(result)
+        return collections.OrderedDict((job, res) for job, res in results.items() if job not in self.failed)
+
+    def oardel(self):
+        '''Delete all the jobs, including the failed ones.'''
+        for job in self.jobs:
+            try:
+                job.oardel()
+            except Exception as e:
+                logger.error('[%s] oardel failed: %s' % (job, e))
+
+    @classmethod
+    def oarsub_clusters(cls, username, clusters, walltime, nb_nodes, **kwargs):
+        '''Submit one job per {site: cluster} of clusters, concurrently. The failed submissions are ignored.'''
+        jobs = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(clusters), 1)) as executor:
+            futures = [(site, cluster, executor.submit(Job.oarsub_cluster, site, username, [cluster], walltime,
+                                                       nb_nodes, **kwargs))
+                       for site, cluster in sorted(clusters.items())]
+            for site, cluster, future in futures:
+                try:
+                    jobs.append(future.result())
+                except Exception as e:
+                    logger.error('[%s/%s] oarsub failed: %s' % (site, cluster, e))
+        return cls(jobs)
+
+
 def mpi_install(job):
     logger.info(str(job))
     logger.info('Nodes: %s and %s' % tuple(job.hostnames))
@@ -532,42 +828,60 @@ def send_key(job):
         job.director.run('ssh -o "StrictHostKeyChecking no" %s hostname' % short_target, directory='/root')
 
 
-def run_calibration(job):
-    def remove_g5k(hostname):
-        return hostname[:hostname.index('.')]
-    xml_content = '''<?xml version="1.0"?>
+CALIBRATION_DIR = '/tmp/platform-calibration/src/calibration'
+
+
+def calibration_config(dirname='exp', size_file='zoo_sizes', min_size=0, max_size=1000000, iterations=5):
+    return '''<?xml version="1.0"?>
         <config id="Config">
         <!-- prefix name for the output files -->
          <prefix value="exp"/>
         <!-- directory name for the output files (as seen from calibrate.c) -->
-         <dirname value="exp"/>
+         <dirname value="{dirname}"/>
         <!-- Name of the file that contains all message sizes we can choose from. -->
-         <sizeFile value="zoo_sizes"/>
+         <sizeFile value="{size_file}"/>
         <!-- Minimum size of the messages to send-->
-         <minSize value="0"/>
+         <minSize value="{min_size}"/>
         <!-- Maximum size of the messages to send-->
-         <maxSize value="1000000"/>
+         <maxSize value="{max_size}"/>
         <!-- Number of iterations per size of message-->
-         <iterations value="5"/>
+         <iterations value="{iterations}"/>
         </config>
-    '''
-    path = '/tmp/platform-calibration/src/calibration'
-    node_exp_filename = 'exp.xml'
-    job.nodes.write_files(xml_content, path + '/' + node_exp_filename)
-    job.nodes.run('mkdir -p %s' % (path + '/exp'))
+    '''.format(dirname=dirname, size_file=size_file, min_size=min_size, max_size=max_size, iterations=iterations)
+
+
+@contextlib.contextmanager
+def profile_applied(job, profile):
+    if profile:
+        with profile.applied(job) as record:
+            yield record
+    else:
+        yield None
+
+
+def calibrate(job, config, dirname='exp', config_filename='exp.xml'):
+    job.nodes.write_files(config, CALIBRATION_DIR + '/' + config_filename)
+    job.nodes.run('mkdir -p %s' % (CALIBRATION_DIR + '/' + dirname))
     host = ','.join([node.host for node in job.nodes])
-    start_date = datetime.datetime.now()
-    job.director.run('mpirun --allow-run-as-root -np 2 -host %s ./calibrate -f %s' % (host, node_exp_filename),
-                     directory=path)
-    end_date = datetime.datetime.now()
+    placement = job.nodes.placement(ranks_per='node', cores_per_rank=1, ranks_per_domain=1)
+    job.director.run('mpirun --allow-run-as-root %s -np 2 -host %s ./calibrate -f %s' % (
+                     placement.mpirun_options(), host, config_filename), directory=CALIBRATION_DIR)
+
+
+def archive_calibration(job, start_date, end_date, extra_files=None, raw_files=None, store=None):
+    def remove_g5k(hostname):
+        return hostname[:hostname.index('.')]
     archive_name = '%s-%s_%s_%d.zip' % (remove_g5k(job.director.hostnames[0]),
                                         remove_g5k(job.orchestra.hostnames[0]),
                                         datetime.date.today(),
                                         job.jobid)
     archive_path = '/tmp/%s' % archive_name
-    job.director.run('zip -r %s exp' % archive_path, directory=path)
-    job.add_raw_information(archive_path)
+    job.director.run('zip -r %s exp' % archive_path, directory=CALIBRATION_DIR)
+    hashes = job.add_raw_information(archive_path, store)
     job.director.get(archive_path, archive_name)
+    if store:
+        store.add_archive(archive_name, hashes)
+        extra_files = dict(extra_files or {}, **{'information.yaml': hashes})
     tmp_file = tempfile.NamedTemporaryFile(dir='.')
     job_info = job.platform_information()
     job_info['start'] = start_date.isoformat()
@@ -579,19 +893,56 @@ def run_calibration(job):
     with open(tmp_file.name, 'w') as f:
         yaml.dump(job.oarstat(), f, default_flow_style=False)
     archive.write(tmp_file.name, 'oarstat.yaml')
+    for filename, content in (extra_files or {}).items():
+        with open(tmp_file.name, 'w') as f:
+            yaml.dump(content, f, default_flow_style=False)
+        archive.write(tmp_file.name, filename)
+    for filename, content in (raw_files or {}).items():
+        archive.writestr(filename, content)
     with open(tmp_file.name, 'w') as f:
-        log = log_stream.getvalue()
+        log = job.log_stream.getvalue() or log_stream.getvalue()  # the job has its own log in a JobGroup
         log = log.encode('ascii', 'ignore').decode()  # removing any non-ascii character
         f.write(log)
     archive.write(tmp_file.name, 'commands.log')
     archive.close()
     tmp_file.close()
+    return archive_name
 
 
-def mpi_calibration(job):
+def run_calibration(job, profile=None, collectives=False, ranks_per_node=1, sampler=None, summarize=False,
+                    raw_fraction=0.05, store=None):
+    '''
+    Point-to-point calibration of the first two nodes, and with collectives=True of the collective operations on all
+    the nodes (see collective_calibration).
+    With a telemetry.Sampler, the nodes are sampled during the calibration (telemetry/<hostname>.bin in the archive).
+    With summarize=True, the measures are summarized and only kept for a fraction raw_fraction of the message sizes.
+    With an information_store.InformationStore, the files already in the store are only referenced in information.yaml.
+    '''
+    with profile_applied(job, profile) as profile_record, telemetry.sampling(job, sampler):
+        start_date = datetime.datetime.now()
+        calibrate(job, calibration_config())
+        if collectives:
+            import collective_calibration  # it imports this module
+            collective_calibration.run_collectives(job, ranks_per_node=ranks_per_node)
+        end_date = datetime.datetime.now()
+    if summarize:
+        import calibration_summary
+        calibration_summary.summarize(job, raw_fraction=raw_fraction)
+    extra_files = {'profile.yaml': profile_record} if profile_record else {}
+    raw_files = sampler.archive_files() if sampler else {}
+    return archive_calibration(job, start_date, end_date, extra_files, raw_files, store)
+
+
+def mpi_calibration(job, profile=None, collectives=False, sampler=None, store=None, predictor=None):
+    '''The durations of the stages of the job are added to the history of the walltime_predictor.'''
+    import walltime_predictor
     mpi_install(job)
     send_key(job)
-    run_calibration(job)
+    archive_name = run_calibration(job, profile=profile, collectives=collectives, sampler=sampler, store=store)
+    try:
+        (predictor or walltime_predictor.WalltimePredictor()).add_archive(archive_name)
+    except Exception as e:  # the calibration is archived, a broken history must not fail it
+        logger.warning('Could not add %s to the walltime history: %r' % (archive_name, e))
     return job
 
 
@@ -600,12 +951,17 @@ def get_job(args, nb_nodes=2, check_nb_nodes=False):
     site = args.site
     deploy = args.deploy
     queue = args.queue
+    if args.submission_type in ('cluster', 'nodes'):
+        import walltime_predictor
+        clusters = [args.cluster] if args.submission_type == 'cluster' else sorted({get_cluster(host)
+                                                                                    for host in args.nodes})
+        walltime = walltime_predictor.WalltimePredictor().walltime(clusters, deploy, default=Time(minutes=15))
     if args.submission_type == 'cluster':
         job = Job.oarsub_cluster(site, user, clusters=[
-                                 args.cluster], walltime=Time(minutes=15), nb_nodes=2, deploy=deploy, queue=queue)
+                                 args.cluster], walltime=walltime, nb_nodes=2, deploy=deploy, queue=queue)
     elif args.submission_type == 'nodes':
         job = Job.oarsub_hostnames(
-            site, user, hostnames=args.nodes, walltime=Time(minutes=15), deploy=deploy, queue=queue)
+            site, user, hostnames=args.nodes, walltime=walltime, deploy=deploy, queue=queue)
     else:
         assert args.submission_type == 'jobid'
         connection = Job.g5k_connection(site, user)
@@ -1,7 +1,33 @@
+import os
+import io
+import json
+import tarfile
+import hashlib
+import datetime
+import tempfile
+import pandas
+import dgemm
+import real_hpl
+import hpl_output
+import smpi_platform
 from fabfile import Job, Time, logger
 
+HPL_DIR = '/tmp/hpl-master'
+XHPL_CACHE_DIR = 'xhpl_cache'
+SWEEP_DIR = '/tmp/smpi_sweep'
+HUGEPAGE_DIR = '/root/huge'
+SMPIRUN_OPTIONS = [
+    '--cfg=smpi/privatize-global-variables:dlopen',
+    '--cfg=smpi/display-timing:yes',
+    '--cfg=smpi/shared-malloc-blocksize:2097152',
+    '--cfg=smpi/shared-malloc-hugepage:%s' % HUGEPAGE_DIR,
+]
+COEFFICIENTS_FILE = 'smpi_coefficients.json'
+# Coefficients measured on taurus, used when no measure is wanted
+DEFAULT_COEFFICIENTS = {'dgemm': 2.445036e-10, 'dtrsm': 1.259681e-10}
 
-def install(job):
+
+def install_simgrid(job):
     job.kadeploy().apt_install(
         'build-essential',
         'zip',
@@ -24,12 +50,113 @@ def install(job):
     job.nodes.run('wget https://github.com/Ezibenroc/hpl/archive/master.zip -O hpl.zip')
     job.nodes.run('unzip hpl.zip')
     job.nodes.run('sed -ri "s|TOPdir\s*=.+|TOPdir="`pwd`"|g" Make.SMPI && make startup arch=SMPI',
-                  directory='/tmp/hpl-master')
-    job.nodes.run('make SMPI_OPTS="-DSMPI_OPTIMIZATION -DSMPI_DGEMM_COEFFICIENT=2.445036e-10 -DSMPI_DTRSM_COEFFICIENT=1.259681e-10" arch=SMPI',
-                  directory='/tmp/hpl-master')
+                  directory=HPL_DIR)
+
+
+def load_coefficients(cluster, filename=COEFFICIENTS_FILE):
+    try:
+        with open(filename) as f:
+            return json.load(f).get(cluster)
+    except FileNotFoundError:
+        return None
+
+
+def store_coefficients(cluster, coefficients, filename=COEFFICIENTS_FILE):
+    try:
+        with open(filename) as f:
+            all_coefficients = json.load(f)
+    except FileNotFoundError:
+        all_coefficients = {}
+    all_coefficients[cluster] = coefficients
+    with open(filename, 'w') as f:
+        json.dump(all_coefficients, f, indent=2, sort_keys=True)
+
+
+def measure_coefficients(job, nb_points=200, max_size=4000, nb_repeats=2):
+    '''
+    Measure the single-threaded dgemm and dtrsm durations on all the nodes and fit the coefficients of the SMPI build
+    of HPL (the median of the per-node coefficients). OpenBLAS is installed if needed.
+    '''
+    job.nodes.run('[ -f /tmp/lib/libopenblas.so ] || (wget https://github.com/xianyi/OpenBLAS/archive/v0.3.1.zip '
+                  '-O openblas.zip && unzip openblas.zip && mv OpenBLAS-* openblas && cd openblas && make -j 64 && '
+                  'make install PREFIX=/tmp)')
+    dgemm.install_kernel(job)
+    coefficients = {}
+    for operation in ['dgemm', 'dtrsm']:
+        design = dgemm.sweep_design(nb_points, max_size=max_size, nb_repeats=nb_repeats)
+        df = dgemm.run_sweep(job, design, operation=operation)
+        fits = dgemm.fit_nodes(df, operation=operation)
+        coefficients[operation] = float(fits.coefficient.median())
+    return coefficients
+
+
+def get_coefficients(job, use_cache=True, filename=COEFFICIENTS_FILE, **kwargs):
+    '''
+    Coefficients of the cluster of the job, taken from the cache file if they have already been measured for this
+    cluster, measured (and stored in the cache) otherwise.
+    '''
+    cluster = job.nodes.topology_key
+    if use_cache and cluster is not None:
+        cached = load_coefficients(cluster, filename)
+        if cached is not None:
+            logger.info('Using the coefficients of %s measured on %s' % (cluster, cached['date']))
+            return {operation: cached[operation] for operation in DEFAULT_COEFFICIENTS}
+    coefficients = measure_coefficients(job, **kwargs)
+    if cluster is not None:
+        store_coefficients(cluster, dict(coefficients, date=datetime.date.today().isoformat()), filename)
+    return coefficients
+
+
+def smpi_options(coefficients):
+    return '-DSMPI_OPTIMIZATION -DSMPI_DGEMM_COEFFICIENT=%e -DSMPI_DTRSM_COEFFICIENT=%e' % (
+        coefficients['dgemm'], coefficients['dtrsm'])
+
+
+def coefficients_hash(coefficients):
+    return hashlib.sha1(smpi_options(coefficients).encode()).hexdigest()[:12]
+
+
+def build_hpl(job, coefficients, cache_dir=XHPL_CACHE_DIR):
+    '''
+    Build the SMPI version of HPL with the given coefficients. Each build is kept in cache_dir, on this machine (the
+    nodes are deployed again by each installation), per set of coefficients and per version of the SimGrid and HPL
+    sources, so a build that has already been done is only sent to the nodes.
+    '''
+    sources = job.director.run_unique('md5sum simgrid.zip hpl.zip', hide_output=False).stdout
+    sources_hash = hashlib.sha1(sources.encode()).hexdigest()[:12]
+    cached = os.path.join(cache_dir, '%s-%s' % (coefficients_hash(coefficients), sources_hash), 'xhpl')
+    xhpl = os.path.join(HPL_DIR, 'bin/SMPI/xhpl')
+    if os.path.exists(cached):
+        logger.info('Using the cached build of HPL with %s' % smpi_options(coefficients))
+        job.nodes.put(cached, xhpl)
+        job.nodes.run('chmod +x %s' % xhpl)
+        return
+    logger.info('Building HPL with %s' % smpi_options(coefficients))
+    job.nodes.run('make clean arch=SMPI && make SMPI_OPTS="%s" arch=SMPI' % smpi_options(coefficients),
+                  directory=HPL_DIR)
+    os.makedirs(os.path.dirname(cached), exist_ok=True)
+    job.director.get(xhpl, cached + '.tmp')
+    os.replace(cached + '.tmp', cached)
+
+
+def setup_system(job, nb_hugepages=None):
+    '''Reserve nb_hugepages huge pages (by default, one per core, to run one simulation per core).'''
+    nb_hugepages = nb_hugepages or len(job.nodes.cores)
     job.nodes.run('sysctl -w vm.overcommit_memory=1 && sysctl -w vm.max_map_count=2000000000')
-    job.nodes.run('mkdir -p /root/huge && mount none /root/huge -t hugetlbfs -o rw,mode=0777 && echo 1 >> /proc/sys/vm/nr_hugepages',
-                  hide_output=False)
+    job.nodes.run('mkdir -p %s && mount none %s -t hugetlbfs -o rw,mode=0777 && echo %d > /proc/sys/vm/nr_hugepages' % (
+                  HUGEPAGE_DIR, HUGEPAGE_DIR, nb_hugepages), hide_output=False)
+
+
+def install(job, coefficients=None):
+    '''
+    Install SimGrid and the SMPI version of HPL. If no coefficients are given, they are measured on the nodes (or taken
+    from the cache file for this cluster).
+    '''
+    install_simgrid(job)
+    coefficients = coefficients or get_coefficients(job)
+    build_hpl(job, coefficients)
+    setup_system(job)
+    return coefficients
 
 
 def run_test(job):
@@ -37,6 +164,125 @@ def run_test(job):
     job.nodes.run('smpirun -wrapper /usr/bin/time --cfg=smpi/privatize-global-variables:dlopen --cfg=smpi/display-timing:yes --cfg=smpi/shared-malloc-blocksize:2097152 -hostfile hostnames-taurus-144-hpl -platform platform_taurus_hpl.xml --cfg=smpi/shared-malloc-hugepage:/root/huge -np 144 xhpl', directory='/tmp/hpl-master/bin/SMPI')
 
 
+def simulation_files(configuration, network_config=None, ranks_per_host=1, **platform_kwargs):
+    '''HPL.dat, hostfile, platform and script of the simulation of an HPL configuration (a dictionary of HPL_FIELDS).'''
+    nb_ranks = configuration['proc_p'] * configuration['proc_q']
+    nb_hosts = (nb_ranks + ranks_per_host - 1) // ranks_per_host
+    hpl_params = {key: value for key, value in configuration.items() if key in real_hpl.HPL_FIELDS}
+    script = 'cd "$(dirname "$0")" && /usr/bin/time -f "maxresident=%%M\\nwallclock=%%e" -o time.txt ' \
+             'smpirun %s -hostfile hostfile -platform platform.xml -np %d %s > output.txt 2> stderr.txt\n' % (
+                 ' '.join(SMPIRUN_OPTIONS), nb_ranks, os.path.join(HPL_DIR, 'bin/SMPI/xhpl'))
+    return {
+        'HPL.dat': real_hpl.generate_hpl_file(**hpl_params),
+        'hostfile': smpi_platform.hostfile(nb_ranks, ranks_per_host),
+        'platform.xml': smpi_platform.platform_xml(nb_hosts, ranks_per_host, network_config, **platform_kwargs),
+        'run.sh': script,
+    }
+
+
+def simulation_cost(configuration):
+    '''Rough relative cost of a simulation: number of panels times number of ranks.'''
+    return configuration['size'] / configuration['block_size'] * configuration['proc_p'] * configuration['proc_q']
+
+
+def assign_simulations(configurations, hostnames):
+    '''Greedy assignment of the simulations to the nodes, the most expensive first, each to the least loaded node.'''
+    load = {host: 0 for host in hostnames}
+    assignment = {}
+    order = sorted(range(len(configurations)), key=lambda i: -simulation_cost(configurations[i]))
+    for i in order:
+        host = min(hostnames, key=lambda host: (load[host], hostnames.index(host)))
+        load[host] += simulation_cost(configurations[i])
+        assignment[i] = host
+    return assignment
+
+
+def _add_file(archive, name, content):
+    content = content.encode()
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    archive.addfile(info, io.BytesIO(content))
+
+
+def prepare_simulations(job, configurations, network_config=None, ranks_per_host=1, **platform_kwargs):
+    '''
+    Send the files of all the simulations to the nodes, in a single archive. Return the assignment of the simulations
+    to the nodes.
+    '''
+    assignment = assign_simulations(configurations, job.hostnames)
+    tmp_file = tempfile.NamedTemporaryFile(dir='.', suffix='.tar.gz')
+    with tarfile.open(tmp_file.name, 'w:gz') as archive:
+        for i, configuration in enumerate(configurations):
+            files = simulation_files(configuration, network_config, ranks_per_host, **platform_kwargs)
+            for name, content in files.items():
+                _add_file(archive, 'sim_%d/%s' % (i, name), content)
+        _add_file(archive, 'assignment', ''.join('%s %d\n' % (host.split('.')[0], i)
+                                                 for i, host in sorted(assignment.items())))
+    job.nodes.run('rm -rf %s && mkdir -p %s' % (SWEEP_DIR, SWEEP_DIR))
+    job.nodes.put(tmp_file.name, os.path.join(SWEEP_DIR, 'sweep.tar.gz'))
+    tmp_file.close()
+    job.nodes.run('tar -xzf sweep.tar.gz', directory=SWEEP_DIR)
+    return assignment
+
+
+def parse_simulations(stdout):
+    '''Results of the simulations of a node, from the output of the collection command of run_simulations.'''
+    result = {}
+    for block in stdout.split('### ')[1:]:
+        sim_id, _, content = block.partition('\n')
+        record = {'maxresident': None, 'wallclock': None, 'simulated_time': None, 'gflops': None}
+        for line in content.split('\n'):
+            key, _, value = line.partition('=')
+            if key in ('maxresident', 'wallclock') and value:
+                record[key] = float(value)
+        for res in hpl_output.iter_results(content):
+            record['simulated_time'] = res['time']
+            record['gflops'] = res['gflops']
+        result[int(sim_id)] = record
+    return result
+
+
+def run_simulations(job, configurations, network_config=None, ranks_per_host=1, memory_per_simulation=2048,
+                    hugepages_per_simulation=1, **platform_kwargs):
+    '''
+    Simulate each HPL configuration with SMPI. The simulations are spread over the nodes of the job; on each node, as
+    many of them run concurrently as allowed by the number of cores, the free huge pages (hugepages_per_simulation per
+    simulation) and the available memory (memory_per_simulation MB per simulation). Return a DataFrame with the
+    configuration, the simulated time and performance, the wall-clock time and the peak RSS (in kB) of each simulation.
+    The network_config (e.g. from smpi_platform.network_model) is put in the platform files.
+    '''
+    assignment = prepare_simulations(job, configurations, network_config, ranks_per_host, **platform_kwargs)
+    sims = 'grep "^$(hostname -s) " assignment | cut -d" " -f2'
+    limits = ['$(($(awk \'/MemAvailable/ {print $2}\' /proc/meminfo) / %d))' % (memory_per_simulation*1024)]
+    if hugepages_per_simulation:
+        limits.append('$(($(awk \'/HugePages_Free/ {print $2}\' /proc/meminfo) / %d))' % hugepages_per_simulation)
+    cmd = 'slots=$(nproc); for limit in %s; do [ $limit -lt $slots ] && slots=$limit; done; ' \
+          '[ $slots -lt 1 ] && slots=1; echo "slots=$slots" > slots.txt; ' \
+          '%s | xargs -r -P $slots -I{} sh sim_{}/run.sh || true' % (' '.join(limits), sims)
+    logger.info('Running %d simulations on %d node(s)' % (len(configurations), len(job.hostnames)))
+    job.nodes.run(cmd, directory=SWEEP_DIR)
+    output = job.nodes.run('cat slots.txt; for i in $(%s); do echo "### $i"; '
+                           'cat sim_$i/time.txt sim_$i/output.txt 2> /dev/null; done; true' % sims,
+                           directory=SWEEP_DIR, hide_output=False)
+    rows = []
+    for node, res in output.items():
+        logger.info('[%s] %s' % (node.host, res.stdout.split('\n')[0]))
+        for sim_id, record in parse_simulations(res.stdout).items():
+            record.update(configurations[sim_id])
+            record['hostname'] = node.host
+            record['simulation'] = sim_id
+            rows.append(record)
+    if not rows:
+        logger.warning('No simulation returned a result.')
+    columns = ['maxresident', 'wallclock', 'simulated_time', 'gflops'] + \
+        sorted(set().union(*configurations)) + ['hostname', 'simulation']
+    df = pandas.DataFrame(rows, columns=columns).sort_values('simulation').reset_index(drop=True)
+    failed = df[df.simulated_time.isnull()]
+    if len(failed):
+        logger.warning('%d simulation(s) failed: %s' % (len(failed), ', '.join(str(i) for i in failed.simulation)))
+    return df
+
+
 if __name__ == '__main__':
     job = Job.oarsub_cluster(site='lyon',
                              username='tocornebize',
@@ -0,0 +1,120 @@
+import io
+import re
+import datetime
+
+# Prefix added by mpirun --timestamp-output (and optionally --tag-output) to each line
+TIMESTAMP_REGEX = re.compile(r'^(\w{3} \w{3} [ \d]\d \d\d:\d\d:\d\d \d{4})(?:\[\d+,\d+\])?<std(?:out|err)>:')
+RESULT_REGEX = re.compile(r'(W([RC])(\d)(\d)([LCR])(\d+)([LCR])(\d+))\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\S+)\s+(\S+)')
+DATE_REGEX = re.compile(r'HPL_pdgesv\(\) (start|end) time\s+(.+)$')
+DETAILED_TIMING_REGEX = re.compile(r'Max aggregated wall time ([a-z ]+?)[ .]*:\s+(\S+)')
+RESIDUAL_REGEX = re.compile(r'\|\|Ax-b\|\|.*=\s*(\S+)\s+\.+\s+(PASSED|FAILED)')
+FACT = {'L': 0, 'C': 1, 'R': 2}
+DATE_FORMAT = '%a %b %d %H:%M:%S %Y'
+
+COLUMNS = {
+    'encoding': str,
+    'size': int,
+    'block_size': int,
+    'proc_p': int,
+    'proc_q': int,
+    'pmap': str,
+    'pfact': int,
+    'rfact': int,
+    'bcast': int,
+    'depth': int,
+    'ndiv': int,
+    'nbmin': int,
+    'time': float,
+    'gflops': float,
+    'residual': float,
+    'passed': bool,
+    'timestamp': 'datetime64[ns]',
+    'start_time': 'datetime64[ns]',
+    'end_time': 'datetime64[ns]',
+}
+
+
+def _parse_date(date):
+    return datetime.datetime.strptime(' '.join(date.split()), DATE_FORMAT)
+
+
+def _lines(source):
+    if isinstance(source, str):
+        return io.StringIO(source)
+    return source
+
+
+def iter_results(source):
+    '''
+    Generator over the results of an HPL output, given as a string or an iterable of lines (e.g. an open file).
+    Yields one dictionary per configuration, with the values given by the T/V field, the time and the performance, the
+    residual and the status of the test, the start and end dates, the mpirun timestamp (if --timestamp-output was used)
+    and the detailed timings (if HPL was compiled with HPL_DETAILED_TIMING).
+    '''
+    current = None
+    for line in _lines(source):
+        timestamp = None
+        match = TIMESTAMP_REGEX.match(line)
+        if match:
+            timestamp = _parse_date(match.group(1))
+            line = line[match.end():]
+        match = RESULT_REGEX.search(line)
+        if match:
+            if current is not None:
+                yield current
+            encoding, pmap, depth, bcast, rfact, ndiv, pfact, nbmin, size, block_size, proc_p, proc_q, time, gflops =\
+                match.groups()
+            current = {
+                'encoding': encoding,
+                'size': int(size),
+                'block_size': int(block_size),
+                'proc_p': int(proc_p),
+                'proc_q': int(proc_q),
+                'pmap': pmap,
+                'pfact': FACT[pfact],
+                'rfact': FACT[rfact],
+                'bcast': int(bcast),
+                'depth': int(depth),
+                'ndiv': int(ndiv),
+                'nbmin': int(nbmin),
+                'time': float(time),
+                'gflops': float(gflops),
+                'residual': None,
+                'passed': None,
+                'timestamp': timestamp,
+                'start_time': None,
+                'end_time': None,
+            }
+            continue
+        if current is None:
+            continue
+        match = DATE_REGEX.search(line)
+        if match:
+            current['%s_time' % match.group(1)] = _parse_date(match.group(2))
+            continue
+        match = DETAILED_TIMING_REGEX.search(line)
+        if match:
+            current['time_%s' % '_'.join(match.group(1).split())] = float(match.group(2))
+            continue
+        match = RESIDUAL_REGEX.search(line)
+        if match:
+            current['residual'] = float(match.group(1))
+            current['passed'] = match.group(2) == 'PASSED'
+    if current is not None:
+        yield current
+
+
+def read_hpl(source):
+    '''Typed DataFrame with one row per configuration of the HPL output.'''
+    import pandas  # only needed for the analysis, not to run the experiments
+    df = pandas.DataFrame(list(iter_results(source)))
+    detailed_timings = sorted(column for column in df.columns if column.startswith('time_'))
+    df = df.reindex(columns=list(COLUMNS) + detailed_timings)
+    for column, dtype in COLUMNS.items():
+        if dtype == bool:
+            df[column] = df[column].astype('boolean')
+        elif dtype != str:
+            df[column] = df[column].astype(dtype)
+    for column in detailed_timings:
+        df[column] = df[column].astype(float)
+    return df
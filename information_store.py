@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import hashlib
+import zipfile
+import datetime
+
+# Lines of the information files that change at each collection without any change of the platform. They are ignored
+# by the hash, so the store keeps the first version of such a file.
+VOLATILE_LINES = {
+    'cpuinfo.txt': r'^(cpu MHz|bogomips)',
+    'environment.txt': r'^(SSH_CLIENT|SSH_CONNECTION|OLDPWD)=',
+    'topology.pdf': r'/(CreationDate|ModDate)',
+}
+
+# Files whose collection is slow (lstopo, lspci, dmidecode). They are not collected again on a node whose fingerprint,
+# a hash of its CPUs, memory size, firmware and PCI devices, did not change since it was last seen.
+HARDWARE_FILES = ['topology.xml', 'topology.pdf', 'lspci.txt', 'dmidecode.txt']
+FINGERPRINT_COMMAND = ("(grep -a -v -E '%s' /proc/cpuinfo; grep MemTotal /proc/meminfo; "
+                       "cat /sys/class/dmi/id/bios_version /sys/class/dmi/id/product_name; ls /sys/bus/pci/devices) "
+                       "2> /dev/null | sha256sum | cut -d' ' -f1" % VOLATILE_LINES['cpuinfo.txt'])
+
+
+def content_hash(filename, data):
+    pattern = VOLATILE_LINES.get(filename)
+    if pattern:  # same output as grep -v
+        regex = re.compile(pattern.encode())
+        lines = data.split(b'\n')
+        if data.endswith(b'\n'):
+            lines = lines[:-1]
+        data = b''.join(line + b'\n' for line in lines if not regex.search(line))
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_command(filenames):
+    '''Shell command that prints a line "<filename> <hash>" for each file, the hash being the one of content_hash.'''
+    commands = []
+    for filename in filenames:
+        if filename in VOLATILE_LINES:
+            content = "LC_ALL=C grep -a -v -E '%s' %s" % (VOLATILE_LINES[filename], filename)
+        else:
+            content = 'cat %s' % filename
+        commands.append('echo %s $(%s | sha256sum | cut -d" " -f1)' % (filename, content))
+    return '; '.join(commands)
+
+
+def parse_hashes(output):
+    return dict(line.split() for line in output.splitlines() if line.strip())
+
+
+class InformationStore:
+    '''
+    Content-addressed store of the platform information collected by Job.add_raw_information. Each distinct file is
+    kept once, in blobs/<hash>; the archives reference the files of each host with their hashes (information.yaml).
+    The file hosts.json holds the hashes of the files of each host the last time it was seen.
+    '''
+    def __init__(self, directory='information_store'):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        self.hosts_file = os.path.join(directory, 'hosts.json')
+        if os.path.exists(self.hosts_file):
+            with open(self.hosts_file) as f:
+                self.hosts = json.load(f)
+        else:
+            self.hosts = {}
+        self.__fingerprints = {}
+
+    def __blob_path(self, content_hash):
+        return os.path.join(self.directory, 'blobs', content_hash)
+
+    def has(self, content_hash):
+        return os.path.exists(self.__blob_path(content_hash))
+
+    def get(self, content_hash):
+        with open(self.__blob_path(content_hash), 'rb') as f:
+            return f.read()
+
+    def add(self, filename, data):
+        result = content_hash(filename, data)
+        if not self.has(result):
+            tmp_path = self.__blob_path(result) + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.__blob_path(result))
+        return result
+
+    def last_seen(self, host):
+        return self.hosts.get(host, {}).get('files', {})
+
+    def changes(self, host, hashes):
+        '''Files of the host whose hash changed since it was last seen (None if it was never seen).'''
+        if host not in self.hosts:
+            return None
+        last_seen = self.last_seen(host)
+        return sorted(filename for filename, value in hashes.items() if last_seen.get(filename) != value)
+
+    def unchanged(self, host, fingerprint):
+        '''
+        Whether the host was last seen with this fingerprint and its hardware files are in the store. The fingerprint
+        is saved with the hashes of the host when it is seen.
+        '''
+        self.__fingerprints[host] = fingerprint
+        last_seen = self.last_seen(host)
+        return (self.hosts.get(host, {}).get('fingerprint') == fingerprint and
+                all(filename in last_seen and self.has(last_seen[filename]) for filename in HARDWARE_FILES))
+
+    def see(self, host, hashes):
+        self.hosts[host] = {'date': datetime.datetime.now().isoformat(), 'files': hashes,
+                            'fingerprint': self.__fingerprints.get(host)}
+        with open(self.hosts_file, 'w') as f:
+            json.dump(self.hosts, f, indent=2, sort_keys=True)
+
+    def add_archive(self, archive_name, hashes=None):
+        '''
+        Add the information files of the archive (information/<hostname>/<filename>) to the store. If given, hashes
+        are the hashes computed on the nodes (see Job.add_raw_information): the files missing from the archive must be
+        in the store and the hosts are marked as seen. Return the hashes of the files of each host.
+        '''
+        result = {}
+        with zipfile.ZipFile(archive_name) as input_zip:
+            for name in input_zip.namelist():
+                parts = name.split('/')
+                if len(parts) != 3 or parts[0] != 'information' or not parts[2]:
+                    continue
+                result.setdefault(parts[1], {})[parts[2]] = self.add(parts[2], input_zip.read(name))
+        if hashes is None:
+            return result
+        for host, files in hashes.items():
+            for filename, value in files.items():
+                if result.get(host, {}).get(filename, value) != value:
+                    raise ValueError('File %s of %s changed after being hashed.' % (filename, host))
+                if not self.has(value):
+                    raise ValueError('File %s of %s (%s) is neither in %s nor in the store.' % (
+                        filename, host, value, archive_name))
+            self.see(host, files)
+        return hashes
+
+    def add_folder(self, folder_name):
+        '''Add the information files of all the zip archives of the folder.'''
+        nb_archives = 0
+        for root, dirs, files in os.walk(folder_name):
+            for file in files:
+                if file.endswith('.zip'):
+                    self.add_archive(os.path.join(root, file))
+                    nb_archives += 1
+        return nb_archives
+
+    def read(self, archive_name, host, filename):
+        '''Content of a file of a host for the experiment of the archive, taken from the archive or from the store.'''
+        import yaml
+        import extract_archive
+        name = 'information/%s/%s' % (host, filename)
+        with extract_archive.open_archive(archive_name) as input_zip:
+            if name in input_zip.namelist():
+                return input_zip.read(name)
+            hashes = yaml.safe_load(input_zip.read('information.yaml'))
+        return self.get(hashes[host][filename])
@@ -0,0 +1,109 @@
+import json
+import random
+import itertools
+import collections
+from fabfile import Job, Nodes, logger, get_cluster
+
+NodeInfo = collections.namedtuple('NodeInfo', ['hostname', 'cluster', 'switch', 'available'])
+
+
+def parse_oarnodes(output):
+    '''
+    Information on each host (short hostname) from the output of oarnodes -J. A host is available if all its resources
+    are alive and it is not in maintenance.
+    '''
+    resources = json.loads(output)
+    if isinstance(resources, dict):
+        resources = resources.values()
+    result = {}
+    for resource in resources:
+        properties = resource.get('properties', resource)
+        hostname = (resource.get('network_address') or properties['network_address']).split('.')[0]
+        available = resource.get('state') == 'Alive' and properties.get('maintenance', 'NO') != 'YES'
+        previous = result.get(hostname)
+        if previous:
+            available = available and previous.available
+        result[hostname] = NodeInfo(hostname, properties.get('cluster') or get_cluster(hostname),
+                                    properties.get('switch'), available)
+    return result
+
+
+def query_nodes(frontend, cluster):
+    '''State and switch of the nodes of the cluster, asked to OAR on the frontend.'''
+    result = frontend.run_unique('oarnodes -J --sql "cluster=\'%s\'"' % cluster, hide_output=False)
+    return parse_oarnodes(result.stdout)
+
+
+def plan_pairs(switches, nb_inter=1):
+    '''
+    Small set of node pairs for calibrations, from a dictionary {hostname: switch}. In each switch, the nodes are
+    paired two by two (a node left alone is paired with another one of its switch), then nb_inter pairs are added for
+    each pair of switches, with the nodes used the least so far. Every node is covered and there are intra-switch and
+    inter-switch pairs, with about n/2 + s*(s-1)/2 pairs instead of n*(n-1)/2 for n nodes and s switches.
+    '''
+    groups = collections.defaultdict(list)
+    for hostname, switch in sorted(switches.items()):
+        groups[switch].append(hostname)
+    usage = collections.Counter()
+    pairs = []
+
+    def add(node1, node2):
+        usage[node1] += 1
+        usage[node2] += 1
+        pairs.append((node1, node2))
+
+    def least_used(nodes, excluded=None):
+        return min((node for node in nodes if node != excluded), key=lambda node: usage[node])
+
+    for switch in sorted(groups, key=str):
+        nodes = groups[switch]
+        random.shuffle(nodes)
+        for node1, node2 in zip(nodes[0::2], nodes[1::2]):
+            add(node1, node2)
+        if len(nodes) % 2 == 1 and len(nodes) > 1:
+            add(nodes[-1], least_used(nodes, excluded=nodes[-1]))
+    for switch1, switch2 in itertools.combinations(sorted(groups, key=str), 2):
+        for _ in range(nb_inter):
+            add(least_used(groups[switch1]), least_used(groups[switch2]))
+    return pairs
+
+
+def select_pairs(pairs, nb_pairs):
+    '''
+    At most nb_pairs of the pairs, covering as many nodes as possible: the pairs with the most nodes not covered yet
+    are taken first, in their order. The nodes left uncovered, if any, are reported.
+    '''
+    remaining = list(pairs)
+    selected = []
+    covered = set()
+    while remaining and len(selected) < nb_pairs:
+        pair = max(remaining, key=lambda pair: len(set(pair) - covered))  # the first one in case of tie
+        remaining.remove(pair)
+        selected.append(pair)
+        covered.update(pair)
+    uncovered = sorted({node for pair in pairs for node in pair} - covered)
+    if uncovered:
+        logger.warning('%d pairs are not enough to cover the node(s) %s' % (nb_pairs, ', '.join(uncovered)))
+    return selected
+
+
+def plan_cluster(username, site, cluster, possible_node_id=None, nb_inter=1):
+    '''
+    Pairs of available nodes of the cluster (optionally among the given node ids), see plan_pairs. The nodes that are
+    not alive or in maintenance are left out.
+    '''
+    connection = Job.g5k_connection(site, username)
+    frontend = Nodes([connection], name='frontend', working_dir='/home/%s' % username)
+    nodes = query_nodes(frontend, cluster)
+    if possible_node_id is not None:
+        wanted = {'%s-%d' % (cluster, node_id) for node_id in possible_node_id}
+        nodes = {hostname: info for hostname, info in nodes.items() if hostname in wanted}
+    unavailable = sorted(hostname for hostname, info in nodes.items() if not info.available)
+    if unavailable:
+        logger.warning('Unavailable node(s) left out: %s' % ', '.join(unavailable))
+    switches = {hostname: info.switch for hostname, info in nodes.items() if info.available}
+    pairs = plan_pairs(switches, nb_inter=nb_inter)
+    nb_intra = sum(switches[node1] == switches[node2] for node1, node2 in pairs)
+    logger.info('%d pairs for %d nodes on %d switch(es): %d intra-switch and %d inter-switch' % (
+        len(pairs), len(switches), len(set(switches.values())), nb_intra, len(pairs) - nb_intra))
+    return pairs
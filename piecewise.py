@@ -0,0 +1,99 @@
+import collections
+import numpy
+
+Segment = collections.namedtuple('Segment', ['min_x', 'max_x', 'intercept', 'slope'])
+
+
+def _cumulative_sse(x, y, w):
+    '''
+    For each i, the weighted sum of squared errors of the linear regression of y on x restricted to the points [0, i].
+    '''
+    W = numpy.cumsum(w)
+    X = numpy.cumsum(w*x)
+    Y = numpy.cumsum(w*y)
+    XX = numpy.cumsum(w*x*x)
+    XY = numpy.cumsum(w*x*y)
+    YY = numpy.cumsum(w*y*y)
+    sxx = XX - X**2/W
+    sxy = XY - X*Y/W
+    syy = YY - Y**2/W
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        sse = numpy.where(sxx > 1e-12*XX, syy - sxy**2/sxx, syy)
+    return numpy.maximum(sse, 0)
+
+
+def _best_split(x, y, w, min_points):
+    n = len(x)
+    if n < 2*min_points:
+        return None, numpy.inf
+    left = _cumulative_sse(x, y, w)
+    right = _cumulative_sse(x[::-1], y[::-1], w[::-1])[::-1]
+    # Splitting after index i: left segment [0, i], right segment [i+1, n-1]
+    candidates = numpy.arange(min_points-1, n-min_points)
+    costs = left[candidates] + right[candidates+1]
+    best = candidates[numpy.argmin(costs)]
+    return best, costs.min()
+
+
+def find_breakpoints(x, y, max_breakpoints=5, min_points=3, min_improvement=0.1):
+    '''
+    Greedy binary segmentation of the points (x, y), sorted by x. At each step, the segment whose best split reduces the
+    most the sum of squared relative errors is split. Stops when no split improves the total error by more than
+    min_improvement (relative). Returns the breakpoints, i.e. the first x of each segment but the first one.
+    '''
+    order = numpy.argsort(x)
+    x = numpy.asarray(x, dtype=float)[order]
+    y = numpy.asarray(y, dtype=float)[order]
+    w = 1/numpy.maximum(numpy.abs(y), 1e-300)**2  # relative errors, the durations span several orders of magnitude
+    segments = [(0, len(x))]
+    errors = [_cumulative_sse(x, y, w)[-1]]
+    breakpoints = []
+    while len(breakpoints) < max_breakpoints:
+        best = None
+        for i, (start, stop) in enumerate(segments):
+            split, cost = _best_split(x[start:stop], y[start:stop], w[start:stop], min_points)
+            if split is None:
+                continue
+            gain = errors[i] - cost
+            if best is None or gain > best[0]:
+                best = (gain, i, start + split + 1, cost)
+        total = sum(errors)
+        if best is None or total <= 1e-12*len(x) or best[0] < min_improvement*total:  # no split or perfect fit
+            break
+        gain, i, split, cost = best
+        start, stop = segments[i]
+        left_error = _cumulative_sse(x[start:split], y[start:split], w[start:split])[-1]
+        segments[i:i+1] = [(start, split), (split, stop)]
+        errors[i:i+1] = [left_error, cost - left_error]
+        breakpoints.append(float(x[split]))
+    return sorted(breakpoints)
+
+
+def fit_piecewise(x, y, breakpoints=()):
+    '''Independent linear regressions of y on x on each segment delimited by the breakpoints.'''
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    bounds = [-numpy.inf] + list(breakpoints) + [numpy.inf]
+    segments = []
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        mask = (x >= low) & (x < high)
+        if not mask.any():
+            continue
+        seg_x, seg_y = x[mask], y[mask]
+        if len(numpy.unique(seg_x)) > 1:
+            slope, intercept = numpy.polyfit(seg_x, seg_y, 1)
+        else:
+            slope, intercept = 0.0, seg_y.mean()
+        segments.append(Segment(seg_x.min(), seg_x.max(), intercept, slope))
+    return segments
+
+
+def predict(segments, x):
+    x = numpy.asarray(x, dtype=float)
+    result = numpy.full(x.shape, numpy.nan)
+    for i, seg in enumerate(segments):
+        low = seg.min_x if i > 0 else -numpy.inf
+        high = segments[i+1].min_x if i+1 < len(segments) else numpy.inf
+        mask = (x >= low) & (x < high)
+        result[mask] = seg.intercept + seg.slope*x[mask]
+    return result
@@ -1,9 +1,33 @@
 import tempfile
 import os
-import fabric
-from fabfile import Job, Time, logger
+import math
+import time
+import json
+import random
+import datetime
+import itertools
+import statistics
+import collections
+import functools
+import operator
+import hpl_output
+import telemetry
+from fabfile import Job, Time, logger, profile_applied, get_cluster
 
 HPL_DIR = '/tmp/hpl-2.2'
+HPL_MAX_PARAM = 20  # maximal number of values for a parameter in HPL.dat
+HPL_FIELDS = ['size', 'block_size', 'proc_p', 'proc_q', 'pfact', 'rfact', 'bcast', 'depth', 'swap', 'mem_align']
+HPL_DEFAULTS = {'pfact': 0, 'rfact': 0, 'bcast': 0, 'depth': 0, 'swap': 2, 'mem_align': 8}
+TUNING_LEVELS = {
+    'block_size': [32, 64, 128, 256],
+    'bcast': [0, 1, 2, 3, 4, 5],
+    'pfact': [0, 1, 2],
+    'rfact': [0, 1, 2],
+    'depth': [0, 1],
+}
+BEST_CONFIGURATIONS_FILE = 'hpl_best_configurations.json'
+PEAK_CACHE_FILE = 'dgemm_peak_cache.json'
+DGEMM_TEST_URL = 'https://raw.githubusercontent.com/Ezibenroc/m2_internship_scripts/master/cblas_tests/dgemm_test.c'
 
 
 def install_packages(job):
@@ -45,114 +69,521 @@ def install(job):
     install_hpl(job)
 
 
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
 def generate_hpl_file(*, size, block_size, proc_p, proc_q, pfact=0, rfact=0, bcast=0, depth=0, swap=2, mem_align=8):
-    assert 0 < block_size <= size
-    assert proc_p > 0
-    assert proc_q > 0
-    assert depth >= 0
-    assert pfact in (0, 1, 2)
-    assert rfact in (0, 1, 2)
-    assert bcast in (0, 1, 2, 3, 4, 5)
+    '''
+    Each of size, block_size, proc_p, proc_q, pfact, rfact, bcast and depth can be a single value or a list of values,
+    HPL runs every combination of them (proc_p and proc_q are paired, they give the list of process grids).
+    '''
+    sizes = _as_list(size)
+    block_sizes = _as_list(block_size)
+    proc_ps = _as_list(proc_p)
+    proc_qs = _as_list(proc_q)
+    pfacts = _as_list(pfact)
+    rfacts = _as_list(rfact)
+    bcasts = _as_list(bcast)
+    depths = _as_list(depth)
+    assert len(proc_ps) == len(proc_qs)
+    for values in [sizes, block_sizes, proc_ps, pfacts, rfacts, bcasts, depths]:
+        assert 0 < len(values) <= HPL_MAX_PARAM
+    assert 0 < max(block_sizes) <= min(sizes)
+    assert all(p > 0 for p in proc_ps)
+    assert all(q > 0 for q in proc_qs)
+    assert all(d >= 0 for d in depths)
+    assert all(pf in (0, 1, 2) for pf in pfacts)
+    assert all(rf in (0, 1, 2) for rf in rfacts)
+    assert all(bc in (0, 1, 2, 3, 4, 5) for bc in bcasts)
     assert swap in (0, 1, 2)
     assert mem_align % 4 == 0
+
+    def join(values):
+        return ' '.join(str(val) for val in values)
     return '''\
 HPLinpack benchmark input file
 Innovative Computing Laboratory, University of Tennessee
 HPL.out         output file name (if any)
 6               device out (6=stdout,7=stderr,file)
-1               # of problems sizes (N)
+{nb_sizes}               # of problems sizes (N)
 {size}          # default: 29 30 34 35  Ns
-1               # default: 1            # of NBs
+{nb_block_sizes}               # default: 1            # of NBs
 {block_size}    # 1 2 3 4      NBs
 0               PMAP process mapping (0=Row-,1=Column-major)
-1               # of process grids (P x Q)
+{nb_grids}               # of process grids (P x Q)
 {proc_p}        Ps
 {proc_q}        Qs
 16.0            threshold
-1               # of panel fact
+{nb_pfacts}               # of panel fact
 {pfact}         PFACTs (0=left, 1=Crout, 2=Right)
 1               # of recursive stopping criterium
 2               NBMINs (>= 1)
 1               # of panels in recursion
 2               NDIVs
-1               # of recursive panel fact.
+{nb_rfacts}               # of recursive panel fact.
 {rfact}         RFACTs (0=left, 1=Crout, 2=Right)
-1               # of broadcast
+{nb_bcasts}               # of broadcast
 {bcast}         BCASTs (0=1rg,1=1rM,2=2rg,3=2rM,4=Lng,5=LnM)
-1               # of lookahead depth
+{nb_depths}               # of lookahead depth
 {depth}         DEPTHs (>=0)
 {swap}          SWAP (0=bin-exch,1=long,2=mix)
-{block_size}    swapping threshold
+{swap_threshold}    swapping threshold
 0               L1 in (0=transposed,1=no-transposed) form
 0               U  in (0=transposed,1=no-transposed) form
 1               Equilibration (0=no,1=yes)
 {mem_align}     memory alignment in double (> 0)
 '''.format(
-            size=size,
-            block_size=block_size,
-            proc_p=proc_p,
-            proc_q=proc_q,
-            pfact=pfact,
-            rfact=rfact,
-            bcast=bcast,
-            depth=depth,
+            nb_sizes=len(sizes),
+            size=join(sizes),
+            nb_block_sizes=len(block_sizes),
+            block_size=join(block_sizes),
+            nb_grids=len(proc_ps),
+            proc_p=join(proc_ps),
+            proc_q=join(proc_qs),
+            nb_pfacts=len(pfacts),
+            pfact=join(pfacts),
+            nb_rfacts=len(rfacts),
+            rfact=join(rfacts),
+            nb_bcasts=len(bcasts),
+            bcast=join(bcasts),
+            nb_depths=len(depths),
+            depth=join(depths),
             swap=swap,
+            swap_threshold=max(block_sizes),
             mem_align=mem_align,
     )
 
 
+def pack_configurations(configurations, max_batch=None):
+    '''
+    Group the configurations (dictionaries with the arguments of generate_hpl_file, with single values) in batches that
+    can each be run by a single xhpl invocation, i.e. sets of configurations that are exactly the cartesian product of
+    their values. Returns a list of dictionaries whose values are lists, to give to generate_hpl_file.
+    The configurations of a batch are run in the order of HPL, not in a random order.
+    '''
+    if max_batch is not None and max_batch < 1:
+        raise ValueError('The batches must have at least one configuration, got max_batch=%d.' % max_batch)
+    points = set()
+    for conf in configurations:
+        conf = dict(HPL_DEFAULTS, **conf)
+        points.add(tuple(conf[field] for field in HPL_FIELDS))
+    fixed_fields = [HPL_FIELDS.index(field) for field in ('swap', 'mem_align')]
+    groups = {}
+    for point in points:
+        groups.setdefault(tuple(point[i] for i in fixed_fields), set()).add(point)
+    batch_fields = [i for i in range(len(HPL_FIELDS)) if i not in fixed_fields]
+    # proc_p and proc_q are packed together, as a list of grids
+    grid = (HPL_FIELDS.index('proc_p'), HPL_FIELDS.index('proc_q'))
+    dimensions = [(i,) for i in batch_fields if i not in grid] + [grid]
+
+    def values(points, dim):
+        return sorted(set(tuple(p[i] for i in dim) for p in points))
+
+    def product_size(points):
+        return functools.reduce(operator.mul, [len(values(points, dim)) for dim in dimensions])
+
+    def pack(points):
+        all_values = [values(points, dim) for dim in dimensions]
+        size = product_size(points)
+        if size == len(points) and all(len(val) <= HPL_MAX_PARAM for val in all_values) and \
+                (max_batch is None or size <= max_batch):
+            return [points]
+        # Greedy choice of the split: the one whose parts miss the fewest points to be full cartesian products
+        best = None
+        for dim, val in zip(dimensions, all_values):
+            if len(val) < 2:
+                continue
+            if len(val) > HPL_MAX_PARAM or size == len(points):  # too many values, or too many points
+                chunks = [val[i:i+HPL_MAX_PARAM] for i in range(0, len(val), HPL_MAX_PARAM)]
+                if len(chunks) == 1:
+                    chunks = [val[:len(val)//2], val[len(val)//2:]]
+                splits = [chunks]
+            else:  # isolating one of the values
+                splits = [[[v], [w for w in val if w != v]] for v in val]
+            for chunks in splits:
+                parts = [[p for p in points if tuple(p[i] for i in dim) in set(chunk)] for chunk in chunks]
+                missing = sum(product_size(part) - len(part) for part in parts)
+                if best is None or missing < best[0]:
+                    best = (missing, parts)
+        return sum((pack(part) for part in best[1]), [])
+
+    result = []
+    for group in groups.values():
+        for batch in pack(list(group)):
+            kwargs = {field: sorted(set(p[i] for p in batch)) for i, field in enumerate(HPL_FIELDS)}
+            grids = values(batch, grid)
+            kwargs['proc_p'] = [p for p, q in grids]
+            kwargs['proc_q'] = [q for p, q in grids]
+            kwargs['swap'], = kwargs['swap']
+            kwargs['mem_align'], = kwargs['mem_align']
+            result.append(kwargs)
+    return result
+
+
 def setup_hpl(job, **kwargs):
     hpl_file = generate_hpl_file(**kwargs)
     job.nodes.write_files(hpl_file, os.path.join(HPL_DIR, 'bin/Debian/HPL.dat'))
 
 
-def run_hpl(job):
-    nb_cores = len(job.nodes.cores)
+def run_hpl(job, placement):
     nb_nodes = len(job.hostnames)
-    hosts = ','.join(job.hostnames)
-    cmd = 'mpirun --allow-run-as-root --bind-to none --timestamp-output -np %d -x OMP_NUM_THREADS=%d -H %s -x LD_LIBRARY_PATH=/tmp/lib ./xhpl' % (
-        nb_nodes,
-        nb_cores,
+    hosts = ','.join('%s:%d' % (host, placement.ranks_per_node) for host in job.hostnames)
+    cmd = 'mpirun --allow-run-as-root %s --timestamp-output -np %d -H %s -x LD_LIBRARY_PATH=/tmp/lib ./xhpl' % (
+        placement.mpirun_options(),
+        placement.nb_ranks(nb_nodes),
         hosts
     )
     return job.director.run_unique(cmd, hide_output=False, directory=HPL_DIR+'/bin/Debian')
 
 
 def parse_hpl(stdout):
-    lines = stdout.split('\n')
-    for i, line in enumerate(lines):
-        if 'Time' in line and 'Gflops' in line:
-            result = lines[i + 2].split()
-            result = float(result[-2]), float(result[-1])
-        if 'FAILED' in line:
-            residual = float(line.split()[-3])
-            logger.warning('HPL test failed with residual %.2e (should be < 16).' % residual)
+    '''Return a list of dictionaries, one per configuration run by HPL.'''
+    result = list(hpl_output.iter_results(stdout))
+    for row in result:
+        if row['passed'] is False:
+            logger.warning('HPL test failed with residual %.2e (should be < 16).' % row['residual'])
     return result
 
 
-def run(job, **kwargs):
+def get_placement(job, ranks_per, cores_per_rank, proc_p, proc_q):
+    placement = job.nodes.placement(ranks_per=ranks_per, cores_per_rank=cores_per_rank)
+    nb_ranks = placement.nb_ranks(len(job.hostnames))
+    grids = list(zip(_as_list(proc_p), _as_list(proc_q)))
+    if max(p*q for p, q in grids) != nb_ranks:
+        raise ValueError('Process grids %s do not match the %d ranks of %s.' % (
+            ', '.join('%dx%d' % grid for grid in grids), nb_ranks, placement))
+    return placement
+
+
+def run(job, ranks_per='node', cores_per_rank=None, profile=None, sampler=None, check_size=True, gflops=None,
+        **kwargs):
+    '''
+    Run a single HPL configuration. If a telemetry.Sampler is given, the nodes are sampled during the run, the samples
+    are then in sampler.data. The problem size is checked first, see check_configurations.
+    '''
+    placement = get_placement(job, ranks_per, cores_per_rank, kwargs['proc_p'], kwargs['proc_q'])
+    if check_size:
+        check_configurations(job, [kwargs], gflops)
     setup_hpl(job, **kwargs)
-    output = run_hpl(job)
-    time, gflops = parse_hpl(output.stdout)
-    return time, gflops, output
+    with profile_applied(job, profile), telemetry.sampling(job, sampler):
+        output = run_hpl(job, placement)
+    result = parse_hpl(output.stdout)
+    if len(result) != 1:
+        raise ValueError('Expected one HPL result, got %d.' % len(result))
+    return result[0]['time'], result[0]['gflops'], output
 
 
-def estimate_peak(job, matrix_size=8192, nb_cores=None):
-    nb_cores = nb_cores or len(job.nodes.cores)
-    arg = ' '.join([str(matrix_size)]*6)
-    cmd = 'OMP_NUM_THREADS=%d LD_LIBRARY_PATH=/tmp/lib ./dgemm_test %s ' % (nb_cores, arg)
+def run_batch(job, configurations, ranks_per='node', cores_per_rank=None, profile=None, max_batch=None,
+              sampler=None, check_size=True, gflops=None):
+    '''
+    Run all the given configurations (dictionaries with the arguments of generate_hpl_file), with as few xhpl
+    invocations as possible. Return a list of dictionaries, one per configuration, and the list of the outputs.
+    If a telemetry.Sampler is given, the nodes are sampled during the whole batch.
+    Unless check_size is False, the problem sizes are checked first, see check_configurations.
+    '''
+    # The grids are checked once for all the configurations: a batch may only hold the smaller grids.
+    placement = get_placement(job, ranks_per, cores_per_rank, [conf['proc_p'] for conf in configurations],
+                              [conf['proc_q'] for conf in configurations])
+    if check_size:
+        check_configurations(job, configurations, gflops)
+    batches = pack_configurations(configurations, max_batch=max_batch)
+    logger.info('Running %d HPL configurations with %d invocation(s)' % (len(configurations), len(batches)))
+    results = []
+    outputs = []
+    with profile_applied(job, profile), telemetry.sampling(job, sampler):
+        for i, batch in enumerate(batches):
+            setup_hpl(job, **batch)
+            output = run_hpl(job, placement)
+            for row in parse_hpl(output.stdout):
+                row['batch'] = i
+                row['swap'] = batch['swap']
+                row['mem_align'] = batch['mem_align']
+                results.append(row)
+            outputs.append(output)
+    return results, outputs
+
+
+def _level_means(results, factors):
+    means = {}
+    for factor in factors:
+        by_level = collections.defaultdict(list)
+        for row in results:
+            by_level[row[factor]].append(row['gflops'])
+        means[factor] = {level: statistics.mean(values) for level, values in by_level.items()}
+    return means
+
+
+def prune_levels(results, factors, margin=0.05):
+    '''
+    Levels of each factor whose mean performance is lower than (1-margin) times the mean performance of the best level
+    of this factor. Return a dictionary {factor: set of dominated levels}.
+    '''
+    dominated = {}
+    for factor, means in _level_means(results, factors).items():
+        best = max(means.values())
+        dominated[factor] = set(level for level, mean in means.items() if mean < (1-margin)*best)
+    return dominated
+
+
+def load_best_configurations(filename=BEST_CONFIGURATIONS_FILE):
     try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def store_best_configuration(cluster, record, filename=BEST_CONFIGURATIONS_FILE):
+    configurations = load_best_configurations(filename)
+    configurations[cluster] = record
+    with open(filename, 'w') as f:
+        json.dump(configurations, f, indent=2, sort_keys=True)
+
+
+def autotune(job, size, proc_p, proc_q, levels=TUNING_LEVELS, fraction=1, screening_size=None, eta=3,
+             prune_margin=0.05, nb_confirmations=3, ranks_per='node', cores_per_rank=None, profile=None,
+             filename=BEST_CONFIGURATIONS_FILE):
+    '''
+    Search the best HPL parameters (the factors of levels) for the given problem size and process grid, with
+    successive halving: all the candidates (the full factorial, or a random sample of a fraction of it, which is not a
+    fractional factorial design) are first run with a small problem size, the dominated levels are pruned and only the
+    best 1/eta of the candidates are kept for the next round, whose problem size is eta times larger. The best
+    remaining candidates are then run nb_confirmations times with the full problem size, the one with the best median
+    is stored for the cluster in filename.
+    '''
+    factors = sorted(levels)
+    candidates = [dict(zip(factors, values)) for values in itertools.product(*[levels[f] for f in factors])]
+    if fraction < 1:
+        candidates = random.sample(candidates, max(1, int(len(candidates)*fraction)))
+    screening_size = screening_size or size // eta**2
+    common = {'proc_p': proc_p, 'proc_q': proc_q}
+    history = []
+    current_size = screening_size
+    with profile_applied(job, profile):
+        while len(candidates) > nb_confirmations and current_size < size:
+            configurations = [dict(cand, size=current_size, **common) for cand in candidates
+                              if cand['block_size'] <= current_size]
+            if not configurations:
+                logger.info('Screening with N=%d: no configuration with a block size this small' % current_size)
+                current_size *= eta
+                continue
+            results, _ = run_batch(job, configurations, ranks_per=ranks_per, cores_per_rank=cores_per_rank)
+            if not results:
+                logger.warning('Screening with N=%d: no result, the candidates are kept' % current_size)
+                current_size *= eta
+                continue
+            dominated = prune_levels(results, factors, prune_margin)
+            results.sort(key=lambda row: -row['gflops'])
+            kept = [row for row in results if not any(row[f] in dominated[f] for f in factors)]
+            if len(kept) < nb_confirmations:  # the best ones of the pruned candidates fill the gap
+                kept += [row for row in results if row not in kept][:nb_confirmations - len(kept)]
+            nb_kept = max(nb_confirmations, len(kept)//eta)
+            candidates = [{f: row[f] for f in factors} for row in kept[:nb_kept]]
+            logger.info('Screening with N=%d: %d configurations, kept %d (dominated levels: %s)' % (
+                current_size, len(configurations), len(candidates),
+                ', '.join('%s=%s' % (f, sorted(lev)) for f, lev in dominated.items() if lev) or 'none'))
+            history.append({'size': current_size, 'nb_configurations': len(configurations),
+                            'nb_kept': len(candidates)})
+            current_size *= eta
+        confirmations = [dict(cand, size=size, **common) for cand in candidates]
+        results = []
+        for _ in range(nb_confirmations):  # a batch runs each distinct configuration once
+            results += run_batch(job, confirmations, ranks_per=ranks_per, cores_per_rank=cores_per_rank)[0]
+    by_candidate = collections.defaultdict(list)
+    for row in results:
+        by_candidate[tuple(row[f] for f in factors)].append(row['gflops'])
+    best, gflops = max(by_candidate.items(), key=lambda item: statistics.median(item[1]))
+    best = dict(zip(factors, best))
+    record = {
+        'configuration': best,
+        'gflops': statistics.median(gflops),
+        'size': size,
+        'proc_p': proc_p,
+        'proc_q': proc_q,
+        'nb_nodes': len(job.hostnames),
+        'ranks_per': ranks_per,
+        'date': datetime.date.today().isoformat(),
+        'screening': history,
+    }
+    cluster = get_cluster(job.hostnames[0])
+    logger.info('Best configuration for %s: %s (%.2f Gflops)' % (cluster, best, record['gflops']))
+    store_best_configuration(cluster, record, filename)
+    return record
+
+
+def node_memory(job):
+    '''Total memory of each node, in bytes.'''
+    output = job.nodes.run('grep MemTotal /proc/meminfo', hide_output=False)
+    return {node.host: int(res.stdout.split()[1])*1024 for node, res in output.items()}
+
+
+def remaining_walltime(job):
+    '''Remaining time of the job, in seconds.'''
+    stat = job.oarstat()
+    walltime = int(stat['walltime'])
+    start = int(stat.get('startTime') or 0)
+    if start <= 0:  # not started yet
+        return walltime
+    return start + walltime - time.time()
+
+
+def hpl_memory(size, block_size, proc_p, proc_q):
+    '''Memory used by the matrix on the most loaded rank, in bytes (block-cyclic distribution of a N x (N+1) matrix).'''
+    local_rows = math.ceil(math.ceil(size/block_size)/proc_p)*block_size
+    local_cols = math.ceil(math.ceil((size+1)/block_size)/proc_q)*block_size
+    return 8*local_rows*local_cols
+
+
+def hpl_duration(size, gflops):
+    return (2/3*size**3 + 2*size**2) / (gflops*1e9)
+
+
+ProblemSize = collections.namedtuple('ProblemSize', ['size', 'memory_per_node', 'available_memory', 'predicted_time',
+                                                     'remaining_walltime'])
+
+
+def check_problem_size(job, size, block_size, proc_p, proc_q, gflops=None, memory_fraction=0.8, efficiency=0.8,
+                       safety_margin=1.2, memory=None, walltime=None):
+    '''
+    Predict the memory usage and the duration of HPL for the given problem size, with the given peak performance of the
+    whole job (e.g. from estimate_peak) and the given efficiency of HPL. Raise a ValueError if the matrix would not fit
+    in memory_fraction of the memory of the nodes (i.e. the nodes would swap) or if the run would not finish before the
+    end of the job (with the given safety margin). Without gflops, the duration is not checked.
+    '''
+    memory = memory or min(node_memory(job).values())
+    nb_nodes = len(job.hostnames)
+    ranks_per_node = math.ceil(proc_p*proc_q/nb_nodes)
+    memory_per_node = hpl_memory(size, block_size, proc_p, proc_q)*ranks_per_node
+    predicted_time = hpl_duration(size, gflops*efficiency) if gflops else None
+    if memory_per_node > memory*memory_fraction:
+        raise ValueError('Problem size %d needs %.2f GB per node, more than %.0f%% of the %.2f GB of the nodes.' % (
+            size, memory_per_node*1e-9, memory_fraction*100, memory*1e-9))
+    if predicted_time is None:
+        return ProblemSize(size, memory_per_node, memory*memory_fraction, None, walltime)
+    walltime = walltime or remaining_walltime(job)
+    result = ProblemSize(size, memory_per_node, memory*memory_fraction, predicted_time, walltime)
+    if predicted_time*safety_margin > walltime:
+        raise ValueError('Problem size %d would take about %.0f seconds, the job ends in %.0f seconds.' % (
+            size, predicted_time, walltime))
+    return result
+
+
+def check_configurations(job, configurations, gflops=None):
+    '''
+    Check the problem sizes of the configurations with check_problem_size, so that an oversized problem is never
+    submitted. The duration is only checked with the peak performance gflops.
+    '''
+    memory = min(node_memory(job).values())
+    walltime = remaining_walltime(job) if gflops else None
+    for conf in configurations:
+        grids = list(zip(_as_list(conf['proc_p']), _as_list(conf['proc_q'])))
+        for size, block_size, (proc_p, proc_q) in itertools.product(_as_list(conf['size']),
+                                                                    _as_list(conf['block_size']), grids):
+            check_problem_size(job, size, block_size, proc_p, proc_q, gflops, memory=memory, walltime=walltime)
+
+
+def plan_problem_size(job, block_size, proc_p, proc_q, gflops=None, memory_fraction=0.8, efficiency=0.8,
+                      safety_margin=1.2):
+    '''
+    Largest problem size that fits in memory_fraction of the memory of the nodes, aligned on block_size and on the
+    process grid, and whose predicted duration fits in the remaining walltime of the job.
+    '''
+    memory = min(node_memory(job).values())
+    walltime = remaining_walltime(job)
+    gflops = gflops or estimate_peak(job, use_cache=True)
+    nb_nodes = len(job.hostnames)
+    align = block_size*proc_p*proc_q//math.gcd(proc_p, proc_q)
+    size = int(math.sqrt(memory*memory_fraction*nb_nodes/8))
+    size -= size % align
+    max_time_size = int((walltime/safety_margin*gflops*efficiency*1e9*3/2)**(1/3))
+    size = min(size, max_time_size - max_time_size % align)
+    while size > 0:
+        try:
+            result = check_problem_size(job, size, block_size, proc_p, proc_q, gflops, memory_fraction, efficiency,
+                                        safety_margin, memory=memory, walltime=walltime)
+        except ValueError:
+            size -= align
+        else:
+            logger.info('Problem size %d: %.2f GB per node, about %.0f seconds' % (
+                size, result.memory_per_node*1e-9, result.predicted_time))
+            return result
+    raise ValueError('No problem size fits in the memory and the walltime of %s.' % job)
+
+
+def install_dgemm_test(job):
+    '''
+    Compile the dgemm_test kernel on the nodes, unless it has already been compiled for the same node image (same kernel
+    and same BLAS library).
+    '''
+    stamp = '$( (uname -rv; md5sum /tmp/lib/libopenblas.so dgemm_test.c) | md5sum)'
+    job.nodes.run('([ -f dgemm_test.c ] || wget %s -O dgemm_test.c) && '
+                  '([ -x dgemm_test ] && [ "$(cat dgemm_test.stamp 2> /dev/null)" = "%s" ] || '
+                  '(LD_LIBRARY_PATH=/tmp/lib gcc -DUSE_OPENBLAS ./dgemm_test.c -fopenmp -I /tmp/include '
+                  '/tmp/lib/libopenblas.so -O3 -o ./dgemm_test && echo "%s" > dgemm_test.stamp))' % (
+                      DGEMM_TEST_URL, stamp, stamp))
+
+
+PeakEstimate = collections.namedtuple('PeakEstimate', ['median', 'q1', 'q3', 'min', 'max', 'nb_measures'])
+
+
+def _load_peak_cache(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def measure_peak(job, matrix_size=8192, nb_cores=None, nb_measures=10, warmup=2, use_cache=False,
+                 cache_file=PEAK_CACHE_FILE, slow_threshold=0.05):
+    '''
+    Measure the dgemm performance of each node (in Gflops), with nb_measures runs done in a single remote command after
+    warmup runs that are discarded. Return a dictionary {hostname: PeakEstimate}. With use_cache=True, the results are
+    cached per node and per day in cache_file (a new call then measures nothing, do not use it to sample the
+    variability). A warning is issued for the nodes whose median is slow_threshold below the median of all the nodes.
+    '''
+    nb_cores = nb_cores or len(job.nodes.cores)
+    today = datetime.date.today().isoformat()
+    key = '%s/%d/%d' % (today, matrix_size, nb_cores)
+    cache = _load_peak_cache(cache_file) if use_cache else {}
+    result = {}
+    for host in job.hostnames:
+        if key in cache.get(host, {}):
+            result[host] = PeakEstimate(**cache[host][key])
+    if len(result) < len(job.hostnames):
+        install_dgemm_test(job)
+        arg = ' '.join([str(matrix_size)]*6)
+        cmd = 'for i in $(seq %d); do OMP_NUM_THREADS=%d LD_LIBRARY_PATH=/tmp/lib ./dgemm_test %s; done' % (
+            warmup + nb_measures, nb_cores, arg)
         all_output = job.nodes.run(cmd, hide_output=False)
-    except fabric.exceptions.GroupException:  # not installed yet
-        job.nodes.run('wget https://raw.githubusercontent.com/Ezibenroc/m2_internship_scripts/master/cblas_tests/dgemm_test.c')
-        job.nodes.run('LD_LIBRARY_PATH=/tmp/lib gcc -DUSE_OPENBLAS ./dgemm_test.c -fopenmp -I /tmp/include \
-                /tmp/lib/libopenblas.so -O3 -o ./dgemm_test')
-        all_output = job.nodes.run(cmd, hide_output=False)
-    gflops = []
-    for output in all_output.values():
-        time = float(output.stdout)
-        gflops.append(2*matrix_size**3/time * 1e-9)
-    return sum(gflops)
+        for node, output in all_output.items():
+            durations = [float(duration) for duration in output.stdout.split()][warmup:]
+            gflops = sorted(2*matrix_size**3/duration * 1e-9 for duration in durations)
+            half = len(gflops)//2
+            q1 = statistics.median(gflops[:max(half, 1)])
+            q3 = statistics.median(gflops[-max(half, 1):])
+            result[node.host] = PeakEstimate(statistics.median(gflops), q1, q3, gflops[0], gflops[-1], len(gflops))
+        if use_cache:
+            cache = _load_peak_cache(cache_file)
+            for host, estimate in result.items():
+                cache.setdefault(host, {})[key] = estimate._asdict()
+            with open(cache_file, 'w') as f:
+                json.dump(cache, f, indent=2, sort_keys=True)
+    reference = statistics.median(estimate.median for estimate in result.values())
+    for host, estimate in sorted(result.items()):
+        logger.info('[%s] dgemm: %.2f Gflops (IQR [%.2f, %.2f])' % (host, estimate.median, estimate.q1, estimate.q3))
+        if estimate.median < (1-slow_threshold)*reference:
+            logger.warning('Node %s is slow: %.2f Gflops, median of the nodes is %.2f Gflops' % (
+                host, estimate.median, reference))
+    return result
+
+
+def estimate_peak(job, matrix_size=8192, nb_cores=None, **kwargs):
+    '''Sum of the median dgemm performance of the nodes, in Gflops (see measure_peak for the per-node values).'''
+    return sum(estimate.median for estimate in measure_peak(job, matrix_size, nb_cores, **kwargs).values())
 
 
 if __name__ == '__main__':
@@ -166,7 +597,7 @@ if __name__ == '__main__':
     logger.info(str(job))
     logger.info('Node: %s' % job.hostnames[0])
     install(job)
-    run(job, size=30000, block_size=128, proc_p=2, proc_q=2)
+    run(job, ranks_per='socket', size=30000, block_size=128, proc_p=1, proc_q=2)
     job.oardel()
 
 HPL_MAKEFILE = '''
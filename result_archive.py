@@ -0,0 +1,237 @@
+import os
+import json
+import zlib
+import struct
+import collections
+import numpy
+import pandas
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Archive format for the results, an alternative to the zip archives.
+#
+# Layout of a file: a header (magic, version, codec), the compressed blocks, the compressed index (JSON) and a footer
+# with the position of the index. Each member is either a block of bytes or a table stored column by column (one block
+# per column), so a reader only decompresses the members and the columns it needs. The strings are dictionary-encoded
+# and the floats are stored as decimals (mantissa and exponent) when this is exact, which compresses much better.
+# The codec is zstd if the zstandard package is installed, zlib otherwise.
+MAGIC = b'CARC'
+VERSION = 1
+EXTENSION = '.carc'
+CODECS = ['zlib', 'zstd']
+HEADER = struct.Struct('<4sHB')  # magic, version, codec
+FOOTER = struct.Struct('<QQ4s')  # index offset, index length, magic
+
+
+def default_codec():
+    return 'zstd' if zstandard else 'zlib'
+
+
+def _check_codec(codec):
+    if codec not in CODECS:
+        raise ValueError('Unknown codec %s, expected one of %s.' % (codec, ', '.join(CODECS)))
+    if codec == 'zstd' and zstandard is None:
+        raise RuntimeError('The zstd codec requires the zstandard package.')
+
+
+def _compress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _smallest_int(values):
+    '''The integer columns are stored with the smallest type that can hold their values.'''
+    if len(values) == 0:
+        return values.astype(numpy.int8)
+    low, high = values.min(), values.max()
+    for dtype in [numpy.int8, numpy.int16, numpy.int32]:
+        info = numpy.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype)
+    return values.astype(numpy.int64)
+
+
+def _scale(values, exponents):
+    '''values * 10**exponents, with a single correctly rounded operation (10**k is exact for |k| <= 22).'''
+    powers = 10.0 ** numpy.abs(exponents)
+    return numpy.where(exponents >= 0, values * powers, values / powers)
+
+
+def _decimal(values, max_digits=15):
+    '''
+    Decimal representation of the floats, mantissas * 10**exponents with as few digits as possible in the mantissas,
+    if there is one that gives back exactly the same floats (e.g. for floats parsed from a CSV file). None otherwise.
+    '''
+    if not numpy.isfinite(values).all():
+        return None
+    magnitudes = numpy.zeros(len(values), dtype=numpy.int64)
+    nonzero = values != 0
+    magnitudes[nonzero] = numpy.floor(numpy.log10(numpy.abs(values[nonzero])))
+
+    def attempt(digits):
+        exponents = magnitudes - (digits - 1)
+        if len(values) and (exponents.min() < -22 or exponents.max() > 22):
+            return None
+        mantissas = numpy.rint(_scale(values, -exponents))
+        if not (_scale(mantissas, exponents) == values).all():
+            return None
+        return mantissas.astype(numpy.int64), exponents.astype(numpy.int8)
+
+    low, high = 1, max_digits
+    best = attempt(high)
+    while best is not None and low < high:  # with more digits, the representation stays exact
+        middle = (low + high) // 2
+        result = attempt(middle)
+        if result is None:
+            low = middle + 1
+        else:
+            best, high = result, middle
+    return best
+
+
+def _shuffle(array):
+    '''Bytes of the array, grouped by position in the items (all the first bytes, then all the second bytes...).'''
+    return array.view(numpy.uint8).reshape(-1, array.dtype.itemsize).T.tobytes()
+
+
+def _unshuffle(data, dtype):
+    dtype = numpy.dtype(dtype)
+    array = numpy.frombuffer(data, dtype=numpy.uint8).reshape(dtype.itemsize, -1).T.copy()
+    return array.view(dtype).ravel()
+
+
+class ArchiveWriter:
+    def __init__(self, filename, codec=None):
+        self.codec = codec or default_codec()
+        _check_codec(self.codec)
+        self.file = open(filename, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, CODECS.index(self.codec)))
+        self.index = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_block(self, data):
+        data = _compress(self.codec, data)
+        offset = self.file.tell()
+        self.file.write(data)
+        return [offset, len(data)]
+
+    def add_bytes(self, name, data):
+        self.index[name] = {'kind': 'bytes', 'size': len(data), 'block': self._write_block(data)}
+
+    def add_dataframe(self, name, dataframe):
+        columns = []
+        for column in dataframe.columns:
+            values = dataframe[column]
+            meta = {'name': str(column)}
+            decimal = _decimal(values.to_numpy(numpy.float64)) if pandas.api.types.is_float_dtype(values) else None
+            if decimal is not None:
+                mantissas, exponents = decimal
+                meta['exponents'] = self._write_block(_shuffle(exponents))
+                array = _smallest_int(mantissas)
+            elif pandas.api.types.is_bool_dtype(values) or pandas.api.types.is_float_dtype(values):
+                array = values.to_numpy()
+            elif pandas.api.types.is_integer_dtype(values):
+                meta['integer'] = True
+                array = _smallest_int(values.to_numpy())
+            else:  # dictionary encoding, the missing values have the code -1
+                codes, categories = pandas.factorize(values.astype(object))
+                meta['categories'] = [str(category) for category in categories]
+                array = _smallest_int(codes)
+            meta['dtype'] = array.dtype.str
+            meta['block'] = self._write_block(_shuffle(numpy.ascontiguousarray(array)))
+            columns.append(meta)
+        self.index[name] = {'kind': 'table', 'rows': len(dataframe), 'columns': columns}
+
+    def close(self):
+        if self.file.closed:
+            return
+        index = _compress(self.codec, json.dumps(self.index).encode())
+        offset = self.file.tell()
+        self.file.write(index)
+        self.file.write(FOOTER.pack(offset, len(index), MAGIC))
+        self.file.close()
+
+
+class Archive:
+    '''
+    Reader of an archive. It has the namelist and read methods of zipfile.ZipFile; the tables are read with the method
+    dataframe, only the requested columns are decompressed.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        magic, version, codec = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            self.file.close()
+            raise ValueError('%s is not an archive of version %d.' % (filename, VERSION))
+        self.codec = CODECS[codec]
+        _check_codec(self.codec)
+        self.file.seek(-FOOTER.size, os.SEEK_END)
+        offset, length, magic = FOOTER.unpack(self.file.read(FOOTER.size))
+        if magic != MAGIC:
+            self.file.close()
+            raise ValueError('%s is truncated.' % filename)
+        self.index = json.loads(self._read_block([offset, length]).decode(), object_pairs_hook=collections.OrderedDict)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def _read_block(self, block):
+        offset, length = block
+        self.file.seek(offset)
+        return _decompress(self.codec, self.file.read(length))
+
+    def namelist(self):
+        return list(self.index)
+
+    def is_table(self, name):
+        return self.index[name]['kind'] == 'table'
+
+    def read(self, name):
+        member = self.index[name]
+        if member['kind'] != 'bytes':
+            raise ValueError('%s is a table, use the method dataframe.' % name)
+        return self._read_block(member['block'])
+
+    def columns(self, name):
+        return [column['name'] for column in self.index[name]['columns']]
+
+    def dataframe(self, name, columns=None):
+        member = self.index[name]
+        if member['kind'] != 'table':
+            raise ValueError('%s is not a table.' % name)
+        result = collections.OrderedDict()
+        for meta in member['columns']:
+            if columns is not None and meta['name'] not in columns:
+                continue
+            values = _unshuffle(self._read_block(meta['block']), meta['dtype'])
+            if 'exponents' in meta:
+                exponents = _unshuffle(self._read_block(meta['exponents']), numpy.int8)
+                values = _scale(values.astype(numpy.float64), exponents.astype(numpy.int64))
+            elif 'categories' in meta:
+                categories = numpy.array(meta['categories'] + [None], dtype=object)
+                values = categories[values]  # the code -1 is the last category, None
+            elif meta.get('integer'):
+                values = values.astype(numpy.int64)
+            result[meta['name']] = values
+        return pandas.DataFrame(result, index=pandas.RangeIndex(member['rows']))
@@ -1,20 +1,23 @@
 import fabfile
+import walltime_predictor
+import pair_planner
 import random
-import itertools
 import collections
 import invoke
 
 
-def run_all(username, site, cluster, possible_node_id, nb_runs=None, deploy=True):
-    possible_nodes = ['%s-%d' % (cluster, node_id) for node_id in possible_node_id]
-    combinations = list(itertools.combinations(possible_nodes, 2))
-    nb_runs = nb_runs or len(combinations)
-    choices = random.sample(combinations, nb_runs)
+def run_all(username, site, cluster, possible_node_id=None, nb_runs=None, deploy=True):
+    pairs = pair_planner.plan_cluster(username, site, cluster, possible_node_id)
+    choices = pair_planner.select_pairs(pairs, nb_runs or len(pairs))
+    nb_runs = len(choices)
     failure_count = 0
     node_failure_count = collections.Counter()
     node_tentative_count = collections.Counter()
     deploy_str = '--deploy %s ' % deploy if deploy else ''
     script = 'python3 fabfile.py %s%s tocornebize jobid $OAR_JOB_ID' % (deploy_str, site)
+    predictor = walltime_predictor.WalltimePredictor()
+    walltime = predictor.walltime([cluster], deploy, default=fabfile.Time(minutes=15))
+    fabfile.logger.info('Walltime of the jobs: %s' % walltime)
     for i, (node1, node2) in enumerate(choices):
         node_tentative_count[node1] += 1
         node_tentative_count[node2] += 1
@@ -23,7 +26,7 @@ def run_all(username, site, cluster, possible_node_id, nb_runs=None, deploy=True
                 site=site,
                 username=username,
                 hostnames=[node1, node2],
-                walltime=fabfile.Time(minutes=15),
+                walltime=walltime,
                 immediate=False,
                 script=script,
                 deploy=deploy)
@@ -0,0 +1,74 @@
+import pandas
+import piecewise
+import extract_archive
+
+# SMPI overheads and the (calibration file, operation) they are fitted on. The blocking send overhead is fitted on the
+# Isend durations too, the calibration does not measure it separately.
+OVERHEADS = {
+    'smpi/os': ('exp/exp_Isend.csv', 'MPI_Isend'),
+    'smpi/ois': ('exp/exp_Isend.csv', 'MPI_Isend'),
+    'smpi/or': ('exp/exp_Recv.csv', 'MPI_Recv'),
+}
+
+PLATFORM_TEMPLATE = '''<?xml version='1.0'?>
+<!DOCTYPE platform SYSTEM "https://simgrid.org/simgrid.dtd">
+<platform version="4.1">
+<config>
+%(config)s
+</config>
+<cluster id="cluster" prefix="host-" suffix=".hpl" radical="0-%(last_host)d" core="%(cores)d" speed="%(speed)s"
+         bw="%(bandwidth)s" lat="%(latency)s" loopback_bw="%(loopback_bandwidth)s" loopback_lat="%(loopback_latency)s"/>
+</platform>
+'''
+
+
+def fit_overhead(df, max_breakpoints=5):
+    '''Piecewise linear model of the duration of an operation, on the cleaned calibration data.'''
+    df = extract_archive.clean_dataset(df)
+    breakpoints = piecewise.find_breakpoints(df.msg_size.values, df.duration.values, max_breakpoints=max_breakpoints)
+    return piecewise.fit_piecewise(df.msg_size.values, df.duration.values, breakpoints)
+
+
+def segments_to_config(segments):
+    '''Value of an SMPI piecewise option: "min_size:intercept:slope" for each segment, separated by ";".'''
+    values = []
+    for i, seg in enumerate(segments):
+        min_size = 0 if i == 0 else int(seg.min_x)
+        values.append('%d:%e:%e' % (min_size, max(seg.intercept, 0), max(seg.slope, 0)))
+    return ';'.join(values)
+
+
+def network_model(archives, max_breakpoints=5):
+    '''SMPI configuration of the overheads (smpi/os, smpi/ois and smpi/or), fitted on the given calibration archives.'''
+    data = {}
+    for archive in archives:
+        for name, df in extract_archive.extract_zip(archive).items():
+            data.setdefault(name, []).append(df)
+    config = {}
+    for option, (filename, op) in OVERHEADS.items():
+        if filename not in data:
+            continue
+        df = pandas.concat(data[filename], ignore_index=True)
+        config[option] = segments_to_config(fit_overhead(df[df.op == op], max_breakpoints))
+    return config
+
+
+def platform_xml(nb_hosts, cores=1, config=None, speed='1Gf', bandwidth='10Gbps', latency='2.4us',
+                 loopback_bandwidth='100Gbps', loopback_latency='0.1us'):
+    config = config or {}
+    props = '\n'.join('<prop id="%s" value="%s"/>' % (key, value) for key, value in sorted(config.items()))
+    return PLATFORM_TEMPLATE % {
+        'config': props,
+        'last_host': nb_hosts - 1,
+        'cores': cores,
+        'speed': speed,
+        'bandwidth': bandwidth,
+        'latency': latency,
+        'loopback_bandwidth': loopback_bandwidth,
+        'loopback_latency': loopback_latency,
+    }
+
+
+def hostfile(nb_ranks, ranks_per_host=1):
+    nb_hosts = (nb_ranks + ranks_per_host - 1) // ranks_per_host
+    return ''.join('host-%d.hpl\n' % host for host in range(nb_hosts) for _ in range(ranks_per_host))
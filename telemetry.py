@@ -0,0 +1,275 @@
+import os
+import hashlib
+import struct
+import tempfile
+import contextlib
+
+SAMPLER_DIR = '/tmp/telemetry'
+OUTPUT_FILE = 'telemetry.bin'
+MAGIC = b'TLM1'
+HEADER = struct.Struct('<4sIIIQ')  # magic, version, record size, capacity, number of records written
+RECORD = struct.Struct('<dfffQQQ')
+FIELDS = ['timestamp', 'cpu_busy', 'load', 'frequency', 'mem_available', 'rx_bytes', 'tx_bytes']
+
+SAMPLER_SOURCE = r'''
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
+#include <signal.h>
+#include <time.h>
+#include <unistd.h>
+#include <fcntl.h>
+
+struct header {
+    char magic[4];
+    uint32_t version, record_size, capacity;
+    uint64_t count;
+} __attribute__((packed));
+
+struct record {
+    double timestamp;               /* seconds since the epoch */
+    float cpu_busy;                 /* fraction of non-idle CPU time since the previous record */
+    float load;                     /* 1 minute load average */
+    float frequency;                /* mean current frequency of the cores, in MHz */
+    uint64_t mem_available;         /* in kB */
+    uint64_t rx_bytes, tx_bytes;    /* sum over all the network interfaces but lo */
+} __attribute__((packed));
+
+static volatile sig_atomic_t stop = 0;
+
+static void handler(int sig) {
+    stop = 1;
+}
+
+static double get_time(void) {
+    struct timespec t;
+    clock_gettime(CLOCK_REALTIME, &t);
+    return t.tv_sec + t.tv_nsec*1e-9;
+}
+
+static void cpu_times(uint64_t *busy, uint64_t *total) {
+    unsigned long long v[8] = {0};
+    *busy = *total = 0;
+    FILE *f = fopen("/proc/stat", "r");
+    if(!f)
+        return;
+    if(fscanf(f, "cpu %llu %llu %llu %llu %llu %llu %llu %llu", v, v+1, v+2, v+3, v+4, v+5, v+6, v+7) >= 5) {
+        for(int i = 0; i < 8; i++)
+            *total += v[i];
+        *busy = *total - v[3] - v[4];  /* idle and iowait */
+    }
+    fclose(f);
+}
+
+static float load(void) {
+    double value = 0;
+    FILE *f = fopen("/proc/loadavg", "r");
+    if(f) {
+        if(fscanf(f, "%lf", &value) != 1)
+            value = 0;
+        fclose(f);
+    }
+    return value;
+}
+
+static float frequency(long nb_cpus) {
+    char path[128], line[256];
+    double sum = 0, value;
+    int n = 0;
+    for(long cpu = 0; cpu < nb_cpus; cpu++) {
+        snprintf(path, sizeof(path), "/sys/devices/system/cpu/cpu%ld/cpufreq/scaling_cur_freq", cpu);
+        FILE *f = fopen(path, "r");
+        if(!f)
+            continue;
+        if(fscanf(f, "%lf", &value) == 1) {
+            sum += value / 1000;
+            n++;
+        }
+        fclose(f);
+    }
+    if(n == 0) {  /* no cpufreq, using /proc/cpuinfo */
+        FILE *f = fopen("/proc/cpuinfo", "r");
+        if(!f)
+            return 0;
+        while(fgets(line, sizeof(line), f))
+            if(sscanf(line, "cpu MHz : %lf", &value) == 1) {
+                sum += value;
+                n++;
+            }
+        fclose(f);
+    }
+    return n ? sum / n : 0;
+}
+
+static uint64_t mem_available(void) {
+    char line[256];
+    unsigned long long value = 0;
+    FILE *f = fopen("/proc/meminfo", "r");
+    if(!f)
+        return 0;
+    while(fgets(line, sizeof(line), f))
+        if(sscanf(line, "MemAvailable: %llu", &value) == 1)
+            break;
+    fclose(f);
+    return value;
+}
+
+static void network(uint64_t *rx, uint64_t *tx) {
+    char line[512];
+    unsigned long long r, t;
+    *rx = *tx = 0;
+    FILE *f = fopen("/proc/net/dev", "r");
+    if(!f)
+        return;
+    while(fgets(line, sizeof(line), f)) {
+        char *sep = strchr(line, ':'), *name = line;
+        if(!sep)
+            continue;
+        *sep = '\0';
+        while(*name == ' ')
+            name++;
+        if(!strcmp(name, "lo"))
+            continue;
+        if(sscanf(sep+1, "%llu %*u %*u %*u %*u %*u %*u %*u %llu", &r, &t) == 2) {
+            *rx += r;
+            *tx += t;
+        }
+    }
+    fclose(f);
+}
+
+/* Samples the node every <interval> seconds, in a ring buffer of <capacity> records, until it receives SIGTERM or
+ * SIGINT, or after <max_duration> seconds. */
+int main(int argc, char *argv[]) {
+    if(argc != 5) {
+        fprintf(stderr, "Syntax: %s <output> <interval> <capacity> <max_duration>\n", argv[0]);
+        return 1;
+    }
+    double interval = atof(argv[2]), max_duration = atof(argv[4]);
+    struct header header = {{'T', 'L', 'M', '1'}, 1, sizeof(struct record), atoi(argv[3]), 0};
+    long nb_cpus = sysconf(_SC_NPROCESSORS_CONF);
+    int fd = open(argv[1], O_RDWR | O_CREAT | O_TRUNC, 0644);
+    if(fd < 0 || ftruncate(fd, sizeof(header) + (off_t)header.capacity*sizeof(struct record)) < 0) {
+        perror(argv[1]);
+        return 1;
+    }
+    signal(SIGTERM, handler);
+    signal(SIGINT, handler);
+    struct timespec delay = {(time_t)interval, (long)((interval - (time_t)interval)*1e9)};
+    uint64_t busy, total, prev_busy, prev_total;
+    cpu_times(&prev_busy, &prev_total);
+    double start = get_time();
+    while(!stop && get_time() - start < max_duration) {
+        struct record rec;
+        uint64_t rx, tx;
+        cpu_times(&busy, &total);
+        rec.timestamp = get_time();
+        rec.cpu_busy = total > prev_total ? (double)(busy - prev_busy) / (total - prev_total) : 0;
+        rec.load = load();
+        rec.frequency = frequency(nb_cpus);
+        rec.mem_available = mem_available();
+        network(&rx, &tx);
+        rec.rx_bytes = rx;
+        rec.tx_bytes = tx;
+        prev_busy = busy;
+        prev_total = total;
+        off_t offset = sizeof(header) + (off_t)(header.count % header.capacity)*sizeof(rec);
+        header.count++;
+        if(pwrite(fd, &rec, sizeof(rec), offset) != sizeof(rec) || pwrite(fd, &header, sizeof(header), 0) < 0) {
+            perror(argv[1]);
+            return 1;
+        }
+        nanosleep(&delay, NULL);
+    }
+    close(fd);
+    return 0;
+}
+'''
+SAMPLER_BINARY = 'sampler_%s' % hashlib.sha1(SAMPLER_SOURCE.encode()).hexdigest()[:12]  # rebuilt on a new source
+
+
+def decode(data):
+    '''DataFrame of the records of a telemetry file (the content of the ring buffer, in chronological order).'''
+    import numpy
+    import pandas
+    magic, version, record_size, capacity, count = HEADER.unpack_from(data)
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError('Not a telemetry file (magic %r, record size %d).' % (magic, record_size))
+    dtype = numpy.dtype([('timestamp', '<f8'), ('cpu_busy', '<f4'), ('load', '<f4'), ('frequency', '<f4'),
+                         ('mem_available', '<u8'), ('rx_bytes', '<u8'), ('tx_bytes', '<u8')])
+    records = numpy.frombuffer(data, dtype=dtype, count=min(count, capacity), offset=HEADER.size)
+    if count > capacity:  # the buffer has wrapped, the oldest record is the next one to be overwritten
+        records = numpy.roll(records, -(count % capacity))
+    df = pandas.DataFrame(records)
+    elapsed = df.timestamp.diff()
+    for column in ['rx', 'tx']:
+        df['%s_rate' % column] = df['%s_bytes' % column].astype(float).diff() / elapsed
+    df['timestamp'] = pandas.to_datetime(df.timestamp, unit='s')
+    return df
+
+
+class Sampler:
+    '''
+    Sampling of the CPU usage and frequency, load, available memory and network traffic of the nodes, every interval
+    seconds, in a ring buffer of capacity records (the oldest records are overwritten) on each node. The sampler stops
+    by itself after max_duration seconds. After a run, the attribute data holds the content of the ring buffer of each
+    node.
+    '''
+    def __init__(self, interval=0.1, capacity=100000, max_duration=24*3600):
+        if capacity < 1:
+            raise ValueError('The capacity must be at least one record, got %r.' % capacity)
+        self.interval = interval
+        self.capacity = capacity
+        self.max_duration = max_duration
+        self.data = {}
+
+    def install(self, job):
+        job.nodes.run('mkdir -p %s' % SAMPLER_DIR)
+        job.nodes.write_files(SAMPLER_SOURCE, os.path.join(SAMPLER_DIR, 'sampler.c'))
+        cmd = '[ -x %s ] || gcc -O2 -std=gnu99 sampler.c -o %s' % (SAMPLER_BINARY, SAMPLER_BINARY)
+        job.nodes.run(cmd, directory=SAMPLER_DIR)
+
+    def start(self, job):
+        self.install(job)
+        job.nodes.run('{ setsid nohup ./%s %s %f %d %d < /dev/null &> /dev/null & echo $! > sampler.pid; }' % (
+            SAMPLER_BINARY, OUTPUT_FILE, self.interval, self.capacity, self.max_duration), directory=SAMPLER_DIR)
+
+    def stop(self, job):
+        job.nodes.run('pid=$(cat sampler.pid) && kill $pid; while kill -0 $pid 2> /dev/null; do sleep 0.05; done',
+                      directory=SAMPLER_DIR)
+        tmp_file = tempfile.NamedTemporaryFile(dir='.')
+        for node in job.nodes:
+            node.get(os.path.join(SAMPLER_DIR, OUTPUT_FILE), tmp_file.name)
+            with open(tmp_file.name, 'rb') as f:
+                self.data[node.host] = f.read()
+        tmp_file.close()
+
+    @contextlib.contextmanager
+    def running(self, job):
+        self.start(job)
+        try:
+            yield self
+        finally:
+            self.stop(job)
+
+    def archive_files(self):
+        return {'telemetry/%s.bin' % host: data for host, data in self.data.items()}
+
+    def dataframe(self):
+        import pandas
+        result = []
+        for host, data in sorted(self.data.items()):
+            df = decode(data)
+            df['hostname'] = host
+            result.append(df)
+        return pandas.concat(result, ignore_index=True)
+
+
+@contextlib.contextmanager
+def sampling(job, sampler):
+    if sampler:
+        with sampler.running(job):
+            yield sampler
+    else:
+        yield None
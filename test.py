@@ -1,11 +1,46 @@
 import unittest
-from unittest.mock import MagicMock, call, PropertyMock
+import base64
+import hashlib
+from unittest.mock import MagicMock, call, PropertyMock, patch
 import collections
+import contextlib
 import datetime
+import time
 import fabric
 import json
+import re
 import random
 import fabfile
+import topology
+import numpy
+import piecewise
+import adaptive_calibration
+import itertools
+import real_hpl
+import hpl_output
+import dgemm
+import hpl
+import smpi_platform
+import validation
+import telemetry
+import extract_archive
+import zipfile
+import subprocess
+import sys
+import calibration_summary
+import result_archive
+import information_store
+import comparison
+import bootstrap
+import walltime_predictor
+import pair_planner
+import benchmark_profile
+import benchmark_analysis
+import collective_calibration
+import shutil
+import tempfile
+import os
+import pandas
 
 
 def build_cmd(cmd):
@@ -82,5 +117,1084 @@ class RunTest(Util):
         self.job.connection.run.assert_called_once_with('foo bar &> /dev/null', hide=True)
 
 
+class TopologyTest(unittest.TestCase):
+    xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<topology>
+  <object type="Machine" os_index="0">
+    %s
+  </object>
+</topology>
+'''
+    package = '''<object type="Package" os_index="%d">
+      <object type="NUMANode" os_index="%d">
+        <object type="L3Cache">%s</object>
+      </object>
+    </object>'''
+    core = '<object type="Core"><object type="PU" os_index="%d"/><object type="PU" os_index="%d"/></object>'
+
+    def build_topology(self, nb_packages, nb_cores):
+        packages = []
+        for pkg in range(nb_packages):
+            cores = [self.core % (pkg*nb_cores + i, nb_packages*nb_cores + pkg*nb_cores + i) for i in range(nb_cores)]
+            packages.append(self.package % (pkg, pkg, ''.join(cores)))
+        return topology.Topology.from_xml(self.xml % ''.join(packages))
+
+    def test_parse(self):
+        topo = self.build_topology(2, 4)
+        self.assertEqual(topo.core_pus, [[i, i+8] for i in range(8)])
+        self.assertEqual([core.numa for core in topo.cores], [0]*4 + [1]*4)
+        self.assertEqual(topo, topology.Topology.from_dict(topo.to_dict()))
+
+    def test_placement(self):
+        topo = self.build_topology(2, 4)
+        placement = topo.placement('node')
+        self.assertEqual(placement.ranks, [list(range(8))])
+        placement = topo.placement('numa', cores_per_rank=2)
+        self.assertEqual(placement.ranks, [[0, 1], [2, 3], [4, 5], [6, 7]])
+        self.assertEqual(placement.nb_ranks(3), 12)
+        self.assertIn('--map-by ppr:2:numa:PE=2', placement.mpirun_options())
+        placement = topo.placement('node', cores_per_rank=1, ranks_per_domain=1)
+        self.assertEqual(placement.ranks, [[0]])
+        self.assertIn('--map-by ppr:1:node:PE=1', placement.mpirun_options())
+        with self.assertRaises(ValueError):
+            topo.placement('socket', cores_per_rank=2, ranks_per_domain=3)
+        with self.assertRaises(ValueError):
+            topo.placement('socket', cores_per_rank=5)
+        with self.assertRaises(ValueError):
+            topo.placement('core')
+
+    def build_nodes(self, cache_dir, model, calls):
+        xml = self.xml % (self.package % (0, 0, self.core % (0, 1)))
+
+        def run(command, **kwargs):
+            calls.append(command)
+            if 'lstopo' in command:
+                return MagicMock(stdout=xml)
+            if 'model name' in command:
+                return MagicMock(stdout='0-1\nmodel name\t: %s\n' % model)
+            return MagicMock(stdout='')
+        connections = []
+        for host in ['paravance-1', 'paravance-2']:
+            cxn = MagicMock()
+            cxn.host = host
+            cxn.run.side_effect = run
+            connections.append(cxn)
+        nodes = fabfile.Nodes(connections, name='allnodes', working_dir='/tmp')
+        nodes.topology_cache = topology.TopologyCache(cache_dir)
+        return nodes
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for model, nb_lstopo in [('E5-2630', 2), ('E5-2630', 0), ('E5-2660', 2)]:
+                calls = []
+                nodes = self.build_nodes(tmp_dir, model, calls)
+                self.assertEqual(nodes.topology.core_pus, [[0, 1]])
+                self.assertEqual(sum('lstopo' in command for command in calls), nb_lstopo)
+            calls.clear()
+            nodes.refresh_topology()
+            self.assertEqual(sum('lstopo' in command for command in calls), 2)
+
+    def test_calibration_mapping(self):
+        topo = self.build_topology(2, 4)
+        job = MagicMock()
+        job.nodes.placement.side_effect = topo.placement
+        job.nodes.__iter__.return_value = iter([MagicMock(host='a'), MagicMock(host='b')])
+        fabfile.calibrate(job, '<config/>')
+        command = job.director.run.call_args[0][0]
+        self.assertIn('--map-by ppr:1:node:PE=1', command)  # one rank on each of the two nodes
+        self.assertIn('-np 2 -host a,b', command)
+
+    @unittest.skipUnless(shutil.which('mpirun'), 'MPI is not installed')
+    def test_calibration_map(self):
+        topo = self.build_topology(2, 4)
+        job = MagicMock()
+        job.nodes.placement.side_effect = topo.placement
+        job.nodes.__iter__.return_value = iter([MagicMock(host='a'), MagicMock(host='b')])
+        fabfile.calibrate(job, '<config/>')
+        options = job.director.run.call_args[0][0].split('--allow-run-as-root ')[1].split(' -np')[0]
+        options = options.replace('--bind-to core', '--bind-to none')  # the binding depends on the local machine
+        # Open MPI prints the map of the ranks on the two (fake) 8-core nodes, then fails to launch them
+        result = subprocess.run('mpirun --allow-run-as-root --do-not-launch --display-map %s -np 2 -host a:8,b:8 true'
+                                % options, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60)
+        nb_procs = re.findall(r'Data for node: (\w+)\s.*Num procs: (\d+)', result.stdout.decode())
+        self.assertEqual(nb_procs, [('a', '1'), ('b', '1')])
+
+    def test_cluster(self):
+        self.assertEqual(fabfile.get_cluster('taurus-3.lyon.grid5000.fr'), 'taurus')
+        self.assertEqual(fabfile.get_cluster('lyon'), 'lyon')
+
+
+class BenchmarkProfileTest(unittest.TestCase):
+    state = {'governor': 'powersave', 'min_freq': '1200000', 'max_freq': '2400000', 'turbo': '1', 'thp': 'always'}
+
+    def build_job(self):
+        output = '\n'.join('%s=%s' % item for item in self.state.items())
+        job = MagicMock()
+        job.deploy = True
+        job.nodes.hyperthreads = [8, 9]
+        job.nodes.run.return_value = {MagicMock(host='a'): MagicMock(stdout='%s\n---\n%s\n' % (output, output))}
+        return job
+
+    def test_apply(self):
+        job = self.build_job()
+        profile = benchmark_profile.BenchmarkProfile(hyperthreading=False, cstate_limit=1)
+        before, after = profile.apply(job)
+        self.assertEqual(before, {'a': self.state})
+        script = base64.b64decode(job.nodes.run.call_args[0][0].split()[1]).decode()
+        self.assertIn('scaling_governor; do set_value $f performance; done', script)
+        self.assertIn('set_value $f $((i > 1))', script)
+        self.assertTrue(script.rstrip().endswith('set_value $cpu/cpu9/online 0\nstate'))
+        job = self.build_job()
+        benchmark_profile.BenchmarkProfile(hyperthreading=True).apply(job)
+        script = base64.b64decode(job.nodes.run.call_args[0][0].split()[1]).decode()
+        self.assertLess(script.index('set_value $cpu/cpu9/online 1'), script.index('set_value $f performance'))
+        job = self.build_job()
+        benchmark_profile.BenchmarkProfile().apply(job)
+        self.assertNotIn('online 0', base64.b64decode(job.nodes.run.call_args[0][0].split()[1]).decode())
+
+    def test_check(self):
+        profile = benchmark_profile.BenchmarkProfile(turbo=False)
+        with self.assertLogs(fabfile.logger, 'WARNING') as logs:
+            profile.check(self.build_job(), {'a': self.state})
+        self.assertEqual(len(logs.output), 3)  # governor, frequency and turbo
+
+    def test_restore(self):
+        profile = benchmark_profile.BenchmarkProfile()
+        profile.restore = MagicMock()
+        profile.apply = MagicMock(side_effect=fabric.exceptions.GroupException({}))
+        with self.assertRaises(fabric.exceptions.GroupException):
+            with profile.applied(self.build_job()):
+                pass
+        profile.restore.assert_called_once()
+
+
+class BenchmarkAnalysisTest(unittest.TestCase):
+    def test_scale(self):
+        df = pandas.DataFrame({'index': [0, 1, 2], 'duration': [1., 2., 3.]})
+        scaled = benchmark_analysis.scale_dataframe(df, 3)
+        self.assertEqual(list(scaled['index']), list(range(9)))
+        self.assertEqual(list(scaled.duration[:3]), [1, 2, 3])
+
+    def test_measure(self):
+        result = benchmark_analysis.measure(lambda: (10000,), lambda n: list(range(n)), repeat=2)
+        self.assertEqual(sorted(result), ['peak_rss', 'rss_increase', 'time'])
+        self.assertGreater(result['time'], 0)
+
+    def test_measure_error(self):
+        def fail(n):
+            raise KeyError(n)
+        with self.assertRaises(KeyError):
+            benchmark_analysis.measure(lambda: (1,), fail, repeat=1)
+        with self.assertRaises(ZeroDivisionError):
+            benchmark_analysis.measure(lambda: (1 / 0,), fail, repeat=1)
+        with self.assertRaises(RuntimeError):
+            benchmark_analysis.measure(lambda: (1,), os._exit, repeat=1)
+
+    def test_compare(self):
+        baseline = {'a': {'time': 1, 'peak_rss': 100}, 'b': {'time': 1, 'peak_rss': 100}}
+        results = {'a': {'time': 1.1, 'peak_rss': 100}, 'b': {'time': 1.5, 'peak_rss': 100}, 'c': {'time': 9}}
+        self.assertEqual(benchmark_analysis.compare(results, baseline, 0.2), [('b', 'time', 1.5)])
+
+    def test_no_archive(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(ValueError):
+                benchmark_analysis.benchmark_cases([tmp_dir])
+
+
+class PiecewiseTest(unittest.TestCase):
+    def test_breakpoints(self):
+        x = numpy.arange(1, 200, dtype=float)
+        y = numpy.where(x < 60, 1 + 0.01*x, numpy.where(x < 140, 5 + 0.05*x, 20 + 0.2*x))
+        y *= numpy.random.RandomState(42).lognormal(0, 0.01, len(x))
+        breakpoints = piecewise.find_breakpoints(x, y)
+        self.assertEqual(breakpoints, [60, 140])
+        segments = piecewise.fit_piecewise(x, y, breakpoints)
+        self.assertEqual(len(segments), 3)
+        for seg, slope in zip(segments, [0.01, 0.05, 0.2]):
+            self.assertAlmostEqual(seg.slope, slope, delta=slope*0.1)
+        self.assertTrue(numpy.allclose(piecewise.predict(segments, x), y, rtol=0.05))
+
+    def test_no_breakpoint(self):
+        x = numpy.arange(1, 100, dtype=float)
+        self.assertEqual(piecewise.find_breakpoints(x, 3 + 2*x), [])
+
+    def test_refine_sizes(self):
+        sizes = [1, 10, 100, 1000]
+        self.assertEqual(adaptive_calibration.refine_sizes(sizes, [1000], nb_points=2), [215, 464])
+        self.assertEqual(adaptive_calibration.refine_sizes(sizes, [11]), [])
+        job = MagicMock()
+        with self.assertRaises(ValueError):
+            adaptive_calibration.run_adaptive_calibration(job, max_rounds=0)
+        job.director.run.assert_not_called()
+
+    @staticmethod
+    def fake_round(job, round_id, sizes, iterations):
+        rows = []
+        for size in sizes:
+            duration = 1e-6 + size*1e-10 if size < 10000 else 5e-6 + size*2e-10
+            for filename in adaptive_calibration.MODEL_FILES:
+                rows.extend((filename, 'MPI_Recv', size, duration) for _ in range(iterations))
+        df = pandas.DataFrame(rows, columns=['type', 'op', 'msg_size', 'duration'])
+        df['round'] = round_id
+        return df
+
+    def test_round(self):
+        job = MagicMock()
+        with patch.object(adaptive_calibration, 'calibrate'), \
+                patch.object(adaptive_calibration, 'read_csvs', return_value=pandas.DataFrame({'duration': [1.]})):
+            adaptive_calibration.run_round(job, 2, [1, 10], 3)
+        self.assertIn('rm -f /tmp/round_2.zip && zip -r /tmp/round_2.zip', job.director.run.call_args[0][0])
+
+    def test_adaptive_calibration(self):
+        rounds = MagicMock(side_effect=self.fake_round)
+        with patch.object(adaptive_calibration, 'run_round', rounds), \
+                patch.object(adaptive_calibration, 'merge_rounds'), \
+                patch.object(adaptive_calibration, 'archive_calibration') as archive:
+            adaptive_calibration.run_adaptive_calibration(MagicMock(), nb_initial_sizes=20, max_rounds=8)
+        self.assertTrue(1 < rounds.call_count < 8)
+        first_sizes = rounds.call_args_list[0][0][2]
+        for round_call in rounds.call_args_list[1:]:  # only the new sizes, around the breakpoint
+            self.assertTrue(set(round_call[0][2]).isdisjoint(first_sizes))
+            self.assertTrue(all(1000 < size < 100000 for size in round_call[0][2]))
+        report = archive.call_args[0][3]['adaptive.yaml']
+        self.assertEqual(len(report['rounds']), rounds.call_count)
+        self.assertEqual(report['rounds'][-1]['noisy_sizes'], 0)
+        for breakpoints in report['breakpoints'].values():
+            self.assertEqual(len(breakpoints), 1)
+            self.assertAlmostEqual(breakpoints[0], 10000, delta=500)
+
+    def test_sequential_calibration(self):
+        rng = numpy.random.RandomState(0)
+
+        def fake_round(job, round_id, sizes, iterations):
+            df = self.fake_round(job, round_id, sizes, iterations)
+            df['duration'] *= numpy.where(df.msg_size == 100, rng.lognormal(0, 1, len(df)), 1)  # too noisy
+            return df
+
+        @contextlib.contextmanager
+        def profile_applied(job, profile):
+            yield {'profile': profile}
+        rounds = MagicMock(side_effect=fake_round)
+        with patch.object(adaptive_calibration, 'run_round', rounds), \
+                patch.object(adaptive_calibration, 'profile_applied', profile_applied), \
+                patch.object(adaptive_calibration, 'merge_rounds'), \
+                patch.object(adaptive_calibration, 'archive_calibration') as archive:
+            _, report = adaptive_calibration.run_sequential_calibration(MagicMock(), sizes=[1, 10, 100],
+                                                                        min_iterations=3, max_iterations=8,
+                                                                        profile='fixed')
+        self.assertEqual([round_call[0][2] for round_call in rounds.call_args_list],
+                         [[1, 10, 100], [1, 10, 100], [100], [100]])  # 4 iterations for the precise sizes
+        self.assertEqual(report['iterations_per_size'], {1: 4, 10: 4, 100: 8})
+        self.assertEqual(report['capped_sizes'], 1)
+        self.assertEqual(sorted(archive.call_args[0][3]), ['profile.yaml', 'sequential.yaml'])
+        self.assertEqual(archive.call_args[0][3]['profile.yaml'], {'profile': 'fixed'})
+
+    def test_sequential_report(self):
+        report = adaptive_calibration.sequential_report({1: 4, 10: 4, 100: 20}, max_iterations=20, fixed_iterations=5)
+        self.assertEqual(report['iterations'], 28)
+        self.assertEqual(report['fixed_iterations'], 15)
+        self.assertEqual(report['saved_iterations'], -13)
+        self.assertEqual(report['capped_sizes'], 1)
+
+
+class HPLTest(unittest.TestCase):
+    def test_generate_lists(self):
+        content = real_hpl.generate_hpl_file(size=[1000, 2000], block_size=128, proc_p=[1, 2], proc_q=[4, 2],
+                                             bcast=[0, 1, 2])
+        lines = [line.split() for line in content.split('\n')]
+        self.assertEqual(lines[4][0], '2')
+        self.assertEqual(lines[5][:2], ['1000', '2000'])
+        self.assertEqual(lines[10][:2], ['1', '2'])
+        self.assertEqual(lines[11][:2], ['4', '2'])
+        self.assertEqual(lines[21][:4], ['3', '#', 'of', 'broadcast'])
+        self.assertEqual(lines[22][:3], ['0', '1', '2'])
+
+    def test_pack(self):
+        configurations = [dict(size=10000, block_size=nb, proc_p=2, proc_q=2, bcast=bcast, pfact=pfact, depth=depth)
+                          for nb, bcast, pfact, depth in itertools.product([32, 64, 128], range(6), range(3), range(2))]
+        batches = real_hpl.pack_configurations(configurations)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0]['bcast'], list(range(6)))
+        batches = real_hpl.pack_configurations(configurations[1:])
+        self.assertEqual(len(batches), 4)
+        self.assertEqual(sum(len(batch['block_size'])*len(batch['bcast'])*len(batch['pfact'])*len(batch['depth'])
+                             for batch in batches), len(configurations) - 1)
+        batches = real_hpl.pack_configurations([dict(size=1000*i, block_size=64, proc_p=1, proc_q=1)
+                                                for i in range(1, 46)])
+        self.assertEqual([len(batch['size']) for batch in batches], [20, 20, 5])
+        with self.assertRaises(ValueError):
+            real_hpl.pack_configurations(configurations, max_batch=0)
+
+    def test_run_batch_grids(self):
+        job = MagicMock()
+        job.hostnames = ['dahu-1']
+        job.nodes.placement.return_value = topology.Placement('node', 8, 1, [[i] for i in range(8)])
+        job.director.run_unique.return_value = MagicMock(stdout='')
+        job.nodes.run.return_value = {MagicMock(host='dahu-1'): MagicMock(stdout='MemTotal: 100000000 kB')}
+        configurations = [dict(size=10000, block_size=64, proc_p=2, proc_q=2),
+                          dict(size=10000, block_size=128, proc_p=2, proc_q=4)]
+        real_hpl.run_batch(job, configurations)  # the batch with only the 2x2 grid uses 4 of the 8 ranks
+        self.assertEqual(job.director.run_unique.call_count, len(real_hpl.pack_configurations(configurations)))
+        with self.assertRaises(ValueError):
+            real_hpl.run_batch(job, configurations[:1])
+
+    def test_parse(self):
+        output = '''
+T/V                N    NB     P     Q               Time                 Gflops
+--------------------------------------------------------------------------------
+WR00L2L2       30000   128     2     2             123.45              1.458e+02
+--------------------------------------------------------------------------------
+||Ax-b||_oo/(eps*(||A||_oo*||x||_oo+||b||_oo)*N)=        0.0066420 ...... PASSED
+T/V                N    NB     P     Q               Time                 Gflops
+--------------------------------------------------------------------------------
+Thu Jun 14 10:00:00 2018<stdout>:WR13R2C4       30000   256     2     2             100.00              1.800e+02
+'''
+        result = real_hpl.parse_hpl(output)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0]['gflops'], 145.8)
+        self.assertEqual((result[1]['depth'], result[1]['bcast'], result[1]['rfact'], result[1]['pfact']), (1, 3, 2, 1))
+        self.assertEqual(result[0]['passed'], True)
+        self.assertIsNone(result[1]['passed'])
+        self.assertEqual(real_hpl.parse_hpl('no result'), [])
+
+    def test_prune_levels(self):
+        results = [{'bcast': bcast, 'depth': depth, 'gflops': 100 - 10*(bcast == 2) + depth}
+                   for bcast in range(3) for depth in range(2)]
+        dominated = real_hpl.prune_levels(results, ['bcast', 'depth'], margin=0.05)
+        self.assertEqual(dominated, {'bcast': {2}, 'depth': set()})
+
+    def test_autotune_confirmations(self):
+        runs = collections.Counter()
+
+        def run_batch(job, configurations, **kwargs):  # one run per distinct configuration, as xhpl
+            rows = []
+            for batch in real_hpl.pack_configurations(configurations):
+                for block_size, bcast in itertools.product(batch['block_size'], batch['bcast']):
+                    runs[block_size, bcast] += 1
+                    rows.append({'block_size': block_size, 'bcast': bcast, 'gflops': block_size + bcast})
+            return rows, []
+        job = MagicMock()
+        job.hostnames = ['dahu-1.grenoble.grid5000.fr']
+        with tempfile.TemporaryDirectory() as tmp_dir, unittest.mock.patch.object(real_hpl, 'run_batch', run_batch):
+            record = real_hpl.autotune(job, 9000, 2, 2, levels={'block_size': [64, 128], 'bcast': [0, 1]},
+                                       nb_confirmations=4, filename=os.path.join(tmp_dir, 'best.json'))
+        self.assertEqual(record['configuration'], {'block_size': 128, 'bcast': 1})
+        self.assertEqual(dict(runs), {(64, 0): 4, (64, 1): 4, (128, 0): 4, (128, 1): 4})
+
+    def test_autotune_empty(self):
+        def run_batch(job, configurations, **kwargs):
+            self.assertTrue(configurations)
+            rows = []
+            for conf in configurations:
+                if (conf['block_size'], conf['bcast']) != (256, 2):  # this run failed, no result
+                    gflops = 1 + 10*(conf['block_size'] == 256) + 10*(conf['bcast'] == 2)
+                    rows.append({'block_size': conf['block_size'], 'bcast': conf['bcast'], 'gflops': gflops})
+            return rows, []
+        job = MagicMock()
+        job.hostnames = ['dahu-1.grenoble.grid5000.fr']
+        levels = {'block_size': [64, 128, 256], 'bcast': [0, 1, 2]}
+        with tempfile.TemporaryDirectory() as tmp_dir, unittest.mock.patch.object(real_hpl, 'run_batch', run_batch):
+            filename = os.path.join(tmp_dir, 'best.json')
+            # the levels 256 and 2 dominate, but their only combination has no result: nothing survives the pruning
+            record = real_hpl.autotune(job, 9000, 2, 2, levels=levels, nb_confirmations=2, filename=filename)
+            self.assertEqual(record['gflops'], 11)
+            self.assertEqual(record['screening'][0]['nb_kept'], 2)
+            # no block size fits the first screening size
+            record = real_hpl.autotune(job, 9000, 2, 2, levels=levels, screening_size=32, nb_confirmations=2,
+                                       filename=filename)
+            self.assertEqual(record['screening'][0]['size'], 96)
+
+    def test_hpl_memory(self):
+        self.assertEqual(real_hpl.hpl_memory(1024, 128, 1, 1), 8*1024*1152)
+        self.assertEqual(real_hpl.hpl_memory(1024, 128, 2, 2), 8*512*640)
+        self.assertAlmostEqual(real_hpl.hpl_duration(10000, 1), (2/3*1e12 + 2e8)*1e-9)
+
+    def problem_job(self):
+        job = MagicMock()
+        job.hostnames = ['dahu-1', 'dahu-2']
+        job.nodes.run.return_value = {MagicMock(host=host): MagicMock(stdout='MemTotal: 1000000 kB')
+                                      for host in job.hostnames}
+        job.oarstat.return_value = {'walltime': '3600', 'startTime': '0'}  # not started, 3600 seconds left
+        return job
+
+    def test_problem_size(self):
+        job = self.problem_job()
+        result = real_hpl.check_problem_size(job, 5000, 128, 2, 2, gflops=10)
+        self.assertEqual(result.memory_per_node, 2*8*2560*2560)  # two ranks per node
+        self.assertLess(result.predicted_time, 20)
+        with self.assertRaisesRegex(ValueError, 'GB per node'):
+            real_hpl.check_problem_size(job, 20000, 128, 2, 2)
+        with self.assertRaisesRegex(ValueError, 'seconds'):
+            real_hpl.check_problem_size(job, 5000, 128, 2, 2, gflops=0.01)
+        result = real_hpl.plan_problem_size(job, 128, 2, 2, gflops=10)
+        self.assertEqual(result.size, 14080)  # the largest multiple of 256 that fits in 80% of the memory
+        with self.assertRaises(ValueError):
+            real_hpl.check_problem_size(job, result.size + 256, 128, 2, 2, gflops=10)
+
+    def test_measure_peak(self):
+        job = MagicMock()
+        job.hostnames = ['dahu-1', 'dahu-2', 'dahu-3']
+        job.nodes.cores = list(range(32))
+        durations = {'dahu-1': [9, 9, 1, 2, 1, 2], 'dahu-2': [9, 9, 2, 1, 1, 2], 'dahu-3': [9, 9, 2, 2, 2, 4]}
+
+        def run(command, **kwargs):
+            if './dgemm_test 1000' not in command:  # the installation
+                return {}
+            self.assertIn('seq 6', command)
+            self.assertIn('OMP_NUM_THREADS=32', command)
+            return {MagicMock(host=host): MagicMock(stdout='\n'.join(map(str, values)))
+                    for host, values in durations.items()}
+        job.nodes.run.side_effect = run
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'cache.json')
+            with self.assertLogs(fabfile.logger, 'WARNING') as logs:
+                result = real_hpl.measure_peak(job, 1000, nb_measures=4, use_cache=True, cache_file=cache_file)
+            self.assertEqual(len(logs.output), 1)
+            self.assertIn('dahu-3 is slow', logs.output[0])
+            # 2 Gflops per second of run, the warmup runs (9 seconds) are dropped
+            self.assertEqual(result['dahu-1'], real_hpl.PeakEstimate(1.5, 1, 2, 1, 2, 4))
+            self.assertEqual(result['dahu-2'], result['dahu-1'])
+            self.assertEqual(result['dahu-3'].median, 1)
+            nb_calls = job.nodes.run.call_count
+            self.assertEqual(real_hpl.measure_peak(job, 1000, nb_measures=4, use_cache=True, cache_file=cache_file),
+                             result)
+            self.assertEqual(job.nodes.run.call_count, nb_calls)  # cache hit
+            durations['dahu-1'] = [9, 9, 2, 2, 2, 2]
+            self.assertEqual(real_hpl.estimate_peak(job, 1000, nb_measures=4, cache_file=cache_file), 3.5)
+            self.assertGreater(job.nodes.run.call_count, nb_calls)  # no cache by default
+            with open(cache_file) as f:
+                self.assertEqual(json.load(f)['dahu-1'][datetime.date.today().isoformat() + '/1000/32']['median'], 1.5)
+
+    def test_run_batch_size(self):
+        job = self.problem_job()
+        job.nodes.placement.return_value = topology.Placement('node', 2, 1, [[0], [1]])
+        job.director.run_unique.return_value = MagicMock(stdout='')
+        configurations = [dict(size=size, block_size=128, proc_p=2, proc_q=2) for size in [5000, 20000]]
+        with self.assertRaisesRegex(ValueError, 'Problem size 20000'):
+            real_hpl.run_batch(job, configurations)
+        job.director.run_unique.assert_not_called()
+        real_hpl.run_batch(job, configurations, check_size=False)
+        job.director.run_unique.assert_called()
+
+    def test_read_hpl(self):
+        output = '''
+Thu Jun 14 10:02:03 2018<stdout>:WR00L2L2       30000   128     2     2             123.45              1.458e+02
+Thu Jun 14 10:02:03 2018<stdout>:HPL_pdgesv() start time Thu Jun 14 10:00:00 2018
+Thu Jun 14 10:02:03 2018<stdout>:HPL_pdgesv() end time   Thu Jun 14 10:02:03 2018
+Thu Jun 14 10:02:03 2018<stdout>:Max aggregated wall time rfact . . . :               4.53
+Thu Jun 14 10:02:03 2018<stdout>:Max aggregated wall time up tr sv  . :               0.07
+Thu Jun 14 10:02:04 2018<stdout>:||Ax-b||_oo/(eps*(||A||_oo*||x||_oo+||b||_oo)*N)=        21.0066420 ...... FAILED
+Thu Jun  4 10:04:04 2018<stdout>:WC13R4C8       30000   256     1     4             100.00              1.800e+02
+'''
+        df = hpl_output.read_hpl(output)
+        self.assertEqual(len(df), 2)
+        self.assertFalse(df.passed[0])
+        self.assertTrue(pandas.isna(df.passed[1]))
+        self.assertEqual(df.time_rfact[0], 4.53)
+        self.assertEqual(df.time_up_tr_sv[0], 0.07)
+        self.assertEqual(df.end_time[0], datetime.datetime(2018, 6, 14, 10, 2, 3))
+        self.assertEqual(df.timestamp[1], datetime.datetime(2018, 6, 4, 10, 4, 4))
+        self.assertEqual(list(df.nbmin), [2, 8])
+
+
+class DgemmTest(unittest.TestCase):
+    def test_design(self):
+        design = dgemm.sweep_design(100, min_size=100, max_size=10000, nb_repeats=2)
+        self.assertEqual(design.shape, (200, 3))
+        self.assertTrue((design >= 100).all() and (design <= 10000).all())
+        for dim in range(3):  # latin hypercube: each of the 100 log-space strata is sampled (up to the rounding)
+            strata = numpy.floor((numpy.log10(design[:, dim]) - 2)/2*100).clip(0, 99)
+            self.assertGreaterEqual(len(set(strata)), 95)
+
+    def test_fit(self):
+        design = dgemm.sweep_design(100, min_size=10, max_size=5000)
+        df = pandas.DataFrame(design, columns=['m', 'n', 'k'])
+        df['duration'] = 2e-10*df.m*df.n*df.k + 1e-6
+        fit = dgemm.fit_node(df)
+        self.assertAlmostEqual(fit['coefficient']/2e-10, 1)
+        self.assertEqual(fit['breakpoints'], [])
+
+    def test_dtrsm_fit(self):
+        design = dgemm.sweep_design(100, min_size=10, max_size=5000)
+        df = pandas.DataFrame(design, columns=['m', 'n', 'k'])
+        df['duration'] = 1e-10*df.m*df.m*df.n + 1e-6
+        fit = dgemm.fit_node(df, operation='dtrsm')
+        self.assertAlmostEqual(fit['coefficient']/1e-10, 1)
+
+
+class SMPIHPLTest(unittest.TestCase):
+    def test_coefficients(self):
+        options = hpl.smpi_options(hpl.DEFAULT_COEFFICIENTS)
+        self.assertEqual(options, '-DSMPI_OPTIMIZATION -DSMPI_DGEMM_COEFFICIENT=2.445036e-10 '
+                                  '-DSMPI_DTRSM_COEFFICIENT=1.259681e-10')
+        self.assertNotEqual(hpl.coefficients_hash(hpl.DEFAULT_COEFFICIENTS),
+                            hpl.coefficients_hash({'dgemm': 1e-10, 'dtrsm': 1e-10}))
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'coefficients.json')
+            self.assertIsNone(hpl.load_coefficients('dahu', filename))
+            hpl.store_coefficients('dahu', {'dgemm': 1e-10, 'dtrsm': 2e-10}, filename)
+            hpl.store_coefficients('taurus', hpl.DEFAULT_COEFFICIENTS, filename)
+            self.assertEqual(hpl.load_coefficients('dahu', filename), {'dgemm': 1e-10, 'dtrsm': 2e-10})
+
+    def test_build_cache(self):
+        def build_job():
+            job = MagicMock()
+            job.director.run_unique.return_value = MagicMock(stdout='0123  simgrid.zip\n4567  hpl.zip\n')
+            job.director.get.side_effect = lambda origin, target: open(target, 'w').close()
+            return job
+        with tempfile.TemporaryDirectory() as cache_dir:
+            job = build_job()
+            hpl.build_hpl(job, hpl.DEFAULT_COEFFICIENTS, cache_dir)
+            self.assertIn('make SMPI_OPTS="%s"' % hpl.smpi_options(hpl.DEFAULT_COEFFICIENTS),
+                          job.nodes.run.call_args[0][0])
+            job.nodes.put.assert_not_called()
+            job = build_job()  # another job, with the same sources
+            hpl.build_hpl(job, hpl.DEFAULT_COEFFICIENTS, cache_dir)
+            self.assertFalse(any('make' in args[0] for args, kwargs in job.nodes.run.call_args_list))
+            cached = job.nodes.put.call_args[0][0]
+            self.assertTrue(cached.startswith(cache_dir))
+            self.assertEqual(job.nodes.put.call_args[0][1], '/tmp/hpl-master/bin/SMPI/xhpl')
+            job = build_job()
+            hpl.build_hpl(job, {'dgemm': 1e-10, 'dtrsm': 1e-10}, cache_dir)
+            job.nodes.put.assert_not_called()
+            job.director.run_unique.return_value = MagicMock(stdout='89ab  simgrid.zip\n4567  hpl.zip\n')
+            hpl.build_hpl(job, hpl.DEFAULT_COEFFICIENTS, cache_dir)  # a new version of SimGrid
+            job.nodes.put.assert_not_called()
+
+    def test_platform(self):
+        segments = [piecewise.Segment(0, 1000, 1e-6, 1e-10), piecewise.Segment(1448, 65535, -1e-6, 2e-10)]
+        self.assertEqual(smpi_platform.segments_to_config(segments),
+                         '0:1.000000e-06:1.000000e-10;1448:0.000000e+00:2.000000e-10')
+        self.assertEqual(smpi_platform.hostfile(5, 2).split(), ['host-0.hpl']*2 + ['host-1.hpl']*2 + ['host-2.hpl']*2)
+        files = hpl.simulation_files(dict(size=1000, block_size=128, proc_p=2, proc_q=4), {'smpi/or': '0:1e-6:0'}, 4)
+        self.assertIn('radical="0-1" core="4"', files['platform.xml'])
+        self.assertIn('<prop id="smpi/or" value="0:1e-6:0"/>', files['platform.xml'])
+        self.assertIn('-np 8 ', files['run.sh'])
+
+    def test_simulations(self):
+        configurations = [dict(size=size, block_size=128, proc_p=4, proc_q=4) for size in [1000, 8000, 2000, 4000]]
+        assignment = hpl.assign_simulations(configurations, ['a', 'b'])
+        self.assertEqual(assignment, {1: 'a', 3: 'b', 2: 'b', 0: 'b'})
+        output = '''slots=2
+### 1
+maxresident=1234
+wallclock=12.5
+WR00L2L2        8000   128     4     4              42.00              8.127e+00
+### 3
+Command terminated by signal 9
+maxresident=99
+wallclock=1.0
+'''
+        result = hpl.parse_simulations(output)
+        self.assertEqual(result[1], {'maxresident': 1234, 'wallclock': 12.5, 'simulated_time': 42.0, 'gflops': 8.127})
+        self.assertIsNone(result[3]['simulated_time'])
+
+    def test_no_result(self):
+        job = MagicMock()
+        job.nodes.run.return_value = {}
+        configurations = [dict(size=8000, block_size=128, proc_p=4, proc_q=4)]
+        with unittest.mock.patch.object(hpl, 'prepare_simulations'):
+            df = hpl.run_simulations(job, configurations)
+        self.assertEqual(len(df), 0)
+        self.assertIn('simulated_time', df.columns)
+
+
+class ValidationTest(unittest.TestCase):
+    def test_compare(self):
+        base = dict(size=10000, block_size=128, proc_p=2, proc_q=2, pfact=0, rfact=0, depth=0)
+        real = [dict(base, bcast=bcast, time=t, gflops=1) for bcast, t in [(0, 10), (0, 12), (0, 11), (1, 20)]]
+        simulated = [dict(base, bcast=bcast, time=t, gflops=1) for bcast, t in [(0, 9.9), (1, 25), (2, 30)]]
+        df = validation.compare(real, simulated)
+        self.assertEqual(len(df), 2)
+        self.assertEqual(list(df.real_nb_runs), [3, 1])
+        self.assertEqual(list(df.relative_error.round(2)), [-0.1, 0.25])
+        breakdown = validation.error_breakdown(df)
+        self.assertEqual(list(breakdown.parameter), ['bcast', 'bcast'])
+        self.assertEqual(list(breakdown.mean_abs_error.round(2)), [0.1, 0.25])
+        validation.report(df)
+        with self.assertLogs(fabfile.logger, 'WARNING'):
+            validation.report(validation.compare(real, [dict(simulated[0], size=20000)]))
+
+
+class CollectiveCalibrationTest(unittest.TestCase):
+    def test_command(self):
+        topo = TopologyTest().build_topology(2, 4)
+        job = MagicMock()
+        job.hostnames = ['a', 'b', 'c']
+        job.nodes.placement.side_effect = topo.placement
+        collective_calibration.run_collectives(job, ranks_per_node=2)
+        command = job.director.run.call_args[0][0]
+        self.assertIn('--map-by ppr:2:node:PE=1', command)
+        self.assertIn('-np 6 -host a:2,b:2,c:2 ./collectives exp zoo_sizes 0 1000000 5', command)
+
+    @unittest.skipUnless(shutil.which('mpicc') and shutil.which('mpirun'), 'MPI is not installed')
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, 'collectives.c'), 'w') as f:
+                f.write(collective_calibration.BENCHMARK_SOURCE)
+            with open(os.path.join(tmp_dir, 'sizes'), 'w') as f:
+                f.write('0\n8\n1000\n2000000\n')
+            os.mkdir(os.path.join(tmp_dir, 'exp'))
+            subprocess.check_call(['mpicc', '-O2', '-std=c99', 'collectives.c', '-o', 'collectives'], cwd=tmp_dir)
+            subprocess.check_call(['mpirun', '--allow-run-as-root', '--oversubscribe', '-np', '6', './collectives',
+                                   'exp', 'sizes', '0', '1000000', '2'], cwd=tmp_dir, timeout=60,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            archive_name = os.path.join(tmp_dir, 'exp_2020-01-01_1.zip')
+            with zipfile.ZipFile(archive_name, 'w') as archive:
+                for name in os.listdir(os.path.join(tmp_dir, 'exp')):
+                    archive.write(os.path.join(tmp_dir, 'exp', name), 'exp/' + name)
+            data = extract_archive.extract_zip(archive_name)
+        operations = ['Allgather', 'Allreduce', 'Alltoall', 'Barrier', 'Bcast', 'Contention', 'Reduce']
+        self.assertEqual(sorted(data), ['exp/exp_%s.csv' % op for op in operations])
+        self.assertEqual(list(data['exp/exp_Barrier.csv'].msg_size), [0, 0])  # once per iteration
+        for op in ['Allgather', 'Allreduce', 'Alltoall', 'Bcast', 'Reduce']:
+            df = data['exp/exp_%s.csv' % op]
+            self.assertEqual(set(df.op), {'MPI_%s' % op})
+            self.assertEqual(sorted(df.msg_size), [0, 0, 8, 8, 1000, 1000])  # the sizes above max_size are ignored
+            self.assertTrue((df.duration > 0).all())
+        # 3 pairs of ranks: 1, 2 then 3 pairs at the same time, one line per pair, for each size and iteration
+        counts = data['exp/exp_Contention.csv'].groupby('op').size()
+        self.assertEqual(counts.to_dict(), {'PingPong_1pairs': 6, 'PingPong_2pairs': 12, 'PingPong_3pairs': 18})
+
+
+class JobGroupTest(unittest.TestCase):
+    def test_map(self):
+        jobs = ['job-%d' % i for i in range(4)]
+        group = fabfile.JobGroup(jobs)
+
+        def step(job, duration):
+            time.sleep(duration)
+            if job == 'job-2':
+                raise ValueError('node is down')
+            return job.upper()
+        start = time.time()
+        result = group.map(step, 0.2)
+        self.assertLess(time.time() - start, 0.6)  # concurrent, not 4*0.2 seconds
+        self.assertEqual(list(result.items()), [('job-0', 'JOB-0'), ('job-1', 'JOB-1'), ('job-3', 'JOB-3')])
+        self.assertEqual(list(group.failed), ['job-2'])
+        self.assertEqual(list(group), ['job-0', 'job-1', 'job-3'])
+        result = group.pipeline(lambda job: job[-1], lambda job: int(job[-1])*2)
+        self.assertEqual(result, {'job-0': ['0', 0], 'job-1': ['1', 2], 'job-3': ['3', 6]})
+
+    def test_job_log(self):
+        frontend = MagicMock()
+        jobs = [fabfile.Job(jobid, frontend) for jobid in [1, 2]]
+
+        def step(job):
+            for i in range(3):
+                fabfile.logger.info('command %d of %s' % (i, job))
+                time.sleep(0.05)
+        fabfile.JobGroup(jobs).map(step)
+        for job in jobs:
+            lines = job.log_stream.getvalue().splitlines()
+            self.assertEqual([line.split('] ')[-1] for line in lines], ['command %d of %s' % (i, job) for i in range(3)])
+        fabfile.logger.info('outside of the group')
+        self.assertNotIn('outside', jobs[0].log_stream.getvalue())
+        self.assertIn('command 2 of Job(2)', fabfile.log_stream.getvalue())
+
+    def test_oarsub_clusters(self):
+        def oarsub_cluster(site, username, clusters, walltime, nb_nodes, **kwargs):
+            if site == 'lille':
+                raise ValueError('oarsub failed')
+            return '%s-%s' % (clusters[0], nb_nodes)
+        with unittest.mock.patch.object(fabfile.Job, 'oarsub_cluster', side_effect=oarsub_cluster):
+            group = fabfile.JobGroup.oarsub_clusters('alice', {'nancy': 'grvingt', 'lille': 'chifflet',
+                                                               'grenoble': 'dahu'}, fabfile.Time(hours=1), 4)
+        self.assertEqual(list(group), ['dahu-4', 'grvingt-4'])
+
+
+class StragglerTest(unittest.TestCase):
+    def build_nodes(self, behaviours, policy=None):
+        connections = []
+        for host, behaviour in behaviours.items():
+            cxn = MagicMock()
+            cxn.host = host
+            cxn.run.side_effect = behaviour
+            connections.append(cxn)
+        return fabfile.Nodes(connections, name='allnodes', working_dir='/tmp', timeout=10, policy=policy)
+
+    def test_abort(self):
+        nodes = self.build_nodes({'a': ['ok'], 'b': [TimeoutError('stuck')]})
+        with self.assertRaises(fabric.exceptions.GroupException):
+            nodes.run('hostname')
+        for cxn in nodes:
+            cxn.run.assert_called_once_with(build_cmd('hostname'), hide=True, timeout=10)
+
+    def test_drop(self):
+        nodes = self.build_nodes({'a': ['ok', 'ok'], 'b': [TimeoutError('stuck')], 'c': ['ok', 'ok']},
+                                 policy=fabfile.Drop())
+        dropped = []
+        nodes.drop_callbacks.append(dropped.extend)
+        result = nodes.run('hostname', timeout=5)
+        self.assertEqual(sorted(cxn.host for cxn in result), ['a', 'c'])
+        self.assertEqual(nodes.hostnames, ['a', 'c'])
+        self.assertEqual(dropped, ['b'])
+        self.assertEqual(len(nodes.run('hostname')), 2)
+
+    def test_no_timeout(self):
+        nodes = self.build_nodes({'a': ['ok']})
+        nodes.run('hostname', timeout=None)
+        next(iter(nodes)).run.assert_called_once_with(build_cmd('hostname'), hide=True)
+
+    def test_job_drop(self):
+        job = fabfile.Job(1, MagicMock())
+        nodes = self.build_nodes({'a': ['ok'], 'b': [TimeoutError('stuck')], 'c': ['ok', 'ok']})
+        job._Job__hostnames = ['a', 'b', 'c']
+        job._Job__nodes = nodes
+        nodes.drop_callbacks.append(job._Job__nodes_dropped)
+        job._Job__split_nodes()
+        self.assertEqual(job.orchestra.timeout, 10)
+        job.orchestra.policy = fabfile.Drop()
+        job.orchestra.timeout = 5
+        self.assertEqual(len(job.orchestra.run('hostname')), 1)
+        self.assertEqual(job.hostnames, ['a', 'c'])
+        self.assertEqual(job._Job__nodes.hostnames, ['a', 'c'])
+        self.assertEqual((job.director.hostnames, job.orchestra.hostnames), (['a'], ['c']))
+        self.assertEqual(job.orchestra.timeout, 5)
+        self.assertIsInstance(job.orchestra.policy, fabfile.Drop)
+        job.orchestra.run('hostname')  # the rebuilt orchestra still drops its hosts from the job
+        self.assertEqual(job._Job__nodes.hostnames, ['a', 'c'])
+
+    def test_retry(self):
+        nodes = self.build_nodes({'a': ['ok'], 'b': [TimeoutError('stuck'), 'ok']}, policy=fabfile.Retry(2))
+        result = nodes.run('hostname')
+        self.assertEqual(sorted(result.values()), ['ok', 'ok'])
+        nodes = self.build_nodes({'a': ['ok'], 'b': [TimeoutError('stuck')]*3},
+                                 policy=fabfile.Retry(2, then=fabfile.Drop()))
+        result = nodes.run('hostname')
+        self.assertEqual(list(result.values()), ['ok'])
+        self.assertEqual(nodes.hostnames, ['a'])
+
+
+class TelemetryTest(unittest.TestCase):
+    def build_file(self, capacity, nb_records):
+        data = bytearray(telemetry.HEADER.pack(telemetry.MAGIC, 1, telemetry.RECORD.size, capacity, nb_records))
+        data += bytes(capacity*telemetry.RECORD.size)
+        for i in range(nb_records):
+            offset = telemetry.HEADER.size + (i % capacity)*telemetry.RECORD.size
+            telemetry.RECORD.pack_into(data, offset, 1e9 + i, 0.5, 1.0, 2400, 1000, 100*i, 10*i)
+        return bytes(data)
+
+    def test_decode(self):
+        df = telemetry.decode(self.build_file(10, 4))
+        self.assertEqual(list(df.rx_bytes), [0, 100, 200, 300])
+        df = telemetry.decode(self.build_file(10, 25))  # wrapped buffer, only the last 10 records are kept
+        self.assertEqual(list(df.rx_bytes), [100*i for i in range(15, 25)])
+        self.assertEqual(list(df.rx_rate[1:]), [100]*9)
+        self.assertEqual(list(df.tx_rate[1:]), [10]*9)
+        with self.assertRaises(ValueError):
+            telemetry.decode(b'\0'*100)
+
+    def test_extract(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_name = os.path.join(tmp_dir, 'exp_2020-01-01_1.zip')
+            with zipfile.ZipFile(archive_name, 'w') as archive:
+                archive.writestr('telemetry/a.bin', self.build_file(10, 3))
+                archive.writestr('telemetry/b.bin', self.build_file(10, 2))
+            df = extract_archive.extract_telemetry(archive_name)
+            self.assertEqual(list(df.hostname), ['a']*3 + ['b']*2)
+            self.assertIn('telemetry', extract_archive.extract_zip(archive_name, with_telemetry=True))
+
+    def test_sampler(self):
+        with self.assertRaises(ValueError):  # the ring buffer of the sampler needs at least one record
+            telemetry.Sampler(capacity=0)
+        job = MagicMock()
+        telemetry.Sampler(capacity=10).start(job)
+        commands = [args[0] for args, kwargs in job.nodes.run.call_args_list]
+        self.assertIn('-o %s' % telemetry.SAMPLER_BINARY, commands[1])
+        self.assertIn('./%s telemetry.bin' % telemetry.SAMPLER_BINARY, commands[2])
+        source_hash = hashlib.sha1(telemetry.SAMPLER_SOURCE.encode()).hexdigest()[:12]
+        self.assertEqual(telemetry.SAMPLER_BINARY, 'sampler_%s' % source_hash)  # a stale sampler is never reused
+
+
+class CalibrationSummaryTest(unittest.TestCase):
+    def test_summarize(self):
+        rng = random.Random(42)
+        raw = pandas.DataFrame([('MPI_Recv', size, i*1e-3, 1e-6 + size*1e-10 + rng.expovariate(1e6))
+                                for i, size in enumerate(rng.choice([1, 10, 100, 1000]) for _ in range(2000))],
+                               columns=['op', 'msg_size', 'start', 'duration'])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.mkdir(os.path.join(tmp_dir, 'exp'))
+            raw.to_csv(os.path.join(tmp_dir, 'exp', 'exp_Recv.csv'), header=False, index=False)
+            with open(os.path.join(tmp_dir, 'summarize.py'), 'w') as f:
+                f.write(calibration_summary.SUMMARY_SCRIPT)
+            subprocess.check_call([sys.executable, 'summarize.py', 'exp', '0.5', '1'], cwd=tmp_dir,
+                                  stdout=subprocess.DEVNULL)
+            archive_name = os.path.join(tmp_dir, 'exp_2020-01-01_1.zip')
+            with zipfile.ZipFile(archive_name, 'w') as archive:
+                for name in os.listdir(os.path.join(tmp_dir, 'exp')):
+                    archive.write(os.path.join(tmp_dir, 'exp', name), 'exp/' + name)
+            summary = extract_archive.extract_summary(archive_name)['exp/exp_Recv.csv']
+            kept = extract_archive.extract_zip(archive_name)
+        self.assertEqual(list(kept), ['exp/exp_Recv.csv'])
+        self.assertEqual(kept['exp/exp_Recv.csv'].msg_size.nunique(), 2)
+        expected = raw.groupby('msg_size').duration
+        summary = summary.set_index('msg_size')
+        self.assertEqual(list(summary['count']), list(expected.count()))
+        for column, values in [('mean', expected.mean()), ('median', expected.median()),
+                               ('q90', expected.quantile(0.9)), ('std', expected.std())]:
+            numpy.testing.assert_allclose(summary[column], values, rtol=1e-6)
+        for size, histogram in summary.histogram.items():
+            self.assertEqual(sum(extract_archive.parse_histogram(histogram).values()), summary['count'][size])
+
+
+class ResultArchiveTest(unittest.TestCase):
+    def test_convert(self):
+        rng = random.Random(42)
+        lines = ''.join('MPI_Recv,%d,%f,%e\n' % (rng.choice([1, 10, 100]), i*1e-3, rng.expovariate(1e6))
+                        for i in range(1000))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            zip_name = os.path.join(tmp_dir, 'exp_2020-01-01_1.zip')
+            with zipfile.ZipFile(zip_name, 'w') as archive:
+                archive.writestr('exp/exp_Recv.csv', lines)
+                archive.writestr('info.yaml', 'deployment: debian9\n')
+                archive.writestr('exp/exp_Recv.summary.csv', 'op,msg_size,count,histogram\nMPI_Recv,1,0,\n')
+            expected = extract_archive.extract_zip(zip_name)
+            expected_summary = extract_archive.extract_summary(zip_name)
+            archive_name = extract_archive.convert_zip(zip_name, codec='zlib')
+            self.assertTrue(archive_name.endswith(result_archive.EXTENSION))
+            for name, df in extract_archive.extract_zip(archive_name).items():
+                pandas.testing.assert_frame_equal(df, expected[name], check_exact=True)
+            for name, df in extract_archive.extract_summary(archive_name).items():
+                pandas.testing.assert_frame_equal(df, expected_summary[name])
+            with result_archive.Archive(archive_name) as archive:
+                self.assertEqual(archive.read('info.yaml'), b'deployment: debian9\n')
+                df = archive.dataframe('exp/exp_Recv.csv', columns=['duration'])
+                self.assertEqual(list(df.columns), ['duration'])
+                numpy.testing.assert_array_equal(df.duration, expected['exp/exp_Recv.csv'].duration)
+            self.assertEqual(list(extract_archive.extract_folder(tmp_dir)), [archive_name])
+        with self.assertRaises(ValueError):
+            result_archive.ArchiveWriter(os.devnull, codec='lzma')
+
+
+class InformationStoreTest(unittest.TestCase):
+    def test_hash(self):
+        contents = {
+            'cpuinfo.txt': b'processor\t: 0\ncpu MHz\t\t: 1200.000\nflags\t\t: fpu',
+            'lspci.txt': b'00:00.0 Host bridge\n\x00\xff\n',
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for filename, content in contents.items():
+                with open(os.path.join(tmp_dir, filename), 'wb') as f:
+                    f.write(content)
+            output = subprocess.check_output(['bash', '-c', information_store.hash_command(contents)], cwd=tmp_dir)
+        hashes = information_store.parse_hashes(output.decode())
+        for filename, content in contents.items():
+            self.assertEqual(hashes[filename], information_store.content_hash(filename, content))
+        other_frequency = contents['cpuinfo.txt'].replace(b'1200', b'2400')
+        self.assertEqual(information_store.content_hash('cpuinfo.txt', contents['cpuinfo.txt']),
+                         information_store.content_hash('cpuinfo.txt', other_frequency))
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = information_store.InformationStore(os.path.join(tmp_dir, 'store'))
+            first = os.path.join(tmp_dir, 'exp_2020-01-01_1.zip')
+            with zipfile.ZipFile(first, 'w') as archive:
+                archive.writestr('information/a/lspci.txt', b'foo')
+            hashes = store.add_archive(first)
+            self.assertTrue(store.has(hashes['a']['lspci.txt']))
+            self.assertIsNone(store.changes('a', hashes['a']))
+            second = os.path.join(tmp_dir, 'exp_2020-01-02_2.zip')
+            with zipfile.ZipFile(second, 'w') as archive:  # nothing collected, the file is already in the store
+                archive.writestr('information/', b'')
+                archive.writestr('information.yaml', 'a:\n  lspci.txt: %s\n' % hashes['a']['lspci.txt'])
+            store.add_archive(second, hashes)
+            self.assertEqual(store.changes('a', hashes['a']), [])
+            self.assertEqual(store.read(second, 'a', 'lspci.txt'), b'foo')
+            with self.assertRaises(ValueError):
+                store.add_archive(second, {'a': {'lspci.txt': '0'*64}})
+
+    def test_fingerprint(self):
+        fingerprint = subprocess.check_output(['bash', '-c', information_store.FINGERPRINT_COMMAND]).decode().strip()
+        self.assertRegex(fingerprint, '^[0-9a-f]{64}$')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = information_store.InformationStore(os.path.join(tmp_dir, 'store'))
+            self.assertFalse(store.unchanged('a', fingerprint))
+            hashes = {filename: store.add(filename, filename.encode()) for filename in information_store.HARDWARE_FILES}
+            store.see('a', hashes)
+            self.assertTrue(store.unchanged('a', fingerprint))
+            self.assertTrue(information_store.InformationStore(store.directory).unchanged('a', fingerprint))
+            self.assertFalse(store.unchanged('a', '0'*64))
+            os.remove(os.path.join(store.directory, 'blobs', hashes['lspci.txt']))
+            self.assertFalse(store.unchanged('a', fingerprint))
+
+
+class ComparisonTest(unittest.TestCase):
+    def test_compare(self):
+        rng = numpy.random.RandomState(42)
+
+        def measures(n, shift):
+            sizes = rng.choice([1, 1000], n)
+            durations = numpy.round(1e-6 + rng.exponential(1e-6, n) + shift*(sizes == 1000), 8)  # with ties
+            return pandas.DataFrame({'op': 'MPI_Recv', 'msg_size': sizes, 'duration': durations})
+        first, second = measures(600, 0), measures(400, 1e-6)
+        result = comparison.compare({'a.zip': {'exp/exp_Recv.csv': first}}, second).set_index('msg_size')
+        for size, row in result.iterrows():
+            x = first[first.msg_size == size].duration.values
+            y = second[second.msg_size == size].duration.values
+            grid = numpy.union1d(x, y)
+            cdf_x = numpy.searchsorted(numpy.sort(x), grid, 'right') / len(x)
+            cdf_y = numpy.searchsorted(numpy.sort(y), grid, 'right') / len(y)
+            self.assertAlmostEqual(row.ks_statistic, numpy.abs(cdf_x - cdf_y).max())
+            delta = ((y[:, None] > x[None, :]).sum() - (y[:, None] < x[None, :]).sum()) / (len(x) * len(y))
+            self.assertAlmostEqual(row.cliffs_delta, delta)
+            self.assertEqual(row.median_diff, numpy.median(y) - numpy.median(x))
+            self.assertLess(row.median_diff_low, row.median_diff)
+        self.assertGreater(result.mw_pvalue[1], 0.01)
+        self.assertLess(result.mw_adjusted_pvalue[1000], 1e-6)
+        self.assertLess(result.ks_adjusted_pvalue[1000], 1e-6)
+        summary = comparison.summarize(result.reset_index())
+        self.assertEqual(summary.fraction_different[0], 0.5)
+
+    def test_mann_whitney(self):
+        first = pandas.DataFrame({'op': 'op', 'msg_size': 1, 'duration': [1., 2, 3]})
+        second = pandas.DataFrame({'op': 'op', 'msg_size': 1, 'duration': [4., 5, 6]})
+        result = comparison.compare(first, second)
+        self.assertAlmostEqual(result.mw_pvalue[0], 0.0808556, places=6)  # normal approximation with continuity
+        self.assertEqual(result.cliffs_delta[0], 1)
+        numpy.testing.assert_allclose(comparison.adjust_pvalues([0.01, 0.04, numpy.nan, 0.03]),
+                                      [0.03, 0.04, numpy.nan, 0.04])
+
+
+class BootstrapTest(unittest.TestCase):
+    def measures(self, nb_iterations):
+        rng = numpy.random.RandomState(0)
+        sizes = numpy.unique(numpy.logspace(0, 6, 40).astype(int))
+        rows = []
+        for _ in range(nb_iterations):
+            for size in rng.permutation(sizes):
+                duration = 1e-6 + size*1e-10 if size < 10000 else 5e-6 + size*2e-10
+                rows.append(('MPI_Recv', size, len(rows)*1e-3, duration*(1 + rng.exponential(0.02))))
+        df = pandas.DataFrame(rows, columns=['op', 'msg_size', 'start', 'duration'])
+        df['index'] = range(len(df))
+        return df
+
+    def test_clean(self):
+        df = self.measures(5)
+        x, y = bootstrap.clean(df.msg_size, df.duration)
+        expected = extract_archive.clean_dataset(df)
+        numpy.testing.assert_array_equal(x, expected.msg_size)
+        numpy.testing.assert_allclose(y, expected.duration)
+
+    def test_bootstrap(self):
+        result = bootstrap.bootstrap_piecewise(self.measures(10), max_breakpoints=1, max_resamples=60,
+                                               min_resamples=20, batch_size=20, nb_workers=2)
+        self.assertLessEqual(result.nb_resamples + result.nb_failed, 60)
+        intervals = result.intervals.set_index('parameter')
+        self.assertEqual(list(intervals.index), ['breakpoint_1', 'intercept_0', 'intercept_1', 'slope_0', 'slope_1'])
+        self.assertTrue((intervals.low <= intervals.estimate).all() and (intervals.estimate <= intervals.high).all())
+        self.assertLessEqual(intervals.low['slope_1'], 2e-10*1.02)
+        self.assertGreaterEqual(intervals.high['slope_1'], 2e-10)
+
+
+class WalltimePredictorTest(unittest.TestCase):
+    def test_time(self):
+        self.assertEqual(repr(fabfile.Time.from_seconds(3725)), '01:02:05')
+        self.assertEqual(repr(fabfile.Time.from_seconds(59.2)), '00:01:00')
+
+    def test_stages(self):
+        commands = [(0, 'oarsub -t deploy'), (10, 'kadeploy3 -k'), (300, 'sudo-g5k apt update'), (330, 'hostname'),
+                    (340, 'mpirun --allow-run-as-root -np 2 ./calibrate'), (400, 'zip -r exp'), (402, 'oarstat')]
+        self.assertEqual(dict(walltime_predictor.stage_durations(commands, start=5)),
+                         {'setup': 5, 'deploy': 290, 'install': 40, 'calibration': 60, 'archive': 2})
+        self.assertEqual(walltime_predictor.stage_of('get: /home/alice/.ssh/id_rsa.pub → id_rsa.pub', 'install'),
+                         'install')
+        self.assertEqual(walltime_predictor.stage_of('get: /tmp/a-b_2018-06-29_1.zip → a-b_2018-06-29_1.zip',
+                                                     'calibration'), 'archive')
+
+    def test_archive(self):
+        record = walltime_predictor.archive_record('paravance-71-paravance-72_2018-06-29_1022596.zip')
+        self.assertEqual((record['cluster'], record['deployment'], record['nb_nodes']),
+                         ('paravance', 'debian9-x64-min', 2))
+        self.assertGreater(record['stages']['deploy'], 200)
+        self.assertLess(record['total'], record['requested'])
+        self.assertAlmostEqual(record['total'], sum(record['stages'].values()))
+
+    def test_history(self):
+        log = ('[2018-06-29 10:00:00,000][INFO] [director | /tmp] hostname\n'
+               '[2018-06-29 10:01:00,000][INFO] [director | /tmp] zip -r /tmp/a.zip exp\n')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for jobid in [None, 42]:
+                oarstat = {'assigned_network_address': ['paravance-1.rennes.grid5000.fr'], 'Job_Id': jobid}
+                with zipfile.ZipFile(os.path.join(tmp_dir, 'archive_%s.zip' % jobid), 'w') as archive:
+                    archive.writestr('info.yaml', 'deployment: false\n')
+                    archive.writestr('oarstat.yaml', json.dumps({key: value for key, value in oarstat.items()
+                                                                 if value is not None}))  # JSON is YAML
+                    archive.writestr('commands.log', log)
+            predictor = walltime_predictor.WalltimePredictor(os.path.join(tmp_dir, 'history.json'))
+            self.assertEqual(predictor.add_folder(tmp_dir), 1)
+            self.assertEqual([record['jobid'] for record in predictor.records], [42])
+            self.assertIsNone(predictor.add_archive(os.path.join(tmp_dir, 'archive_42.zip')))
+            with self.assertRaises(ValueError):
+                predictor.add_archive(os.path.join(tmp_dir, 'archive_None.zip'))
+
+    def test_walltime(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            predictor = walltime_predictor.WalltimePredictor(os.path.join(tmp_dir, 'history.json'))
+            for i in range(5):
+                predictor.records.append({'jobid': i, 'cluster': 'paravance', 'deployment': False,
+                                          'stages': {'setup': 10, 'install': 50, 'calibration': 30 + 10*i}})
+            self.assertEqual(predictor.predict('paravance', False)['calibration'], 68)
+            self.assertEqual(repr(predictor.walltime(['paravance'], False)), '00:05:00')  # 128s * 1.2 + 120s
+            self.assertIsNone(predictor.predict('paravance', 'debian9-x64-min'))
+            self.assertEqual(repr(predictor.walltime(['parasilo'], False, default=fabfile.Time(minutes=15))),
+                             '00:15:00')
+            with self.assertRaises(ValueError):
+                predictor.walltime(['paravance', 'parasilo'], False)
+
+    def test_oarsub_prediction(self):
+        predictor = MagicMock()
+        predictor.walltime.return_value = fabfile.Time(minutes=7)
+        with patch.object(fabfile.Job, 'oarsub') as oarsub, patch.object(fabfile.Job, 'g5k_connection'):
+            fabfile.Job.oarsub_cluster('rennes', 'alice', ['paravance'], None, 2, predictor=predictor, calibration=True)
+            self.assertEqual(repr(oarsub.call_args[0][2]), '00:07:00')
+            with self.assertRaises(ValueError):  # an HPL job gives its own walltime
+                fabfile.Job.oarsub_hostnames('rennes', 'alice', ['paravance-1'], None, predictor=predictor)
+        predictor.walltime.assert_called_once_with(['paravance'], True)
+
+    def test_broken_history(self):
+        predictor = MagicMock()
+        predictor.add_archive.side_effect = ValueError('no start date')
+        job = MagicMock()
+        with patch.object(fabfile, 'mpi_install'), patch.object(fabfile, 'send_key'), \
+                patch.object(fabfile, 'run_calibration', return_value='a.zip'):
+            with self.assertLogs(fabfile.logger, 'WARNING') as logs:
+                self.assertIs(fabfile.mpi_calibration(job, predictor=predictor), job)
+        self.assertIn('a.zip', logs.output[0])
+
+
+class PairPlannerTest(unittest.TestCase):
+    def test_parse(self):
+        def resource(host, state='Alive', maintenance='NO'):
+            return {'network_address': '%s.rennes.grid5000.fr' % host, 'state': state,
+                    'properties': {'cluster': 'paravance', 'switch': 'sw-%s' % host[-1], 'maintenance': maintenance}}
+        output = json.dumps({str(i): res for i, res in enumerate([resource('paravance-1'), resource('paravance-1'),
+                                                                   resource('paravance-2'),
+                                                                   resource('paravance-2', state='Suspected'),
+                                                                   resource('paravance-3', maintenance='YES')])})
+        nodes = pair_planner.parse_oarnodes(output)
+        self.assertEqual({host: info.available for host, info in nodes.items()},
+                         {'paravance-1': True, 'paravance-2': False, 'paravance-3': False})
+        self.assertEqual(nodes['paravance-1'].switch, 'sw-1')
+
+    def test_plan(self):
+        random.seed(42)
+        switches = {'node-%d' % i: 'sw-%d' % (i % 3) for i in range(20)}
+        switches['lonely'] = 'sw-3'
+        pairs = pair_planner.plan_pairs(switches)
+        self.assertEqual({node for pair in pairs for node in pair}, set(switches))
+        links = {frozenset([switches[node1], switches[node2]]) for node1, node2 in pairs}
+        intra = {link for link in links if len(link) == 1}
+        self.assertEqual(intra, {frozenset(['sw-%d' % i]) for i in range(3)})
+        self.assertEqual(links - intra, {frozenset(pair) for pair in itertools.combinations(set(switches.values()), 2)})
+        self.assertLessEqual(len(pairs), 3*4 + 6)  # instead of 210
+        for nb_pairs in [12, 15, 100]:  # 9 pairs within the switches, 3 more for the nodes left alone
+            selected = pair_planner.select_pairs(pairs, nb_pairs)
+            self.assertEqual(len(selected), min(nb_pairs, len(pairs)))
+            self.assertEqual({node for pair in selected for node in pair}, set(switches))
+        selected = pair_planner.select_pairs(pairs, 7)
+        self.assertEqual(len({node for pair in selected for node in pair}), 14)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,145 @@
+import os
+import json
+import collections
+import lxml.etree
+
+CACHE_DIR = os.path.expanduser('~/.cache/mpi_calibration/topology')
+
+_CONTAINER_TYPES = ('Machine', 'NUMANode', 'Package', 'Group', 'Cache', 'L3Cache', 'L2Cache', 'L1Cache', 'L1dCache',
+                    'L1iCache')
+
+Core = collections.namedtuple('Core', ['package', 'numa', 'pus'])
+
+
+class Topology:
+    def __init__(self, cores):
+        self.cores = [Core(*core) for core in cores]
+
+    def __eq__(self, other):
+        return self.cores == other.cores
+
+    @classmethod
+    def from_xml(cls, xml):
+        if isinstance(xml, str):
+            xml = lxml.etree.fromstring(xml.encode('utf8'))
+        cores = []
+        cls.__process_object(xml.findall('object')[0], cores, package=0, numa=0)
+        return cls(cores)
+
+    @classmethod
+    def __process_object(cls, xml, cores, package, numa):
+        children = xml.findall('object')
+        # With hwloc 2, NUMA nodes are memory children of their package (or group), they do not contain the cores.
+        for obj in children:
+            if obj.get('type') == 'NUMANode' and not obj.findall('.//object[@type="Core"]'):
+                numa = int(obj.get('os_index'))
+        for obj in children:
+            obj_type = obj.get('type')
+            if obj_type == 'Core':
+                pus = []
+                for pu in obj.findall('object'):
+                    assert pu.get('type') == 'PU'
+                    pus.append(int(pu.get('os_index')))
+                cores.append((package, numa, pus))
+            elif obj_type in _CONTAINER_TYPES:
+                cls.__process_object(obj, cores,
+                                     package=int(obj.get('os_index')) if obj_type == 'Package' else package,
+                                     numa=int(obj.get('os_index')) if obj_type == 'NUMANode' else numa)
+
+    def to_dict(self):
+        return {'cores': [list(core) for core in self.cores]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['cores'])
+
+    @property
+    def core_pus(self):
+        return [list(core.pus) for core in self.cores]
+
+    def domains(self, level):
+        if level == 'node':
+            key = lambda core: 0
+        elif level == 'socket':
+            key = lambda core: core.package
+        elif level == 'numa':
+            key = lambda core: core.numa
+        else:
+            raise ValueError('Unknown placement level %s, expected one of node, socket and numa.' % level)
+        result = collections.OrderedDict()
+        for core in self.cores:
+            result.setdefault(key(core), []).append(core)
+        return list(result.values())
+
+    def placement(self, ranks_per='node', cores_per_rank=None, ranks_per_domain=None):
+        '''
+        Ranks of cores_per_rank cores (by default, the whole domain) in each domain. By default, the domains are filled,
+        ranks_per_domain can be given to use only some of their cores.
+        '''
+        domains = self.domains(ranks_per)
+        sizes = set(len(dom) for dom in domains)
+        if len(sizes) != 1:
+            raise ValueError('Cannot place ranks per %s, the domains have different sizes: %s' % (ranks_per, sizes))
+        domain_size = sizes.pop()
+        cores_per_rank = cores_per_rank or domain_size
+        if not 0 < cores_per_rank <= domain_size:
+            raise ValueError('Cannot use %d cores per rank with %d cores per %s.' % (cores_per_rank, domain_size,
+                                                                                   ranks_per))
+        max_ranks = domain_size // cores_per_rank
+        ranks_per_domain = ranks_per_domain or max_ranks
+        if ranks_per_domain > max_ranks:
+            raise ValueError('Cannot place %d ranks of %d core(s) per %s of %d cores.' % (
+                ranks_per_domain, cores_per_rank, ranks_per, domain_size))
+        ranks = []
+        for dom in domains:
+            for i in range(ranks_per_domain):
+                cores = dom[i*cores_per_rank:(i+1)*cores_per_rank]
+                ranks.append([core.pus[0] for core in cores])
+        return Placement(ranks_per, ranks_per_domain, cores_per_rank, ranks)
+
+
+class Placement:
+    '''
+    Binding map for the MPI ranks of a single node: each rank is bound to cores_per_rank cores (one PU per core)
+    taken from the same domain (node, socket or NUMA node).
+    '''
+    def __init__(self, level, ranks_per_domain, cores_per_rank, ranks):
+        self.level = level
+        self.ranks_per_domain = ranks_per_domain
+        self.cores_per_rank = cores_per_rank
+        self.ranks = ranks
+
+    def __repr__(self):
+        return '%s(%d rank(s) per %s, %d core(s) per rank)' % (self.__class__.__name__, self.ranks_per_domain,
+                                                              self.level, self.cores_per_rank)
+
+    @property
+    def ranks_per_node(self):
+        return len(self.ranks)
+
+    def nb_ranks(self, nb_nodes):
+        return self.ranks_per_node * nb_nodes
+
+    def mpirun_options(self):
+        return '--map-by ppr:%d:%s:PE=%d --bind-to core -x OMP_NUM_THREADS=%d -x OMP_PROC_BIND=true' % (
+                self.ranks_per_domain, self.level, self.cores_per_rank, self.cores_per_rank)
+
+
+class TopologyCache:
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+
+    def __path(self, key):
+        return os.path.join(self.directory, '%s.json' % key)
+
+    def get(self, key):
+        try:
+            with open(self.__path(key)) as f:
+                return Topology.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, topology):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.__path(key), 'w') as f:
+            json.dump(topology.to_dict(), f)
@@ -0,0 +1,97 @@
+import os
+import datetime
+import pandas
+import hpl
+import real_hpl
+from fabfile import logger, get_cluster
+
+RESULTS_FILE = 'validation.csv'
+# Parameters identifying a configuration, on which the real and the simulated runs are matched
+FIELDS = ['size', 'block_size', 'proc_p', 'proc_q', 'bcast', 'pfact', 'rfact', 'depth']
+
+
+def _by_configuration(rows, prefix):
+    df = pandas.DataFrame(rows)
+    df = df.groupby(FIELDS).agg(time=('time', 'median'), gflops=('gflops', 'median'), nb_runs=('time', 'count'))
+    return df.add_prefix(prefix).reset_index()
+
+
+def compare(real_rows, simulated_rows):
+    '''
+    Match the real and simulated runs of the same configurations (the median of the runs is taken if a configuration
+    is run several times) and compute the relative error of the prediction of the duration, (simulated - real)/real.
+    '''
+    real = _by_configuration(real_rows, 'real_')
+    simulated = _by_configuration(simulated_rows, 'simulated_')
+    df = real.merge(simulated, on=FIELDS, how='inner')
+    df['relative_error'] = (df.simulated_time - df.real_time) / df.real_time
+    return df
+
+
+def store_results(df, filename=RESULTS_FILE):
+    '''Append to the shared results table.'''
+    df.to_csv(filename, mode='a', header=not os.path.exists(filename), index=False)
+
+
+def load_results(filename=RESULTS_FILE):
+    return pandas.read_csv(filename)
+
+
+def error_breakdown(df, parameters=FIELDS):
+    '''
+    For each value of each parameter: number of configurations, mean relative error (the bias of the prediction) and
+    mean absolute relative error.
+    '''
+    result = []
+    for parameter in parameters:
+        if df[parameter].nunique() < 2:
+            continue
+        grouped = df.groupby(parameter).relative_error
+        stats = pandas.DataFrame({
+            'count': grouped.count(),
+            'mean_error': grouped.mean(),
+            'mean_abs_error': df.relative_error.abs().groupby(df[parameter]).mean(),
+        }).reset_index().rename(columns={parameter: 'value'})
+        stats.insert(0, 'parameter', parameter)
+        result.append(stats)
+    if not result:
+        return pandas.DataFrame(columns=['parameter', 'value', 'count', 'mean_error', 'mean_abs_error'])
+    return pandas.concat(result, ignore_index=True)
+
+
+def report(df):
+    errors = df.relative_error.dropna()
+    if errors.empty:
+        logger.warning('No configuration has both a real and a simulated run, nothing to report.')
+        return
+    logger.info('%d configuration(s): mean error %+.1f%%, mean absolute error %.1f%%, worst %+.1f%%' % (
+        len(errors), errors.mean()*100, errors.abs().mean()*100, errors[errors.abs().idxmax()]*100))
+    for _, row in error_breakdown(df).iterrows():
+        logger.info('  %s=%s: %d configuration(s), mean error %+.1f%%, mean absolute error %.1f%%' % (
+            row.parameter, row.value, row['count'], row.mean_error*100, row.mean_abs_error*100))
+
+
+def validate(job, configurations, network_config=None, simulation_job=None, ranks_per='node', cores_per_rank=None,
+             profile=None, filename=RESULTS_FILE, **simulation_kwargs):
+    '''
+    Run the given HPL configurations (dictionaries with the arguments of real_hpl.generate_hpl_file) on the nodes of
+    job, simulate them with SMPI on the nodes of simulation_job (by default, the same job, which must then have both
+    HPL builds), with the same number of ranks per node. The pairs are appended to the results table filename.
+    '''
+    simulation_job = simulation_job or job
+    configurations = [dict(real_hpl.HPL_DEFAULTS, **configuration) for configuration in configurations]
+    real_rows, _ = real_hpl.run_batch(job, configurations, ranks_per=ranks_per, cores_per_rank=cores_per_rank,
+                                      profile=profile)
+    ranks_per_host = job.nodes.placement(ranks_per=ranks_per, cores_per_rank=cores_per_rank).ranks_per_node
+    simulated = hpl.run_simulations(simulation_job, configurations, network_config=network_config,
+                                    ranks_per_host=ranks_per_host, **simulation_kwargs)
+    simulated = simulated[simulated.simulated_time.notnull()]
+    simulated_rows = simulated.rename(columns={'simulated_time': 'time'}).to_dict('records')
+    df = compare(real_rows, simulated_rows)
+    df['cluster'] = get_cluster(job.hostnames[0])
+    df['nb_nodes'] = len(job.hostnames)
+    df['ranks_per'] = ranks_per
+    df['date'] = datetime.datetime.now().isoformat()
+    store_results(df, filename)
+    report(df)
+    return df
@@ -0,0 +1,199 @@
+import os
+import re
+import json
+import math
+import zipfile
+import datetime
+import collections
+import yaml
+from fabfile import Time, get_cluster
+
+HISTORY_FILE = 'walltime_history.json'
+
+# Stages of a job, recognized from the commands of commands.log (the first pattern that matches). A command that
+# matches no pattern belongs to the stage of the previous one; the commands before the first match are the setup.
+SETUP_STAGE = 'setup'
+STAGES = collections.OrderedDict([
+    ('deploy', r'kadeploy3'),
+    ('install', r'\bapt(-get)? |git clone|\bmake\b|pip3? install'),
+    ('calibration', r'mpirun (--allow-run-as-root|-np)'),
+    ('archive', r'\bzip |information/|lstopo|get: \S+\.zip'),
+])
+
+LOG_LINE = re.compile(r'^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3})\]\[\w+\] (?:\[[^\]]+\] )?(.*)$')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def parse_log(text):
+    '''The (date, command) pairs of commands.log, the dates are naive local dates.'''
+    result = []
+    for line in text.splitlines():
+        match = LOG_LINE.match(line)
+        if match:
+            date = datetime.datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S,%f')
+            result.append((date, match.group(2)))
+    return result
+
+
+def stage_of(command, previous):
+    for stage, pattern in STAGES.items():
+        if re.search(pattern, command):
+            return stage
+    return previous
+
+
+def stage_durations(commands, start=None):
+    '''
+    Duration of each stage, in seconds, the duration of a command being the time until the next one. The commands
+    are (timestamp, command) pairs, the timestamps in seconds. If the start of the job is given, the commands done
+    before (e.g. the submission) are ignored and the time between the start and the first command goes in the setup.
+    '''
+    durations = collections.OrderedDict([(SETUP_STAGE, 0.0)])
+    if start is not None:
+        commands = [(timestamp, command) for timestamp, command in commands if timestamp >= start]
+        if commands:
+            durations[SETUP_STAGE] = commands[0][0] - start
+    stage = SETUP_STAGE
+    for (timestamp, command), (next_timestamp, _) in zip(commands, commands[1:]):
+        stage = stage_of(command, stage)
+        durations[stage] = durations.get(stage, 0.0) + next_timestamp - timestamp
+    return durations
+
+
+def _open(archive_name):
+    if archive_name.endswith('.carc'):
+        import result_archive  # only for the converted archives, it needs numpy and pandas
+        return result_archive.Archive(archive_name)
+    return zipfile.ZipFile(archive_name)
+
+
+def archive_record(archive_name):
+    '''Cluster, deployment, number of nodes, requested walltime and stage durations of the job of an archive.'''
+    with _open(archive_name) as archive:
+        info = yaml.safe_load(archive.read('info.yaml'))
+        oarstat = yaml.safe_load(archive.read('oarstat.yaml'))
+        log = parse_log(archive.read('commands.log').decode())
+    if not log:
+        raise ValueError('No command in the log of %s.' % archive_name)
+    jobid = info.get('jobid', oarstat.get('Job_Id'))
+    if jobid is None:  # the jobs are told apart by their id
+        raise ValueError('No job id in %s.' % archive_name)
+    hostnames = oarstat.get('assigned_network_address') or [host for host, value in info.items()
+                                                             if isinstance(value, dict)]
+    deployment = info.get('deployment', 'deploy' in (oarstat.get('types') or []))
+    timestamps = [(date - EPOCH).total_seconds() for date, _ in log]
+    start = oarstat.get('startTime')
+    if start:
+        # The log has local dates, the start of the job is a UNIX timestamp: the difference between the two, rounded
+        # to a quarter of an hour, is the UTC offset of the frontend.
+        start = int(start) + round((timestamps[0] - int(start)) / 900) * 900
+    durations = stage_durations([(timestamp, command) for timestamp, (_, command) in zip(timestamps, log)], start)
+    return {
+        'archive': os.path.basename(archive_name),
+        'jobid': int(jobid),
+        'cluster': get_cluster(hostnames[0]),
+        'deployment': deployment,
+        'nb_nodes': len(hostnames),
+        'requested': int(oarstat['walltime']) if oarstat.get('walltime') else None,
+        'stages': durations,
+        'total': sum(durations.values()),
+    }
+
+
+def _quantile(values, quantile):
+    '''Quantile of the values, with a linear interpolation (as numpy.quantile).'''
+    values = sorted(values)
+    position = (len(values) - 1) * quantile
+    low = int(math.floor(position))
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class WalltimePredictor:
+    '''
+    Stage durations of past calibrations (see archive_record), per cluster and deployment, kept in a JSON file. The
+    walltime of a new job is the sum over the stages of a high quantile of their durations, plus a safety margin.
+    '''
+    def __init__(self, filename=HISTORY_FILE):
+        self.filename = filename
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.records = json.load(f)
+        else:
+            self.records = []
+
+    def save(self):
+        tmp_path = self.filename + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.records, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.filename)
+
+    def __add(self, archive_name):
+        record = archive_record(archive_name)
+        if any(other['jobid'] == record['jobid'] for other in self.records):
+            return None
+        self.records.append(record)
+        return record
+
+    def add_archive(self, archive_name):
+        '''Add the job of the archive to the history (unless it is already there), return its record or None.'''
+        record = self.__add(archive_name)
+        if record:
+            self.save()
+        return record
+
+    def add_folder(self, folder_name):
+        '''Add the jobs of all the archives of the folder, return the number of new ones.'''
+        nb_records = 0
+        for root, dirs, files in os.walk(folder_name):
+            for file in sorted(files):
+                if file.endswith('.zip') or file.endswith('.carc'):
+                    try:
+                        nb_records += self.__add(os.path.join(root, file)) is not None
+                    except (KeyError, ValueError):  # an old archive, without the log, the oarstat or the job id
+                        continue
+        self.save()
+        return nb_records
+
+    def matching_records(self, cluster, deployment, min_records=3):
+        '''
+        The records of the cluster with the same deployment. If there are fewer than min_records of them and the job
+        is deployed, those of any deployed environment.
+        '''
+        records = [record for record in self.records if record['cluster'] == cluster]
+        result = [record for record in records if record['deployment'] == deployment]
+        if len(result) < min_records and deployment:
+            result = [record for record in records if record['deployment']]
+        return result
+
+    def predict(self, cluster, deployment, quantile=0.95, min_records=3):
+        '''Predicted duration of the stages of a calibration, in seconds, or None without enough history.'''
+        records = self.matching_records(cluster, deployment, min_records)
+        if len(records) < min_records:
+            return None
+        stages = collections.OrderedDict()
+        for record in records:
+            for stage, duration in record['stages'].items():
+                if stage == 'deploy' and not deployment:
+                    continue
+                stages.setdefault(stage, []).append(duration)
+        return collections.OrderedDict((stage, _quantile(durations, quantile)) for stage, durations in stages.items())
+
+    def walltime(self, clusters, deployment, default=None, quantile=0.95, margin=0.2, min_margin=120,
+                 min_records=3):
+        '''
+        Walltime for a calibration on one of the clusters: the longest prediction for them, increased by a fraction
+        margin and by min_margin seconds, rounded up to the minute. Without enough history for one of the clusters,
+        return the default walltime, or raise a ValueError if there is none.
+        '''
+        predictions = []
+        for cluster in clusters:
+            stages = self.predict(cluster, deployment, quantile=quantile, min_records=min_records)
+            if stages is None:
+                if default is None:
+                    raise ValueError('Fewer than %d jobs in the history of cluster %s, give a walltime.' % (
+                        min_records, cluster))
+                return default
+            predictions.append(sum(stages.values()))
+        seconds = max(predictions) * (1 + margin) + min_margin
+        return Time.from_seconds(math.ceil(seconds / 60) * 60)